@@ -4,7 +4,6 @@ import time
 import queue
 import dbutils
 import threading
-import qrcode
 from enum import Enum
 from decouple import config
 from io import BytesIO
@@ -161,6 +160,9 @@ class TelegramBotThread(threading.Thread):
             if data.get("ok"):
                 botname = data["result"]["username"]
 
+                #This is only needed while setting the bot up, so it's imported here rather than at start up
+                import qrcode
+
                 bot_url = f"https://t.me/{botname}"
                 code = qrcode.make(bot_url)
 
@@ -0,0 +1,135 @@
+import os
+import queue
+import threading
+from decouple import config
+from vision import VisionPipeline
+from vision_process import VisionProcess
+from pipeline import FrameBusFull, bus_prefix, frame_bus
+
+#Every camera gets its own vision engine (capture, detection and tracking), its own message queue and its own
+#recording, so one container can watch several cameras. The cameras themselves are kept in the database
+
+def parse_camera_source(source):
+    #Sources are stored as text. DEFAULT is the first local camera, and a plain number is a local camera too
+    if source is None or source == "DEFAULT":
+        return 0
+    elif str(source).isdigit():
+        return int(source)
+    else:
+        return source
+
+class Camera:
+    def __init__(self, camera_id, name, source, record_source=None):
+        self.id = camera_id
+        self.name = name
+        self.source = source
+        #The (usually higher resolution) stream we record from, None means we record from source
+        self.record_source = record_source
+
+        #Made by CameraRegistry.create_engine the first time this camera starts
+        self.vision = None
+
+        #The message queue takes the messages from object detection and uses them to start a recording
+        self.message_queue = queue.Queue(maxsize=1)
+        self.last_msg_time = 0
+        self.messaging_thread = None
+
+        #This is a threading.Event and not a boolean to prevent race conditions
+        self.recording_event = threading.Event()
+        self.record_count = 0
+
+        #Records this camera all of the time when CONTINUOUS_RECORDING is on
+        self.segment_recorder = None
+
+    @property
+    def running(self):
+        return self.vision is not None and self.vision.running.is_set()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "source": self.source,
+            "record_source": self.record_source,
+            "running": self.running,
+            "recording": self.recording_event.is_set()
+        }
+
+class CameraRegistry:
+    #Keeps track of the cameras and shares the CPU out between them. Every camera's detector gets an
+    #equal slice of VISION_THREAD_BUDGET threads (but no more than DETECTOR_THREADS), and with
+    #VISION_PROCESS=True the first MAX_VISION_PROCESSES cameras get their own process while the rest
+    #run as threads in the web server. The slices are worked out when a camera's engine is made, so
+    #adding a camera doesn't take threads away from the ones already running until they restart
+    def __init__(self, display_size, detection_size, record_size=None, thread_budget=None, process_budget=None):
+        self.display_size = display_size
+        self.detection_size = detection_size
+        self.record_size = record_size or display_size
+
+        if thread_budget is None:
+            thread_budget = config("VISION_THREAD_BUDGET", default=os.cpu_count() or 1, cast=int)
+        if process_budget is None:
+            process_budget = config("MAX_VISION_PROCESSES", default=os.cpu_count() or 1, cast=int) if config("VISION_PROCESS", default=False, cast=bool) else 0
+
+        self.thread_budget = max(1, thread_budget)
+        self.process_budget = max(0, process_budget)
+
+        self.cameras = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self, rows):
+        #rows are the cameras from dbutils.get_cameras
+        with self.lock:
+            for row in rows:
+                if row["id"] not in self.cameras:
+                    self.cameras[row["id"]] = Camera(row["id"], row["name"], row["source"], row.get("record_source"))
+            self.loaded = True
+
+    def add(self, camera_id, name, source, record_source=None):
+        with self.lock:
+            camera = Camera(camera_id, name, source, record_source)
+            self.cameras[camera_id] = camera
+            return camera
+
+    def remove(self, camera_id):
+        #Hands back the camera so the caller can stop it
+        with self.lock:
+            return self.cameras.pop(camera_id, None)
+
+    def get(self, camera_id=None):
+        #No id means the default camera, which is the one that's been around the longest
+        with self.lock:
+            if camera_id is None:
+                return self.cameras[min(self.cameras)] if self.cameras else None
+            return self.cameras.get(camera_id)
+
+    def __iter__(self):
+        with self.lock:
+            return iter([self.cameras[camera_id] for camera_id in sorted(self.cameras)])
+
+    def __len__(self):
+        return len(self.cameras)
+
+    def plan(self, camera):
+        #Returns (run in a process, detector threads) for this camera
+        with self.lock:
+            order = sorted(self.cameras)
+            threads = max(1, min(config("DETECTOR_THREADS", default=1, cast=int), self.thread_budget // max(1, len(order))))
+            in_process = camera.id in order[:self.process_budget]
+            return in_process, threads
+
+    def create_engine(self, camera, on_message, processing_method=0):
+        in_process, threads = self.plan(camera)
+        engine = VisionProcess if in_process else VisionPipeline
+        record_source = parse_camera_source(camera.record_source) if camera.record_source else None
+        try:
+            camera.vision = engine(parse_camera_source(camera.source), self.display_size, self.detection_size, on_message,
+                                   processing_method=processing_method, camera_id=camera.id, detector_threads=threads,
+                                   record_source=record_source, record_size=self.record_size)
+        except FrameBusFull:
+            #Give back whatever it reserved before it ran out, or nobody else could have it either
+            frame_bus().release(bus_prefix(camera.id))
+            camera.vision = None
+            raise
+        return camera.vision
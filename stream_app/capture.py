@@ -0,0 +1,248 @@
+import cv2 as cv
+import numpy as np
+import subprocess
+import threading
+import time
+from decouple import config
+
+#The capture backends all look like a cv.VideoCapture (isOpened, read, release), so the capture thread
+#doesn't care which one it's talking to. The only difference is that read() hands back frames that are
+#already at the size we asked for, in a buffer that the backend reuses on the next read
+
+class CaptureBackend:
+    #Whether the backend can move on to the next frame with grab() and only finish it off (convert and resize it)
+    #with retrieve() if it's wanted, like a cv.VideoCapture can. read() is the same as grab() then retrieve()
+    can_grab = False
+
+    def __init__(self, source, size):
+        self.source = source
+        self.size = size
+        #Every frame gets written into this one buffer instead of allocating a new one each time
+        self.buffer = np.zeros((size[1], size[0], 3), np.uint8)
+
+    def isOpened(self):
+        raise NotImplementedError("Please implement the isOpened function")
+
+    def read(self):
+        #Returns (success, frame). The frame is only valid until the next call to read
+        raise NotImplementedError("Please implement the read function")
+
+    def release(self):
+        pass
+
+class OpenCVCapture(CaptureBackend):
+    #This is what we've always done, cv.VideoCapture does the decoding and we resize afterwards
+    can_grab = True
+
+    def __init__(self, source, size):
+        super().__init__(source, size)
+        self.raw = None
+        self.camera = cv.VideoCapture(source)
+        if self.camera.isOpened():
+            self.camera.set(cv.CAP_PROP_AUTOFOCUS, 0) # turn the autofocus off
+
+    def isOpened(self):
+        return self.camera.isOpened()
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def grab(self):
+        return self.camera.grab()
+
+    def retrieve(self):
+        #Passing the old raw frame back in lets OpenCV convert into the same memory
+        success, self.raw = self.camera.retrieve(self.raw)
+        if not success or self.raw is None:
+            return False, None
+
+        cv.resize(self.raw, self.size, dst=self.buffer, interpolation=cv.INTER_AREA)
+        return True, self.buffer
+
+    def release(self):
+        self.camera.release()
+
+class FFmpegPipeCapture(CaptureBackend):
+    #This gets ffmpeg to do the decoding, scaling and conversion to BGR in its own process and threads,
+    #and we just read fixed size raw frames off of its stdout. This keeps all of that work off of the GIL
+    def __init__(self, source, size, threads=None, low_delay=True):
+        #Only imported if this backend gets used, to keep start up quick
+        import ffmpeg
+
+        super().__init__(source, size)
+        self.frame_bytes = size[0] * size[1] * 3
+        self.view = memoryview(self.buffer.reshape(-1))
+
+        input_args = {}
+        if isinstance(source, int):
+            #A plain number is a local camera (the container always runs linux), which ffmpeg needs to be told how to open
+            source, input_args["f"] = f"/dev/video{source}", "v4l2"
+        elif low_delay and "://" in source:
+            #For network streams, don't let ffmpeg sit on a buffer of frames before giving them to us. Not for files,
+            #where there's no hurry and low_delay stops anything with B-frames (our own recordings) decoding at all
+            input_args["fflags"] = "nobuffer"
+            input_args["flags"] = "low_delay"
+
+        if threads is not None:
+            input_args["threads"] = threads
+
+        stream = (
+            ffmpeg
+            .input(source, **input_args)
+            .output("pipe:", format="rawvideo", pix_fmt="bgr24", vf=f"scale={size[0]}:{size[1]}:flags=area")
+            .global_args("-hide_banner", "-loglevel", "error")
+        )
+
+        try:
+            self.process = subprocess.Popen(stream.compile(), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, bufsize=0)
+        except OSError as e:
+            print(f"[capture] Could not start ffmpeg: {e}", flush=True)
+            self.process = None
+
+    def isOpened(self):
+        return self.process is not None and self.process.poll() is None
+
+    def read(self):
+        if self.process is None:
+            return False, None
+
+        #Read straight into our buffer, which can take a few goes since pipes give us whatever is available
+        received = 0
+        while received < self.frame_bytes:
+            count = self.process.stdout.readinto(self.view[received:])
+            if not count:
+                return False, None
+            received += count
+
+        return True, self.buffer
+
+    def release(self):
+        if self.process is None:
+            return
+
+        self.process.stdout.close()
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+class LatestFrameGrabber:
+    #Network streams hand us their frames in order, so if we process slower than the camera sends
+    #we end up working on frames from seconds ago. This wraps a backend with a thread that reads
+    #as fast as the source delivers and only keeps the newest frame, counting the ones we skipped. A backend that
+    #can_grab only has the frames that get delivered converted and resized, the ones we skip are just grabbed past.
+    #The ffmpeg pipe has no way of skipping a frame without reading all of it
+    def __init__(self, backend, timeout=1.0):
+        self.backend = backend
+        self.timeout = timeout
+        self.latest = np.zeros_like(backend.buffer)
+        self.output = np.zeros_like(backend.buffer)
+        self.fresh = False
+        #Set while read is waiting, so the grabber knows to finish off the next frame it grabs. The backend can't
+        #retrieve one frame while it's grabbing the next, so read gets the next frame the camera sends rather than
+        #one it has already sent, which is at most a frame's time away and as fresh as it gets
+        self.wanted = False
+        self.running = True
+        self.grabbed = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.grab_frames, daemon=True)
+        if backend.isOpened():
+            self.thread.start()
+
+    def grab_frames(self):
+        while self.running:
+            try:
+                if self.backend.can_grab:
+                    success, frame = self.backend.grab(), None
+                    if success:
+                        with self.condition:
+                            self.grabbed += 1
+                            if not self.wanted:
+                                #Nobody's waiting for it, so it never gets any further than this
+                                self.dropped += 1
+                                continue
+                        success, frame = self.backend.retrieve()
+                else:
+                    success, frame = self.backend.read()
+                    if success:
+                        self.grabbed += 1
+            except (ValueError, OSError):
+                #This happens if the backend gets released out from under us while we're waiting on it
+                break
+
+            if not success:
+                if not self.backend.isOpened():
+                    break
+                #Give a struggling source a moment instead of spinning on it
+                time.sleep(0.01)
+                continue
+
+            with self.condition:
+                np.copyto(self.latest, frame)
+                if self.fresh:
+                    #Nobody picked up the last one before this one arrived
+                    self.dropped += 1
+                self.fresh = True
+                self.condition.notify()
+
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def isOpened(self):
+        return self.running and self.thread.is_alive()
+
+    def read(self):
+        with self.condition:
+            self.wanted = True
+            try:
+                if not self.condition.wait_for(lambda: self.fresh or not self.running, timeout=self.timeout) or not self.fresh:
+                    return False, None
+            finally:
+                self.wanted = False
+
+            #Swapping means we never copy on this side, the old output becomes the grabber's next slot
+            self.latest, self.output = self.output, self.latest
+            self.fresh = False
+            self.delivered += 1
+            return True, self.output
+
+    def release(self):
+        #Anyone waiting in read gets let go straight away, rather than once the backend gives up its next frame
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread.is_alive():
+            self.thread.join(timeout=2)
+        self.backend.release()
+
+    @property
+    def stats(self):
+        return {
+            "grabbed": self.grabbed,
+            "delivered": self.delivered,
+            "dropped": self.dropped
+        }
+
+def open_capture(source, size):
+    #CAPTURE_BACKEND picks how we open the camera, either opencv (the default) or ffmpeg
+    backend = config("CAPTURE_BACKEND", default="opencv").lower()
+
+    if backend == "ffmpeg":
+        threads = config("FFMPEG_THREADS", default=None)
+        capture = FFmpegPipeCapture(source, size, threads=int(threads) if threads else None)
+    else:
+        capture = OpenCVCapture(source, size)
+
+    #By default we always work on the freshest frame, set LATEST_FRAME_GRABBER=False to process every frame in order
+    if config("LATEST_FRAME_GRABBER", default=True, cast=bool):
+        capture = LatestFrameGrabber(capture)
+
+    return capture
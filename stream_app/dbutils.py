@@ -3,6 +3,7 @@ from datetime import datetime
 import cv2 as cv
 import base64
 import os
+import json
 
 def load_database(db_name="/app/db/byakugan.db"):
     conn = sqlite3.connect(db_name)
@@ -20,6 +21,31 @@ def load_database(db_name="/app/db/byakugan.db"):
     if cursor.fetchone() is None:
         raise RuntimeError("Error creating Alerts table in database")
     
+    cursor.execute("CREATE TABLE IF NOT EXISTS Cameras ( id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL UNIQUE, source TEXT NOT NULL )")
+    cursor.execute("SELECT name FROM sqlite_master WHERE name='Cameras' AND type='table'")
+    if cursor.fetchone() is None:
+        raise RuntimeError("Error creating Cameras table in database")
+
+    #Recordings and alerts made before there was more than one camera don't have a camera_id, so they get NULL
+    add_column_if_missing(conn, cursor, "Recordings", "camera_id", "INTEGER")
+    add_column_if_missing(conn, cursor, "Alerts", "camera_id", "INTEGER")
+    #A separate (usually higher resolution) stream to record from, NULL records what we detect on
+    add_column_if_missing(conn, cursor, "Cameras", "record_source", "TEXT")
+
+    #With CONTINUOUS_RECORDING every camera records all the time into fixed length segments, and these are they. end_time
+    #and size are NULL while a segment is still being written. Paths are relative to /app/recordings
+    cursor.execute("CREATE TABLE IF NOT EXISTS Segments ( id INTEGER PRIMARY KEY AUTOINCREMENT, camera_id INTEGER, path TEXT NOT NULL, start_time REAL NOT NULL, end_time REAL, size INTEGER )")
+    cursor.execute("SELECT name FROM sqlite_master WHERE name='Segments' AND type='table'")
+    if cursor.fetchone() is None:
+        raise RuntimeError("Error creating Segments table in database")
+    cursor.execute("CREATE INDEX IF NOT EXISTS SegmentsByTime ON Segments (camera_id, start_time)")
+
+    #An alert from continuous recording doesn't have a file of its own, it's clip_seconds of footage starting
+    #segment_offset seconds into segment_id. clip_seconds is NULL while it's still going
+    add_column_if_missing(conn, cursor, "Alerts", "segment_id", "INTEGER")
+    add_column_if_missing(conn, cursor, "Alerts", "segment_offset", "REAL")
+    add_column_if_missing(conn, cursor, "Alerts", "clip_seconds", "REAL")
+
     cursor.execute("CREATE TABLE IF NOT EXISTS Settings ( name TEXT PRIMARY KEY, value TEXT NOT NULL )")
     cursor.execute("SELECT name FROM sqlite_master WHERE name='Settings' and type='table'")
     if cursor.fetchone() is None:
@@ -27,6 +53,18 @@ def load_database(db_name="/app/db/byakugan.db"):
 
     return conn, cursor
 
+def add_column_if_missing(conn, cursor, table, column, definition):
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column in [row[1] for row in cursor.fetchall()]:
+        return
+
+    try:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        conn.commit()
+    except sqlite3.OperationalError:
+        #Another thread got there first
+        pass
+
 def update_setting_value(conn, cursor, name, value):
     cursor.execute("INSERT OR REPLACE INTO Settings (name, value) VALUES (?, ?)", (name, value))
     conn.commit()
@@ -40,8 +78,54 @@ def get_setting_value(conn, cursor, name, defaultValue=None):
     else:
         return row[0]
 
+def get_detection_zones(conn, cursor, camera_id=None):
+    #The zones are kept as JSON in the settings table, one set per camera. A camera that doesn't have
+    #its own yet uses the ones saved from before there was more than one camera
+    value = None
+    if camera_id is not None:
+        value = get_setting_value(conn, cursor, f"DETECTION_ZONES_{camera_id}")
+    if value is None:
+        value = get_setting_value(conn, cursor, "DETECTION_ZONES")
+
+    if value is None:
+        return {"include": [], "exclude": []}
+    else:
+        return json.loads(value)
+
+def update_detection_zones(conn, cursor, zones, camera_id=None):
+    name = "DETECTION_ZONES" if camera_id is None else f"DETECTION_ZONES_{camera_id}"
+    update_setting_value(conn, cursor, name, json.dumps(zones))
+
+def get_cameras(conn, cursor):
+    cursor.execute("SELECT id, name, source, record_source FROM Cameras ORDER BY id")
+    return [{"id": row[0], "name": row[1], "source": row[2], "record_source": row[3]} for row in cursor.fetchall()]
+
+def get_camera(conn, cursor, camera_id):
+    cursor.execute("SELECT id, name, source, record_source FROM Cameras WHERE id = ?", (camera_id, ))
+    row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    return {"id": row[0], "name": row[1], "source": row[2], "record_source": row[3]}
+
+def add_camera(conn, cursor, name, source, record_source=None):
+    #Raises sqlite3.IntegrityError if there's already a camera with that name
+    cursor.execute("INSERT INTO Cameras (name, source, record_source) VALUES (?, ?, ?)", (name, str(source), str(record_source) if record_source else None))
+    conn.commit()
+    return cursor.lastrowid
+
+def update_camera(conn, cursor, camera_id, name, source, record_source=None):
+    cursor.execute("UPDATE Cameras SET name = ?, source = ?, record_source = ? WHERE id = ?", (name, str(source), str(record_source) if record_source else None, camera_id))
+    conn.commit()
 
-def create_recording(conn, cursor, desc=None):
+def delete_camera(conn, cursor, camera_id):
+    #The camera's alerts and recordings stay, they just keep pointing at a camera that isn't there anymore
+    cursor.execute("DELETE FROM Cameras WHERE id = ?", (camera_id, ))
+    cursor.execute("DELETE FROM Settings WHERE name = ?", (f"DETECTION_ZONES_{camera_id}", ))
+    conn.commit()
+
+def create_recording(conn, cursor, desc=None, camera_id=None):
     cursor.execute("SELECT seq + 1 AS next_id FROM sqlite_sequence WHERE name = 'Recordings'")
     row = cursor.fetchone()
 
@@ -52,14 +136,123 @@ def create_recording(conn, cursor, desc=None):
 
     record_filename = f'rec_{new_id}'
     current_timestamp = int(datetime.now().timestamp())
-    cursor.execute("INSERT INTO Recordings (timestamp, path) VALUES (?, ?)", (current_timestamp, record_filename + ".mp4"))
+    cursor.execute("INSERT INTO Recordings (timestamp, path, camera_id) VALUES (?, ?, ?)", (current_timestamp, record_filename + ".mp4", camera_id))
     conn.commit()
 
 
-    cursor.execute("INSERT INTO Alerts (timestamp, recording_id, description) VALUES (?, ?, ?)", (current_timestamp, cursor.lastrowid, desc))
+    cursor.execute("INSERT INTO Alerts (timestamp, recording_id, description, camera_id) VALUES (?, ?, ?, ?)", (current_timestamp, cursor.lastrowid, desc, camera_id))
     conn.commit()
     return record_filename, cursor.lastrowid
 
+def create_segment_alert(conn, cursor, desc, camera_id, segment_id, segment_offset):
+    #Like create_recording, except the alert points into a segment instead of getting a file. The recording's path
+    #is the clip that gets cut from the segments when someone wants to watch it (see clip_path)
+    cursor.execute("SELECT seq + 1 AS next_id FROM sqlite_sequence WHERE name = 'Recordings'")
+    row = cursor.fetchone()
+    new_id = 1 if row is None else row[0]
+
+    current_timestamp = int(datetime.now().timestamp())
+    cursor.execute("INSERT INTO Recordings (timestamp, path, camera_id) VALUES (?, ?, ?)", (current_timestamp, clip_path(new_id), camera_id))
+    cursor.execute("INSERT INTO Alerts (timestamp, recording_id, description, camera_id, segment_id, segment_offset) VALUES (?, ?, ?, ?, ?, ?)",
+                   (current_timestamp, cursor.lastrowid, desc, camera_id, segment_id, segment_offset))
+    conn.commit()
+    return cursor.lastrowid
+
+def clip_path(recording_id):
+    return f"clip_{recording_id}.mp4"
+
+def partial_clip_path(recording_id):
+    #The clip of an alert that's still going, which gets cut again every so often until it's over
+    return f"clip_{recording_id}_partial.mp4"
+
+def remove_partial_clip(recording_id):
+    try:
+        os.remove("/app/recordings/" + partial_clip_path(recording_id))
+    except FileNotFoundError:
+        pass
+
+def finish_segment_alert(conn, cursor, alert_id, clip_seconds):
+    cursor.execute("UPDATE Alerts SET clip_seconds = ? WHERE id = ?", (clip_seconds, alert_id))
+    conn.commit()
+
+    #Now that it's over, the whole clip gets cut the next time someone asks for it
+    cursor.execute("SELECT recording_id FROM Alerts WHERE id = ?", (alert_id, ))
+    row = cursor.fetchone()
+    if row is not None:
+        remove_partial_clip(row[0])
+
+def get_alert_clip(conn, cursor, recording_id):
+    #Returns the camera, when the alert's footage starts and how long it is (None if it's still going) for the alert
+    #with this recording, or None if it isn't from continuous recording or its segment has already been recycled
+    cursor.execute("""
+                   SELECT Segments.camera_id, Segments.start_time + Alerts.segment_offset, Alerts.clip_seconds FROM Alerts
+                   INNER JOIN Segments
+                   ON Segments.id = Alerts.segment_id
+                   WHERE Alerts.recording_id = ?""", (recording_id, ))
+    row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    return {"camera_id": row[0], "start_time": row[1], "clip_seconds": row[2]}
+
+def add_segment(conn, cursor, camera_id, path, start_time):
+    cursor.execute("INSERT INTO Segments (camera_id, path, start_time) VALUES (?, ?, ?)", (camera_id, path, start_time))
+    conn.commit()
+    return cursor.lastrowid
+
+def finish_segment(conn, cursor, segment_id, end_time, size):
+    cursor.execute("UPDATE Segments SET end_time = ?, size = ? WHERE id = ?", (end_time, size, segment_id))
+    conn.commit()
+
+def find_segment(conn, cursor, camera_id, timestamp):
+    #The segment that has timestamp in it, or the first one after it if there's a gap (or it's from before we
+    #started recording). Returns (id, start_time) or None
+    cursor.execute("SELECT id, start_time, end_time FROM Segments WHERE camera_id = ? AND start_time <= ? ORDER BY start_time DESC LIMIT 1", (camera_id, timestamp))
+    row = cursor.fetchone()
+    if row is not None and (row[2] is None or row[2] >= timestamp):
+        return row[0], row[1]
+
+    cursor.execute("SELECT id, start_time FROM Segments WHERE camera_id = ? AND start_time > ? ORDER BY start_time LIMIT 1", (camera_id, timestamp))
+    row = cursor.fetchone()
+    return (row[0], row[1]) if row is not None else None
+
+def get_segments(conn, cursor, camera_id, start_time, end_time):
+    #Every segment with footage between start_time and end_time, oldest first, as (path, start_time, end_time)
+    cursor.execute("""
+                   SELECT path, start_time, end_time FROM Segments
+                   WHERE camera_id = ? AND start_time < ? AND (end_time IS NULL OR end_time > ?)
+                   ORDER BY start_time""", (camera_id, end_time, start_time))
+    return cursor.fetchall()
+
+def expire_segments(conn, cursor, max_bytes=0, max_age=0):
+    #Forgets the oldest finished segments until they add up to no more than max_bytes and none of them ended more
+    #than max_age seconds ago (0 means no limit). Returns their paths and the paths of any clips that were cut from
+    #the alerts starting in them, so the caller can delete the files. Those clips can't be cut again, and left
+    #behind they'd never count towards SEGMENT_MAX_GB
+    expired = []
+    if max_age > 0:
+        cursor.execute("SELECT id, path FROM Segments WHERE end_time IS NOT NULL AND end_time < ?", (datetime.now().timestamp() - max_age, ))
+        expired.extend(cursor.fetchall())
+
+    if max_bytes > 0:
+        cursor.execute("SELECT id, path, size FROM Segments WHERE end_time IS NOT NULL ORDER BY start_time DESC")
+        total = 0
+        for segment_id, path, size in cursor.fetchall():
+            total += size or 0
+            if total > max_bytes and (segment_id, path) not in expired:
+                expired.append((segment_id, path))
+
+    clips = []
+    for segment_id, _ in expired:
+        cursor.execute("SELECT recording_id FROM Alerts WHERE segment_id = ?", (segment_id, ))
+        for (recording_id, ) in cursor.fetchall():
+            clips.extend([clip_path(recording_id), partial_clip_path(recording_id)])
+
+    cursor.executemany("DELETE FROM Segments WHERE id = ?", [(segment_id, ) for segment_id, _ in expired])
+    conn.commit()
+    return [path for _, path in expired], clips
+
 def add_thumbnail_to_alert(conn, cursor, alert_id, frame):
     fname = f't-{alert_id}.jpg'
     cv.imwrite("/app/thumbnails/" + fname, frame)
@@ -67,20 +260,23 @@ def add_thumbnail_to_alert(conn, cursor, alert_id, frame):
     cursor.execute("UPDATE Alerts SET thumbnail = ? WHERE id = ?", (fname, alert_id))
     conn.commit()
 
-def get_alerts_data(conn, cursor, records_per_page, page_no):
+def get_alerts_data(conn, cursor, records_per_page, page_no, camera_id=None):
     offset_number = page_no - 1
-    cursor.execute("SELECT * FROM Alerts ORDER BY timestamp DESC LIMIT ? OFFSET ?", (records_per_page, offset_number * records_per_page))
+    if camera_id is None:
+        cursor.execute("SELECT id, timestamp, recording_id, description, thumbnail, camera_id FROM Alerts ORDER BY timestamp DESC LIMIT ? OFFSET ?", (records_per_page, offset_number * records_per_page))
+    else:
+        cursor.execute("SELECT id, timestamp, recording_id, description, thumbnail, camera_id FROM Alerts WHERE camera_id = ? ORDER BY timestamp DESC LIMIT ? OFFSET ?", (camera_id, records_per_page, offset_number * records_per_page))
     result_dict = []
 
     for row in cursor.fetchall():
         ts_readable = datetime.fromtimestamp(row[1]).strftime("%B %d, %Y %I:%M:%S %p")
-        result_dict.append({"id" : row[0], "timestamp" : ts_readable, "description" : row[3], "thumbnail": row[4]})
+        result_dict.append({"id" : row[0], "timestamp" : ts_readable, "description" : row[3], "thumbnail": row[4], "camera_id": row[5]})
 
     return result_dict
 
 def get_alert_details(conn, cursor, alert_id):
     cursor.execute("""
-                   SELECT Alerts.id, Alerts.timestamp, Alerts.description, Recordings.path, Alerts.thumbnail FROM Recordings 
+                   SELECT Alerts.id, Alerts.timestamp, Alerts.description, Recordings.path, Alerts.thumbnail, Alerts.camera_id FROM Recordings 
                    INNER JOIN Alerts 
                    ON Recordings.id = Alerts.recording_id
                    WHERE Alerts.id = ?""", (alert_id, ))
@@ -91,7 +287,7 @@ def get_alert_details(conn, cursor, alert_id):
     
     ts_readable = datetime.fromtimestamp(row[1]).strftime("%B %d, %Y %I:%M:%S %p")
     
-    return {"id" : row[0], "timestamp" : ts_readable, "description" : row[2], "video" : row[3], "thumbnail" : row[4] }
+    return {"id" : row[0], "timestamp" : ts_readable, "description" : row[2], "video" : row[3], "thumbnail" : row[4], "camera_id" : row[5] }
 
 def delete_alert(conn, cursor, alert_id):
     cursor.execute("""
@@ -110,4 +306,8 @@ def delete_alert(conn, cursor, alert_id):
     conn.commit()
 
     os.remove(thumbnail_path)
-    os.remove(recording_path)
+    #An alert from continuous recording only has a file if its clip was ever cut
+    if os.path.exists(recording_path) or row[1] != clip_path(rid):
+        os.remove(recording_path)
+    if row[1] == clip_path(rid):
+        remove_partial_clip(rid)
@@ -0,0 +1,335 @@
+import numpy as np
+import queue
+import threading
+from collections import deque
+from decouple import config
+
+#The capture loop is split into stages (capture, detect, annotate) that each run in their own thread,
+#so OpenCV can be decoding one frame while it's detecting on the one before. The stages hand frames
+#to each other through these bounded queues
+
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+
+def frame_bytes(item):
+    #How much memory the frames in a queue item take up. Items are frames, or tuples with frames in them
+    if isinstance(item, np.ndarray):
+        return item.nbytes
+    elif isinstance(item, (bytes, bytearray)):
+        return len(item)
+    elif isinstance(item, (tuple, list)):
+        return sum(frame_bytes(part) for part in item)
+    return 0
+
+class FrameBusFull(ValueError):
+    #A reservation that won't fit in what's left of FRAME_BUS_MB. It's a ValueError since it's the settings
+    #(resolutions, pre-roll, how many cameras) that don't add up
+    pass
+
+def bus_prefix(camera_id):
+    #Everything a camera reserves goes under this, so it can all be given back at once
+    return f"camera {camera_id}/"
+
+class FrameBus:
+    #Everything that holds frames in this process, whichever camera it's for, is charged against one memory
+    #budget of FRAME_BUS_MB: the queues between the stages, the recording buffers, the shared memory to and from
+    #a vision process, and the slice a vision process gets for its own bus. Every consumer reserves its bytes
+    #when it's made and gets fewer (or is turned away) if they aren't there, so the budget is the most we'll
+    #ever hold however many cameras there are. /api/status shows where it's all going
+    def __init__(self, budget_bytes):
+        self.budget = int(budget_bytes)
+        self.consumers = {}
+        self.reservations = {}
+        self.lock = threading.Lock()
+        #What's actually in the queues right now, everything else is allocated for as long as it's reserved
+        self.queued = 0
+        self.peak = 0
+
+    def reserve(self, name, nbytes, min_bytes=None, consumer=None):
+        #Returns how much name gets, nbytes if it's there and at least min_bytes (all of it when None), or raises
+        #FrameBusFull. Reserving a name again gives up what it had before
+        min_bytes = nbytes if min_bytes is None else min_bytes
+        with self.lock:
+            self.drop(name)
+            available = self.budget - sum(self.reservations.values())
+            if available < min_bytes:
+                raise FrameBusFull(f"{name} needs {min_bytes / (1 << 20):.1f}MB of the frame bus but there's only "
+                                 f"{max(0, available) / (1 << 20):.1f}MB left, raise FRAME_BUS_MB")
+
+            granted = min(int(nbytes), available)
+            self.reservations[name] = granted
+            if consumer is not None:
+                self.consumers[name] = consumer
+            self.peak = max(self.peak, self.used())
+            return granted
+
+    def release(self, prefix):
+        #Gives back everything reserved under a name starting with prefix, once a camera's engine is closed
+        with self.lock:
+            for name in [name for name in self.reservations if name.startswith(prefix)]:
+                self.drop(name)
+
+    def drop(self, name):
+        self.reservations.pop(name, None)
+        consumer = self.consumers.pop(name, None)
+        if isinstance(consumer, StageQueue):
+            #Whatever is still in it isn't ours anymore
+            self.queued -= consumer.bytes
+            consumer.bus = None
+
+    def queue(self, name, item_bytes, maxsize=2, policy=BLOCK):
+        #The queue can hold maxsize items of item_bytes, or as many as are left in the budget (one at least)
+        stage_queue = StageQueue(name, maxsize=maxsize, policy=policy, bus=self)
+        stage_queue.max_bytes = self.reserve(name, maxsize * item_bytes, item_bytes, stage_queue)
+        return stage_queue
+
+    def ring(self, name, slots, shape):
+        #The ring is allocated up front. If there isn't room for all of its slots it gets as many as there is room
+        #for, and if there isn't even room for two it's turned away
+        frame = int(np.prod(shape))
+        granted = self.reserve(name, slots * frame, 2 * frame)
+        if granted < slots * frame:
+            print(f"[frame bus] Only room for {granted // frame} of the {slots} {name} frames, raise FRAME_BUS_MB to keep them all", flush=True)
+
+        ring = FrameRing(granted // frame, shape)
+        with self.lock:
+            self.consumers[name] = ring
+        return ring
+
+    def used(self):
+        #Bytes held right now
+        return self.queued + sum(size for name, size in self.reservations.items() if not isinstance(self.consumers.get(name), StageQueue))
+
+    def account(self, change):
+        with self.lock:
+            self.queued += change
+            self.peak = max(self.peak, self.used())
+
+    @property
+    def stats(self):
+        with self.lock:
+            consumers = {}
+            for name, size in self.reservations.items():
+                consumer = self.consumers.get(name)
+                consumers[name] = dict(consumer.stats if consumer is not None else {"bytes": size}, reserved_bytes=size)
+
+            return {
+                "budget_bytes": self.budget,
+                "reserved_bytes": sum(self.reservations.values()),
+                "bytes": self.used(),
+                "peak_bytes": self.peak,
+                "consumers": consumers
+            }
+
+#The frame bus for this process, shared by every camera in it (see frame_bus)
+process_bus = None
+process_bus_lock = threading.Lock()
+
+def frame_bus():
+    #Made the first time a camera wants it. A vision process makes its own out of the slice the web server gave it
+    global process_bus
+    with process_bus_lock:
+        if process_bus is None:
+            process_bus = FrameBus(config("FRAME_BUS_MB", default=640, cast=float) * (1 << 20))
+        return process_bus
+
+class StageQueue:
+    #A bounded queue between two stages. When it's full, a "block" queue makes the stage feeding it
+    #wait, so nothing is ever skipped, and a "drop_oldest" queue throws away the oldest item so the
+    #next stage always gets the newest one. It's full when it has maxsize items, or when another item
+    #would take it over max_bytes
+    def __init__(self, name, maxsize=2, policy=BLOCK, max_bytes=None, bus=None):
+        if policy not in (BLOCK, DROP_OLDEST):
+            raise ValueError(f"Unknown drop policy {policy}, please use {BLOCK} or {DROP_OLDEST}")
+
+        self.name = name
+        self.policy = policy
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.bus = bus
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.bytes = 0
+        self.put_count = 0
+        self.dropped = 0
+        self.peak = 0
+        self.peak_bytes = 0
+        self.warned = False
+
+    def fits(self, size):
+        return len(self.items) < self.maxsize and (self.max_bytes is None or self.bytes + size <= self.max_bytes)
+
+    def pop(self):
+        size, item = self.items.popleft()
+        self.bytes -= size
+        if self.bus is not None:
+            self.bus.account(-size)
+        self.condition.notify_all()
+        return item
+
+    def put(self, item, running):
+        #running is the threading.Event that says the pipeline is still going, so we don't block forever on shutdown
+        size = frame_bytes(item)
+
+        with self.condition:
+            if self.max_bytes is not None and size > self.max_bytes:
+                #This would never fit, so it's dropped rather than letting it blow the budget
+                self.dropped += 1
+                if not self.warned:
+                    self.warned = True
+                    print(f"[frame bus] {self.name} frames are bigger than its {self.max_bytes} bytes, raise FRAME_BUS_MB", flush=True)
+                return False
+
+            if self.policy == DROP_OLDEST:
+                while not self.fits(size):
+                    self.pop()
+                    self.dropped += 1
+            else:
+                while not self.fits(size):
+                    if not running.is_set():
+                        return False
+                    self.condition.wait(timeout=0.1)
+
+            self.items.append((size, item))
+            self.bytes += size
+            if self.bus is not None:
+                self.bus.account(size)
+
+            self.put_count += 1
+            self.peak = max(self.peak, len(self.items))
+            self.peak_bytes = max(self.peak_bytes, self.bytes)
+            self.condition.notify_all()
+            return True
+
+    def get(self, timeout=0.1):
+        #Raises queue.Empty if nothing turned up in time
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.items) > 0, timeout=timeout):
+                raise queue.Empty
+            return self.pop()
+
+    def qsize(self):
+        return len(self.items)
+
+    def clear(self):
+        with self.condition:
+            while self.items:
+                self.pop()
+
+    @property
+    def stats(self):
+        return {
+            "size": len(self.items),
+            "maxsize": self.maxsize,
+            "policy": self.policy,
+            "put": self.put_count,
+            "dropped": self.dropped,
+            "peak": self.peak,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "peak_bytes": self.peak_bytes
+        }
+
+class FrameRing:
+    #A fixed number of preallocated frame slots that the capture stage copies each frame into, so keeping
+    #the last few seconds around for recordings doesn't allocate anything per frame. Every frame gets the next
+    #sequence number, and readers ask for frames by sequence number and copy them into their own buffer.
+    #A slot's sequence number is zeroed while it's being written, so a reader can tell if a frame got
+    #overwritten while it was copying it
+    def __init__(self, slots, shape):
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.frames = np.zeros((slots,) + self.shape, np.uint8)
+        self.timestamps = np.zeros(slots, np.float64)
+        self.seqs = np.zeros(slots, np.int64)
+        self.latest = 0
+        #How many times a reader found the frame it wanted had already been overwritten
+        self.missed = 0
+        self.condition = threading.Condition()
+
+    def write(self, frame, timestamp, check=None):
+        #If frame is a view of a buffer someone else can overwrite (shared memory), check is called once it's been
+        #copied, and if it says the frame changed underneath us the slot is left empty for the next one. Returns
+        #the sequence number, or None if the frame was thrown away
+        seq = self.latest + 1
+        slot = seq % self.slots
+
+        self.seqs[slot] = 0
+        np.copyto(self.frames[slot], frame)
+        if check is not None and not check():
+            return None
+        self.timestamps[slot] = timestamp
+        self.seqs[slot] = seq
+
+        with self.condition:
+            self.latest = seq
+            self.condition.notify_all()
+        return seq
+
+    def oldest(self):
+        #The oldest sequence number that could still be in the ring
+        return max(1, self.latest - self.slots + 1)
+
+    def find(self, timestamp):
+        #The sequence number of the oldest frame we still have from timestamp onwards, or the next frame
+        #to arrive if everything we have is older
+        for seq in range(self.oldest(), self.latest + 1):
+            slot = seq % self.slots
+            if self.seqs[slot] == seq and self.timestamps[slot] >= timestamp:
+                return seq
+        return self.latest + 1
+
+    def wait(self, seq, timeout=1.0):
+        #Waits until frame seq has been written, returns False if it didn't turn up in time
+        with self.condition:
+            return self.condition.wait_for(lambda: self.latest >= seq, timeout=timeout)
+
+    def read(self, seq, out):
+        #Copies frame seq into out and returns its timestamp, or None if it has already been overwritten
+        slot = seq % self.slots
+        if self.seqs[slot] != seq:
+            self.missed += 1
+            return None
+
+        np.copyto(out, self.frames[slot])
+        timestamp = float(self.timestamps[slot])
+
+        if self.seqs[slot] != seq:
+            self.missed += 1
+            return None
+        return timestamp
+
+    def frame_rate(self, window=1.0):
+        #How many frames a second have been coming in lately, going by when they were captured rather than what
+        #the camera claims. None if we don't have enough to tell
+        latest = self.latest
+        newest = float(self.timestamps[latest % self.slots])
+        first = latest
+        for seq in range(latest - 1, self.oldest() - 1, -1):
+            slot = seq % self.slots
+            if self.seqs[slot] != seq or newest - self.timestamps[slot] > window:
+                break
+            first = seq
+
+        span = newest - float(self.timestamps[first % self.slots])
+        return (latest - first) / span if latest - first > 0 and span > 0 else None
+
+    def clear(self):
+        with self.condition:
+            self.seqs[:] = 0
+
+    @property
+    def stats(self):
+        seconds = 0.0
+        oldest = self.oldest() % self.slots
+        if self.latest and self.seqs[oldest]:
+            seconds = float(self.timestamps[self.latest % self.slots] - self.timestamps[oldest])
+
+        return {
+            "slots": self.slots,
+            "frames": min(self.latest, self.slots),
+            "seconds": seconds,
+            "bytes": self.frames.nbytes,
+            "peak_bytes": self.frames.nbytes,
+            "dropped": self.missed
+        }
@@ -0,0 +1,94 @@
+import itertools
+import queue
+import shutil
+import threading
+from decouple import config
+
+#Getting the frames into the encoder is all a recording has to do itself. Finishing it off (waiting for the
+#encoder to write out the end of the file, the thumbnail, the database and telling the bot) is handed to a small
+#pool of workers here, so the camera can get straight on with the next one. Jobs come out in priority order, so
+#recordings someone asked for get finished before the ones we made on our own
+
+USER = 0
+ALERT = 1
+
+def nice_command(args, nice=None):
+    #Runs a command (ffmpeg, really) below the capture pipeline's priority, so it soaks up spare CPU instead of
+    #taking it from capture. Every thread it starts is niced too
+    nice = config("ENCODE_NICE", default=10, cast=int) if nice is None else nice
+    if nice > 0 and shutil.which("nice"):
+        return ["nice", "-n", str(nice)] + list(args)
+    return list(args)
+
+class PostProcessor:
+    def __init__(self, workers=None, max_jobs=None):
+        self.workers = workers or config("POSTPROCESS_WORKERS", default=1, cast=int)
+        self.jobs = queue.PriorityQueue(maxsize=max_jobs or config("POSTPROCESS_QUEUE_SIZE", default=32, cast=int))
+        #Keeps jobs of the same priority in the order they came in, and means the queue never compares the jobs themselves
+        self.order = itertools.count()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.ran_inline = 0
+
+    def start(self):
+        #The workers start the first time there's a job, so they don't slow down start up
+        with self.lock:
+            if self.threads:
+                return
+            self.threads = [threading.Thread(target=self.work, name=f"postprocess-{i}", daemon=True) for i in range(self.workers)]
+            for thread in self.threads:
+                thread.start()
+
+    def submit(self, priority, name, func, *args):
+        self.start()
+        job = (priority, next(self.order), name, func, args)
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            #We never drop a recording. If we're this far behind, whoever handed us the job does it themselves
+            print(f"[postprocess] Job queue is full, doing {name} straight away", flush=True)
+            with self.lock:
+                self.ran_inline += 1
+            self.run(job)
+
+    def run(self, job):
+        _, _, name, func, args = job
+        try:
+            func(*args)
+            with self.lock:
+                self.done += 1
+        except Exception as e:
+            print(f"[postprocess] {name} failed: {e}", flush=True)
+            with self.lock:
+                self.failed += 1
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            with self.lock:
+                self.running += 1
+            self.run(job)
+            with self.lock:
+                self.running -= 1
+            self.jobs.task_done()
+
+    def wait(self, timeout=None):
+        #Returns True once every job handed to us so far is finished. Mostly for the tests
+        waiter = threading.Thread(target=self.jobs.join, daemon=True)
+        waiter.start()
+        waiter.join(timeout)
+        return not waiter.is_alive()
+
+    @property
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queued": self.jobs.qsize(),
+            "running": self.running,
+            "done": self.done,
+            "failed": self.failed,
+            "ran_inline": self.ran_inline
+        }
@@ -0,0 +1,134 @@
+import os
+import subprocess
+from decouple import config
+from postprocess import nice_command
+
+#Recordings used to be written out as an XVID .avi by cv.VideoWriter and then decoded and encoded all over
+#again by ffmpeg to get an mp4 the browser could play. This pipes the raw frames straight into one ffmpeg
+#process that lives as long as the recording and encodes them to H.264 once. The mp4 is fragmented, so
+#it can be played while it's still being recorded, and whatever was written survives if we die halfway.
+#Once it's finished, faststart turns it into an ordinary mp4 with its index up front
+
+class FFmpegRecordingWriter:
+    #This looks like a cv.VideoWriter (isOpened, write, release), so record_frames doesn't care which it has
+    def __init__(self, path, size, fps=30, bitrate=None, preset=None, threads=None, keyframe_seconds=1):
+        #Only imported when there's something to record, to keep start up quick
+        import ffmpeg
+
+        self.path = path
+        self.size = size
+        self.fps = fps
+        self.frame_bytes = size[0] * size[1] * 3
+        self.frames = 0
+        #When frames come with their capture times, the first one's, and how many we've had to repeat or leave out
+        #to keep the video in step with them
+        self.first_timestamp = None
+        self.repeated = 0
+        self.skipped = 0
+
+        bitrate = bitrate or config("RECORD_BITRATE", default="500K")
+        preset = preset or config("RECORD_PRESET", default="ultrafast")
+        threads = threads or config("RECORD_THREADS", default=2, cast=int)
+
+        #Every fragment starts on a keyframe, so the keyframe interval is how far behind a recording that's being
+        #watched while it's recorded can be. flush_packets gets each fragment onto the disk as soon as it's done
+        stream = (
+            ffmpeg
+            .input("pipe:", format="rawvideo", pix_fmt="bgr24", s=f"{size[0]}x{size[1]}", framerate=fps)
+            .output(path, format="mp4", vcodec="libx264", pix_fmt="yuv420p", preset=preset, video_bitrate=bitrate,
+                    threads=threads, g=max(1, int(round(fps * keyframe_seconds))),
+                    movflags="frag_keyframe+empty_moov+default_base_moof", flush_packets=1)
+            .global_args("-hide_banner", "-loglevel", "error")
+            .overwrite_output()
+        )
+
+        try:
+            #The encoder gets whatever CPU capture leaves, RECORD_THREADS of it at most
+            self.process = subprocess.Popen(nice_command(stream.compile()), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        except OSError as e:
+            print(f"[recorder] Could not start ffmpeg: {e}", flush=True)
+            self.process = None
+
+    def isOpened(self):
+        return self.process is not None and self.process.poll() is None
+
+    def write(self, frame, timestamp=None):
+        #frame has to be a BGR frame at size. It's written straight out of its own memory, without a copy.
+        #The video runs at a constant fps, so if it comes with the time it was captured, it's repeated or left out
+        #as needed to put it at the right point in the video, whatever rate the camera actually managed
+        if not self.isOpened() or frame.nbytes != self.frame_bytes:
+            return False
+
+        copies = 1
+        if timestamp is not None:
+            if self.first_timestamp is None:
+                self.first_timestamp = timestamp
+            #How many frames the video should have once this one is in
+            copies = int(round((timestamp - self.first_timestamp) * self.fps)) + 1 - self.frames
+            if copies <= 0:
+                self.skipped += 1
+                return True
+            self.repeated += copies - 1
+
+        try:
+            data = memoryview(frame.reshape(-1))
+            for _ in range(copies):
+                self.process.stdin.write(data)
+        except (BrokenPipeError, ValueError, OSError) as e:
+            print(f"[recorder] ffmpeg stopped taking frames: {e}", flush=True)
+            return False
+
+        self.frames += copies
+        return True
+
+    def release(self, timeout=30):
+        #Closing stdin tells ffmpeg that's the end, then it finishes off the last fragment
+        if self.process is None:
+            return False
+
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            print("[recorder] ffmpeg didn't finish in time, killing it", flush=True)
+            self.process.kill()
+            self.process.wait()
+
+        success = self.process.returncode == 0
+        self.process = None
+        return success
+
+def faststart(path, timeout=120):
+    #A fragmented mp4 has no index of where its frames are, so a browser has to hunt through the fragments to
+    #seek. Copying it (no encoding) into an ordinary mp4 with the moov atom first gives it the whole index in the
+    #first request, and seeking is just a range request. It's written next to the recording and moved into place,
+    #so anyone watching gets one or the other. Returns whether it worked, the recording is left as it was if not
+    import ffmpeg
+
+    working_path = path[:-len(".mp4")] + ".faststart.mp4"
+    command = (
+        ffmpeg
+        .input(path)
+        .output(working_path, c="copy", movflags="+faststart")
+        .global_args("-hide_banner", "-loglevel", "error")
+        .overwrite_output()
+        .compile()
+    )
+
+    try:
+        result = subprocess.run(nice_command(command), stdin=subprocess.DEVNULL, capture_output=True, timeout=timeout)
+        if result.returncode != 0:
+            print(f"[recorder] Couldn't move the index of {path} to the front: {result.stderr.decode(errors='replace').strip()}", flush=True)
+            return False
+        os.replace(working_path, path)
+        return True
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"[recorder] Couldn't move the index of {path} to the front: {e}", flush=True)
+        return False
+    finally:
+        if os.path.exists(working_path):
+            os.remove(working_path)
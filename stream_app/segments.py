@@ -0,0 +1,221 @@
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import numpy as np
+import dbutils
+from decouple import config
+from postprocess import nice_command, ALERT
+from recorder import FFmpegRecordingWriter
+
+#With CONTINUOUS_RECORDING=True every camera records all of the time, into SEGMENT_SECONDS long mp4s that are kept
+#in the Segments table. The oldest ones are recycled to keep them under SEGMENT_MAX_GB and SEGMENT_MAX_HOURS.
+#There's no encoder to start when something happens, alerts just point at where they are in the segments, and
+#their clip is cut out of them (without encoding anything) the first time someone wants to watch it
+
+RECORDINGS_PATH = "/app/recordings"
+
+class SegmentRecorder:
+    def __init__(self, camera, post_processor, segment_seconds=None, max_bytes=None, max_age=None, folder=RECORDINGS_PATH, db_path=None):
+        self.camera = camera
+        self.post_processor = post_processor
+        self.segment_seconds = config("SEGMENT_SECONDS", default=60, cast=float) if segment_seconds is None else segment_seconds
+        self.max_bytes = config("SEGMENT_MAX_GB", default=20, cast=float) * (1 << 30) if max_bytes is None else max_bytes
+        self.max_age = config("SEGMENT_MAX_HOURS", default=72, cast=float) * 3600 if max_age is None else max_age
+        self.folder = folder
+        #None for the usual database
+        self.db_path = db_path
+
+        self.running = threading.Event()
+        self.thread = None
+        self.current = None
+        self.segments = 0
+        self.expired = 0
+
+    def start(self):
+        if self.running.is_set():
+            return
+        self.running.set()
+        self.thread = threading.Thread(target=self.record, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+            self.thread = None
+
+    def record(self):
+        sqlite_conn, sqlite_cursor = self.database()
+        self.close_orphans(sqlite_conn, sqlite_cursor)
+
+        vision = self.camera.vision
+        recording_ring = vision.recording_ring
+        frame = np.empty(recording_ring.shape, np.uint8)
+        fps = config("CAMERA_FPS", default=30, cast=float)
+        os.makedirs(os.path.join(self.folder, "segments", str(self.camera.id)), exist_ok=True)
+
+        #Every frame goes in by when it was captured, so a segment's start_time plus a position in its video is
+        #the time that frame was captured
+        video_writer, segment_id, segment_start, last_timestamp = None, None, None, None
+        seq = recording_ring.latest + 1
+
+        while self.running.is_set():
+            if not recording_ring.wait(seq, timeout=1):
+                continue
+
+            seq = max(seq, recording_ring.oldest())
+            timestamp = recording_ring.read(seq, frame)
+            seq += 1
+            if timestamp is None:
+                continue
+
+            if video_writer is not None and timestamp - segment_start >= self.segment_seconds:
+                self.finish(video_writer, segment_id, timestamp)
+                video_writer = None
+
+            if video_writer is None:
+                path = f"segments/{self.camera.id}/{int(timestamp * 1000)}.mp4"
+                video_writer = FFmpegRecordingWriter(os.path.join(self.folder, path), vision.record_size, fps)
+                segment_id = dbutils.add_segment(sqlite_conn, sqlite_cursor, self.camera.id, path, timestamp)
+                segment_start = timestamp
+                self.current = path
+                self.segments += 1
+
+            video_writer.write(frame, timestamp)
+            last_timestamp = timestamp
+
+        if video_writer is not None:
+            self.finish(video_writer, segment_id, last_timestamp + 1.0 / fps)
+        self.current = None
+
+    def finish(self, video_writer, segment_id, end_time):
+        #The next segment is already being written by the time this one's encoder has finished up
+        self.post_processor.submit(ALERT, f"segment {segment_id}", self.close_segment, video_writer, segment_id, end_time)
+
+    def close_segment(self, video_writer, segment_id, end_time):
+        video_writer.release()
+        sqlite_conn, sqlite_cursor = self.database()
+        size = os.path.getsize(video_writer.path) if os.path.exists(video_writer.path) else 0
+        dbutils.finish_segment(sqlite_conn, sqlite_cursor, segment_id, end_time, size)
+
+        #Make room for the next one
+        expired, clips = dbutils.expire_segments(sqlite_conn, sqlite_cursor, self.max_bytes, self.max_age)
+        self.expired += len(expired)
+        for path in expired + clips:
+            try:
+                os.remove(os.path.join(self.folder, path))
+            except FileNotFoundError:
+                pass
+
+    def close_orphans(self, sqlite_conn, sqlite_cursor):
+        #Segments that were still being written when we last stopped without warning never got finished. What
+        #made it to the disk is still good, since they're fragmented
+        sqlite_cursor.execute("SELECT id, path FROM Segments WHERE camera_id = ? AND end_time IS NULL", (self.camera.id, ))
+        for segment_id, path in sqlite_cursor.fetchall():
+            full_path = os.path.join(self.folder, path)
+            exists = os.path.exists(full_path)
+            dbutils.finish_segment(sqlite_conn, sqlite_cursor, segment_id, os.path.getmtime(full_path) if exists else 0, os.path.getsize(full_path) if exists else 0)
+
+    def database(self):
+        #Every thread that touches the database needs its own connection
+        return dbutils.load_database(self.db_path) if self.db_path else dbutils.load_database()
+
+    @property
+    def stats(self):
+        return {
+            "recording": self.running.is_set(),
+            "current": self.current,
+            "segments": self.segments,
+            "expired": self.expired,
+            "segment_seconds": self.segment_seconds
+        }
+
+#One lock per clip, so the requests for a clip (a video element sends a few at once) cut it once between them
+clip_locks = {}
+clip_locks_lock = threading.Lock()
+
+def clip_lock(recording_id):
+    with clip_locks_lock:
+        return clip_locks.setdefault(recording_id, threading.RLock())
+
+def cut_clip(sqlite_conn, sqlite_cursor, recording_id, folder=RECORDINGS_PATH, partial_seconds=None, timeout=60):
+    #Cuts an alert's footage out of the segments it's in, copying rather than encoding it, and returns where
+    #it is. A finished alert's clip is kept until its footage is recycled. One that's still going is only cut again
+    #once the last cut is PARTIAL_CLIP_SECONDS old. None if it isn't an alert from continuous recording, its footage
+    #has already been recycled or ffmpeg couldn't cut it
+    partial_seconds = config("PARTIAL_CLIP_SECONDS", default=5.0, cast=float) if partial_seconds is None else partial_seconds
+
+    with clip_lock(recording_id):
+        #A finished clip is only ever cut once, so there's no need to look anything up
+        finished_path = os.path.join(folder, dbutils.clip_path(recording_id))
+        if os.path.exists(finished_path):
+            return finished_path
+
+        clip = dbutils.get_alert_clip(sqlite_conn, sqlite_cursor, recording_id)
+        if clip is None:
+            return None
+
+        finished = clip["clip_seconds"] is not None
+        path = os.path.join(folder, dbutils.clip_path(recording_id) if finished else dbutils.partial_clip_path(recording_id))
+        if not finished and os.path.exists(path) and time.time() - os.path.getmtime(path) < partial_seconds:
+            return path
+
+        start_time = clip["start_time"]
+        end_time = start_time + clip["clip_seconds"] if finished else time.time()
+        segments = dbutils.get_segments(sqlite_conn, sqlite_cursor, clip["camera_id"], start_time, end_time)
+        if not segments:
+            return None
+
+        #The concat demuxer can start and stop partway through its files, so all the cutting happens in here
+        lines = []
+        for segment_path, segment_start, segment_end in segments:
+            lines.append(f"file '{os.path.join(folder, segment_path)}'")
+            if start_time > segment_start:
+                lines.append(f"inpoint {start_time - segment_start:.3f}")
+            if segment_end is None or end_time < segment_end:
+                lines.append(f"outpoint {end_time - segment_start:.3f}")
+
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as playlist:
+            playlist.write("\n".join(lines) + "\n")
+
+        #Written next to where it's going under a name of its own and moved into place, so nobody gets sent half a clip
+        descriptor, working_path = tempfile.mkstemp(suffix=".mp4", prefix=f"clip_{recording_id}_", dir=folder)
+        os.close(descriptor)
+
+        import ffmpeg
+        command = (
+            ffmpeg
+            .input(playlist.name, format="concat", safe=0)
+            .output(working_path, c="copy", movflags="+faststart")
+            .global_args("-hide_banner", "-loglevel", "error")
+            .overwrite_output()
+            .compile()
+        )
+
+        try:
+            result = subprocess.run(nice_command(command), stdin=subprocess.DEVNULL, capture_output=True, timeout=timeout)
+            if result.returncode != 0:
+                print(f"[segments] Couldn't cut clip {recording_id}: {result.stderr.decode(errors='replace').strip()}", flush=True)
+                return None
+            os.replace(working_path, path)
+        except subprocess.TimeoutExpired:
+            print(f"[segments] Cutting clip {recording_id} took more than {timeout}s, giving up", flush=True)
+            return None
+        finally:
+            os.remove(playlist.name)
+            if os.path.exists(working_path):
+                os.remove(working_path)
+
+        #The footage may have been recycled while we were cutting, or the alert may have finished, and either way
+        #nobody's going to clean this up after us. A finished alert has its whole clip there to be cut instead
+        clip = dbutils.get_alert_clip(sqlite_conn, sqlite_cursor, recording_id)
+        if clip is None:
+            os.remove(path)
+            return None
+        if not finished and clip["clip_seconds"] is not None:
+            os.remove(path)
+            return cut_clip(sqlite_conn, sqlite_cursor, recording_id, folder, partial_seconds, timeout)
+
+        return path
@@ -0,0 +1,97 @@
+import numpy as np
+import time
+from multiprocessing import shared_memory
+
+#A ring of fixed size slots in shared memory, written by one process and read by any number of others.
+#Every write gets the next sequence number. A slot's sequence number is zeroed while it's being written
+#and set once it's done, so a reader that sees the same number before and after it reads knows the slot
+#wasn't overwritten halfway through (a seqlock)
+
+SLOT_HEADER = np.dtype([("seq", "<u8"), ("length", "<u8"), ("timestamp", "<f8")])
+
+class SharedSlotRing:
+    def __init__(self, shm, slots, slot_size, owner):
+        self.shm = shm
+        self.slots = slots
+        self.slot_size = slot_size
+        #Only the process that created the memory gets rid of it
+        self.owner = owner
+
+        self.latest = np.ndarray((1,), dtype="<u8", buffer=shm.buf, offset=0)
+        self.headers = np.ndarray((slots,), dtype=SLOT_HEADER, buffer=shm.buf, offset=8)
+        self.data = np.ndarray((slots, slot_size), dtype=np.uint8, buffer=shm.buf, offset=8 + slots * SLOT_HEADER.itemsize)
+
+    @staticmethod
+    def size_for(slots, slot_size):
+        return 8 + slots * (SLOT_HEADER.itemsize + slot_size)
+
+    @classmethod
+    def create(cls, slots, slot_size):
+        shm = shared_memory.SharedMemory(create=True, size=SharedSlotRing.size_for(slots, slot_size))
+        ring = cls(shm, slots, slot_size, owner=True)
+        ring.latest[0] = 0
+        ring.headers["seq"] = 0
+        return ring
+
+    @classmethod
+    def attach(cls, name, slots, slot_size):
+        #The worker is started by multiprocessing, so it shares the owner's resource tracker and attaching
+        #doesn't leave anything behind for the tracker to clean up when it exits
+        shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, slots, slot_size, owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, data, timestamp=None, check=None):
+        #data can be bytes or a numpy array, it's copied straight into the slot. If data can be overwritten while
+        #we copy it, check is called afterwards and the slot is left empty if it says it was. Returns the
+        #sequence number, or None if it doesn't fit or was thrown away
+        data = np.frombuffer(data, dtype=np.uint8) if not isinstance(data, np.ndarray) else data.reshape(-1).view(np.uint8)
+        if len(data) > self.slot_size:
+            return None
+
+        seq = int(self.latest[0]) + 1
+        slot = seq % self.slots
+
+        self.headers["seq"][slot] = 0
+        self.data[slot, :len(data)] = data
+        if check is not None and not check():
+            return None
+        self.headers["length"][slot] = len(data)
+        self.headers["timestamp"][slot] = time.time() if timestamp is None else timestamp
+        self.headers["seq"][slot] = seq
+        self.latest[0] = seq
+        return seq
+
+    def latest_seq(self):
+        return int(self.latest[0])
+
+    def view(self, seq):
+        #Returns (view, timestamp) of the slot holding seq without copying anything, or (None, None) if it has
+        #already been overwritten. Call still_valid(seq) once you're done with the view to make sure it
+        #wasn't overwritten while you were using it
+        slot = seq % self.slots
+        if seq == 0 or int(self.headers["seq"][slot]) != seq:
+            return None, None
+        return self.data[slot, :int(self.headers["length"][slot])], float(self.headers["timestamp"][slot])
+
+    def still_valid(self, seq):
+        return int(self.headers["seq"][seq % self.slots]) == seq
+
+    def read(self, seq):
+        #Like view, but copies the data out as bytes, so it's safe to keep
+        view, timestamp = self.view(seq)
+        if view is None:
+            return None, None
+        data = view.tobytes()
+        if not self.still_valid(seq):
+            return None, None
+        return data, timestamp
+
+    def close(self):
+        self.latest = self.headers = self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
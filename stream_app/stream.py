@@ -1,232 +1,309 @@
+import time
+#Taken before anything else gets imported, so the start up times cover all of it
+started_at = time.time()
+
 from flask import Flask, Response, jsonify, request, send_from_directory
 from flask_cors import CORS
 import cv2 as cv
 import queue
 import threading
 from utils import * 
-import time
+from cameras import CameraRegistry
+from pipeline import FrameBusFull
+from recorder import FFmpegRecordingWriter, faststart
+from segments import SegmentRecorder, cut_clip
+import postprocess
+import re
 import dbutils
 import sys
-import ffmpeg
 import os
-from bot import TelegramBotThread
 import platform
+import sqlite3
 
 # Create our Flask app
 app = Flask(__name__, static_folder="../frontend", static_url_path="")
 CORS(app) 
+#Behind a web server that understands X-Sendfile (nginx, apache), let it send recordings and thumbnails straight from
+#the disk. Otherwise they're sent from here, through the WSGI server's sendfile if it has one
+app.config["USE_X_SENDFILE"] = config("USE_X_SENDFILE", default=False, cast=bool)
 
-# Create a thread-safe queue for capture
-frame_queue = queue.Queue(maxsize=35)
-
-# Create a thread-safe queue for recording
-recording_queue = queue.Queue(maxsize=90)
-
-#The message queue takes the messages from object detection and uses them to activate the camera
-message_queue = queue.Queue(maxsize=1)
-
-record_count = 0
-
-#These are threading.events and not booleans to prevent race conditions
+#This is a threading.event and not a boolean to prevent race conditions
 filming_event = threading.Event()
-recording_event = threading.Event()
-
 
-last_msg_time = 0
 suppress_msg_time = 100.0   
 
-# Global variable for the latest processed frame
-captured_frame = None
+#An alert's recording keeps going as long as something's being tracked, and stops POST_ROLL_SECONDS after the last
+#of it, but never runs longer than MAX_RECORDING_SECONDS. One someone started runs until they stop it, or the same cap
+post_roll = config("POST_ROLL_SECONDS", default=5.0, cast=float)
+max_recording_seconds = config("MAX_RECORDING_SECONDS", default=120.0, cast=float)
+
+#Set CONTINUOUS_RECORDING=True to record every camera all of the time into a ring of segments on disk, and have
+#alerts point into them instead of getting a recording each (see segments.py)
+continuous_recording = config("CONTINUOUS_RECORDING", default=False, cast=bool)
+#The footage is on disk already, so an alert can go back a lot further than the pre-roll we keep in memory
+continuous_pre_roll = config("CONTINUOUS_PRE_ROLL_SECONDS", default=30.0, cast=float)
+
+#A recording never changes once it's finished, so browsers can keep it (and its thumbnail) this long without asking
+#again. The ones still being written are in unfinished_recordings, and have to be checked every time
+recording_cache_seconds = config("RECORDING_CACHE_SECONDS", default=31536000, cast=int)
+unfinished_recordings = set()
 
-tracked_objects = []
-frame_count = 0      
 server_linked = False
 
 DOCKER_HOST_IP = config("DOCKER_HOST_IP")
 
-#Threads
-capture_thread = None
-pass_thread = None
-messaging_thread = None
+#We stream and record at the display resolution, but run the object detection at the (usually smaller) detection resolution
+display_size = get_display_resolution()
+detection_size = get_detection_resolution()
+
+#Every camera has its own capture, detection and recording. Their vision engines are made the first time
+#capture starts rather than here, because when one runs in its own process that process imports this module all over again
+cameras = CameraRegistry(display_size, detection_size, get_record_resolution())
 
 #0 for my moving median background subtractor, 1 to use openCV's builtin MOG2
 processing_method = 0
+#And the parameters it runs with, see validate_detector_params
+detector_params = {}
 
-def capture_and_process_frames():
-    global frame_queue, captured_frame, tracked_objects, frame_count, recording_queue, processing_method, filming_event
-    source = get_camera_feed_source()
-    print("The video source is " + str(source))
-    for _ in range(10):
-        camera = cv.VideoCapture(source)
-        if camera.isOpened():
-            break
-        print("Retrying camera open...")
-
-    if not camera.isOpened():
-        print("Failed to reopen camera after 10 retries.", flush=True)
-        return
-
-    camera.set(cv.CAP_PROP_AUTOFOCUS, 0) # turn the autofocus off
-    
-    object_detector = MovingMedianObjectDetector() if processing_method == 0 else OpenCVMOG2ObjectDetector()
-
-    while filming_event.is_set():
-        success, frame = camera.read()
-        if not success or frame is None:
-            print(f"read() success={success}, frame is None={frame is None}", flush=True)
-
-            if not camera.isOpened():
-                print("[camera] Device unexpectedly closed, attempting to reopen...", flush=True)
-                camera.release()
-                camera = cv.VideoCapture(source)
-            continue
-
-        #We always resize the frame to cut down on what it takes to process it
-        frame =  cv.resize(frame, (800, 600), interpolation=cv.INTER_AREA)
-
-        if recording_queue.full():
-            recording_queue.get()
-        
-        recording_queue.put(frame.copy())
+#The telegram bot, which is started in the background once the server is up
+bot_thread = None
 
-        fgmask = object_detector.iterate(frame)
+#Finishes off recordings in the background, so a camera never has to wait on one (see postprocess.py)
+post_processor = postprocess.PostProcessor()
 
-        contours, hierarchy = cv.findContours(image=fgmask, mode=cv.RETR_EXTERNAL, method=cv.CHAIN_APPROX_SIMPLE)
-        new_detections = []
-        for contour in contours:
-            area = cv.contourArea(contour)
-            if area > 3500 and area < 30000:
-                new_detections.append(TrackedObject(cv.boundingRect(contour), contour, frame_count))
+#When the server was about to start listening and when everything was first ready, see /api/ready
+startup = {"http_at": None, "ready_at": None}
 
-        #Check the contours detected and compare them to the old ones to look for motion
+#Only one thread gets to load the cameras. Capture starts in the background while the API is already answering,
+#and on a new database both used to find no cameras and both add the Default one
+camera_load_lock = threading.Lock()
 
-        match_objects(new_detections, frame_count, tracked_objects, add_to_mq)
-
-        tracked_objects = [obj for obj in tracked_objects if obj.enabled]
-
-        #Just uncomment this if I want to see how tracking is working
-        for t_obj in tracked_objects:
-            cv.circle(frame, t_obj.centroid, 10, (255, 0, 0), -1)
-            cv.putText(frame, " " + t_obj.id, t_obj.centroid, cv.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 0))
-
-        frame_count += 1
+def load_cameras():
+    #Fills the registry from the database the first time it's needed. If there aren't any cameras yet,
+    #the one from CAMERA_FEED_SOURCE becomes the first
+    if cameras.loaded:
+        return
 
-        #If the queue is full, drop the oldest frame
-        if frame_queue.full():
-            frame_queue.get()
+    with camera_load_lock:
+        if cameras.loaded:
+            return
 
-        #put it in the queue
-        frame_queue.put(frame)
+        sqlite_conn, sqlite_cursor = dbutils.load_database()
+        rows = dbutils.get_cameras(sqlite_conn, sqlite_cursor)
 
-        #Just for testing
-        #frame_queue.put(fgmask.copy())
+        if not rows:
+            dbutils.add_camera(sqlite_conn, sqlite_cursor, "Default", config("CAMERA_FEED_SOURCE", default="DEFAULT"), config("CAMERA_RECORD_SOURCE", default=None))
+            rows = dbutils.get_cameras(sqlite_conn, sqlite_cursor)
 
-    camera.release()
+        cameras.load(rows)
 
-def pass_frame():
-    #This thread pulls the frame from the queue and sets it up for
-    #display via the MJPEG stream created by the generate_stream function
-    global frame_queue, captured_frame, filming_event
-    while filming_event.is_set():
-        try:
-            captured_frame = frame_queue.get(timeout=0.1)
-        except queue.Empty:
-            continue
+def find_camera(camera_id=None):
+    #Looks up the camera an API call is about, the default camera if it didn't say
+    load_cameras()
+    try:
+        return cameras.get(int(camera_id) if camera_id is not None else None)
+    except ValueError:
+        return None
 
-def add_to_mq(msg):
-    global message_queue, last_msg_time, suppress_msg_time
+def add_to_mq(camera, msg, timestamp=None):
+    #timestamp is when the frame the alert came from was captured, so the recording can start from there
+    global suppress_msg_time
     new_time = time.time()
-    if new_time - last_msg_time > suppress_msg_time:
+    if new_time - camera.last_msg_time > suppress_msg_time:
         print("Ready to message again")
-        last_msg_time = new_time
-        message_queue.put_nowait(msg)
+        camera.last_msg_time = new_time
+        camera.message_queue.put_nowait((msg, timestamp))
 
-def handle_messages():
-    global message_queue, record_count, recording_event, filming_event  
+def handle_messages(camera):
+    global filming_event
 
-    while filming_event.is_set():
+    #stop_camera takes the thread off of the camera to tell us to finish
+    while filming_event.is_set() and camera.messaging_thread is threading.current_thread():
         try:
-            msg = message_queue.get(timeout = 0.1)
-            print(msg)
-            if not recording_event.is_set():
-                record_count = 0
-                recording_thread = threading.Thread(target=record_frames, args=[msg,], daemon=False)
-                recording_event.set()
+            msg, event_time = camera.message_queue.get(timeout = 0.1)
+            print(f"[{camera.name}] {msg}")
+            if not camera.recording_event.is_set():
+                camera.record_count = 0
+                recording_thread = threading.Thread(target=mark_alert if continuous_recording else record_frames, args=[camera, msg, event_time], daemon=False)
+                camera.recording_event.set()
                 recording_thread.start()
         except queue.Empty:
             continue
         except Exception as e:
             print(f'Error in message handler: {e}')
 
-def record_frames(desc=None):
-    global recording_queue, recording_event, record_count
+def publish_alert(camera, alert_id, frame):
+    #Runs on the post processor with its own copy of the alert's first frame
+    sqlite_conn, sqlite_cursor = dbutils.load_database()
+    dbutils.add_thumbnail_to_alert(sqlite_conn, sqlite_cursor, alert_id, frame)
+    alert_details = dbutils.get_alert_details(sqlite_conn, sqlite_cursor, alert_id)
+
+    try:
+        if bot_thread is not None:
+            bot_thread.add_message_to_queue({
+                "name": "alert",
+                "text" : f'*New event detected on {camera.name}!* \n\n*Description:* {alert_details['description']} \n\nReview the footage [here]({"http://" + DOCKER_HOST_IP + ":5000/#/alerts/" + str(alert_id)}).',
+                "image" : alert_details['thumbnail']                    
+            })
+    except queue.Full:
+        print("Bot message queue is full")
+
+def finish_recording(video_writer):
+    #Waits for the encoder to write out the end of the file, then puts its index at the front for seeking
+    try:
+        if video_writer.release():
+            print(f"[record_frames] Video saved and released, {video_writer.frames} frames.", flush=True)
+        else:
+            print("[record_frames] ffmpeg had a problem with the recording, it may be cut short.", flush=True)
+        faststart(video_writer.path)
+    finally:
+        unfinished_recordings.discard(os.path.basename(video_writer.path))
+
+def record_frames(camera, desc=None, event_time=None, priority=postprocess.ALERT, follow_motion=True):
     sqlite_conn = None
     sqlite_cursor = None
 
     try:
         sqlite_conn, sqlite_cursor = dbutils.load_database()
-        video_fn, alert_id = dbutils.create_recording(sqlite_conn, sqlite_cursor, desc)
+        video_fn, alert_id = dbutils.create_recording(sqlite_conn, sqlite_cursor, desc, camera.id)
     except RuntimeError:
         print("Error loading database")
         sys.exit(1)
 
-    video_writer = cv.VideoWriter("/app/recordings/" + video_fn + ".avi", cv.VideoWriter.fourcc(*'XVID'), 30, (800, 600))
-
     firstFrame = True
 
-    while recording_event.is_set() and record_count < 300:
+    #We read the frames out of the vision engine's recording buffer one by one into this, so nothing gets allocated per frame
+    recording_ring = camera.vision.recording_ring
+    current_recorded_frame = np.empty(recording_ring.shape, np.uint8)
 
-        try:
-            current_recorded_frame = recording_queue.get(timeout=1)
-            video_writer.write(current_recorded_frame)
-            record_count += 1
-
-            if firstFrame:
-                firstFrame = False
-                dbutils.add_thumbnail_to_alert(sqlite_conn, sqlite_cursor, alert_id, current_recorded_frame)
-                alert_details = dbutils.get_alert_details(sqlite_conn, sqlite_cursor, alert_id)
-
-                try:
-                    bot_thread.add_message_to_queue({
-                        "name": "alert",
-                        "text" : f'*New event detected!* \n\n*Description:* {alert_details['description']} \n\nReview the footage [here]({"http://" + DOCKER_HOST_IP + ":5000/#/alerts/" + str(alert_id)}).',
-                        "image" : alert_details['thumbnail']                    
-                    })
-                except queue.Full:
-                    print("Bot message queue is full")
+    #The video's frame rate is however fast frames have actually been coming in (but no more than CAMERA_FPS, which
+    #the recording buffer is sized for), and every frame is placed in the video by when it was captured, so it plays
+    #back in real time even if the camera doesn't manage its full rate
+    camera_fps = config("CAMERA_FPS", default=30, cast=float)
+    fps = round(min(recording_ring.frame_rate() or camera_fps, camera_fps), 2)
 
-        except queue.Empty:
-            pass
+    #The recording might come from a different, bigger stream than the one we detect on. It's encoded straight to
+    #an mp4 the browser can play, and it can be watched while it's still being recorded
+    unfinished_recordings.add(video_fn + ".mp4")
+    video_writer = FFmpegRecordingWriter("/app/recordings/" + video_fn + ".mp4", camera.vision.record_size, fps)
 
-    record_count = 0
-    recording_event.clear()
-    video_writer.release()
+    #Start PRE_ROLL_SECONDS before the alert. Both streams are stamped when we capture them, so this lines
+    #the recording up with the alert no matter which one it comes from
+    event_time = event_time or time.time()
+    seq = recording_ring.find(event_time - camera.vision.pre_roll)
+    first_timestamp = last_timestamp = None
 
-    print("[record_frames] Video saved and released.", flush=True)
+    #When something was last being tracked. Asking the vision engine for it on every frame is a waste, and
+    #for one in its own process it isn't free, so we only check a few times a second
+    last_motion_at = event_time
+    last_motion_check = 0
 
-    #Use ffmpeg to convert to mp4 for better browser support
-    ffmpeg.input("/app/recordings/" + video_fn + ".avi").output("/app/recordings/" + video_fn + ".mp4", vcodec="libx264", acodec="aac", threads=2, video_bitrate='500K', preset='ultrafast').run(quiet=True)
-    
-    print("[record_frames] FFmpeg conversion complete.", flush=True)
-    #Clear up the old file
-    os.remove("/app/recordings/" + video_fn + ".avi")
+    while camera.recording_event.is_set():
 
-    #reset the camera because sometimes ffmpeg corrupts it
-    stop_capture_and_processing()
-    time.sleep(2)
-    start_capture_and_processing()
+        if not recording_ring.wait(seq, timeout=1):
+            continue
 
+        #If we fell so far behind that the frame we wanted is gone, skip ahead to the oldest one left
+        seq = max(seq, recording_ring.oldest())
+        timestamp = recording_ring.read(seq, current_recorded_frame)
+        seq += 1
+        if timestamp is None:
+            continue
 
+        if first_timestamp is None:
+            first_timestamp = timestamp
+        if timestamp - first_timestamp > max_recording_seconds:
+            print(f"[record_frames] Stopping {video_fn} at the {max_recording_seconds:g}s limit", flush=True)
+            break
 
-def generate_stream():
-    #This is a generator function used to create the stream response
-    global captured_frame
-    while True:
-        if captured_frame is not None:
-            _, buffer = cv.imencode('.jpg', captured_frame)
-            frame = buffer.tobytes()
-            yield (b'--frame\r\n'
-                    b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+        if follow_motion:
+            if time.time() - last_motion_check > 0.25:
+                last_motion_check = time.time()
+                last_motion_at = max(last_motion_at, camera.vision.last_motion_at or 0)
+            if timestamp > last_motion_at + post_roll:
+                break
+
+        video_writer.write(current_recorded_frame, timestamp)
+        last_timestamp = timestamp
+        camera.record_count += 1
+
+        if firstFrame:
+            firstFrame = False
+            post_processor.submit(priority, f"alert {alert_id} thumbnail", publish_alert, camera, alert_id, current_recorded_frame.copy())
+
+    if last_timestamp is not None:
+        print(f"[record_frames] Recorded {last_timestamp - first_timestamp:.1f}s at {fps} fps ({camera.record_count} frames captured)", flush=True)
+    camera.record_count = 0
+    camera.recording_event.clear()
+
+    #The camera carries on as it is. It used to get restarted here, because the transcode that used to happen
+    #here sometimes broke it, but there's no transcode anymore and the encoder is niced well below capture
+    post_processor.submit(priority, f"recording {video_fn}", finish_recording, video_writer)
+
+
+
+def mark_alert(camera, desc=None, event_time=None, priority=postprocess.ALERT, follow_motion=True):
+    #record_frames for continuous recording. The footage is already being recorded, so all we do is note
+    #where the alert starts in the segments and, once it's over, how long it is. It follows the motion and
+    #stops the same way record_frames does
+    event_time = event_time or time.time()
+    start_time = event_time - continuous_pre_roll
+
+    sqlite_conn, sqlite_cursor = dbutils.load_database()
+    segment = dbutils.find_segment(sqlite_conn, sqlite_cursor, camera.id, start_time)
+    if segment is None:
+        print(f"[mark_alert] {camera.name} hasn't recorded anything yet, so there's nothing to point the alert at", flush=True)
+        camera.recording_event.clear()
+        return
+
+    segment_id, segment_start = segment
+    start_time = max(start_time, segment_start)
+    alert_id = dbutils.create_segment_alert(sqlite_conn, sqlite_cursor, desc, camera.id, segment_id, start_time - segment_start)
+
+    #The thumbnail is the first frame of the alert's footage we still have in memory
+    recording_ring = camera.vision.recording_ring
+    thumbnail = np.empty(recording_ring.shape, np.uint8)
+    seq = recording_ring.find(start_time)
+    if recording_ring.wait(seq, timeout=1) and recording_ring.read(max(seq, recording_ring.oldest()), thumbnail) is not None:
+        post_processor.submit(priority, f"alert {alert_id} thumbnail", publish_alert, camera, alert_id, thumbnail)
+
+    last_motion_at = event_time
+    end_time = time.time()
+    while camera.recording_event.is_set():
+        end_time = time.time()
+        if end_time - start_time > max_recording_seconds:
+            end_time = start_time + max_recording_seconds
+            break
+        if follow_motion:
+            last_motion_at = max(last_motion_at, camera.vision.last_motion_at or 0)
+            if end_time > last_motion_at + post_roll:
+                end_time = last_motion_at + post_roll
+                break
+        time.sleep(0.25)
+
+    dbutils.finish_segment_alert(sqlite_conn, sqlite_cursor, alert_id, end_time - start_time)
+    print(f"[mark_alert] Alert {alert_id} is {end_time - start_time:.1f}s of {camera.name}'s footage", flush=True)
+    camera.recording_event.clear()
+
+def generate_stream(camera):
+    #This is a generator function used to create the stream response. It waits for each new frame
+    #instead of spinning and sending the same one over and over
+    seq = 0
+    while camera.vision is None:
+        time.sleep(0.1)
+
+    #The vision engine only draws and publishes frames while it has viewers. The finally runs when the
+    #client goes away and Flask closes the generator
+    vision = camera.vision
+    vision.add_viewer()
+    try:
+        while True:
+            seq, frame = vision.wait_for_jpeg(seq)
+            if frame is not None:
+                yield (b'--frame\r\n'
+                        b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+    finally:
+        vision.remove_viewer()
             
 @app.route("/api/platform", methods=["GET",])
 def platform_data():
@@ -238,24 +315,77 @@ def platform_data():
         "platform_str": platform.platform()
     }), 200
 
+def camera_status(camera):
+    status = camera.vision.stats() if camera.vision is not None else {"queue_lengths": {}}
+    status.update({
+        "camera": camera.to_dict(),
+        "recording_event": camera.recording_event.is_set(),
+        "messaging_thread_alive": camera.messaging_thread.is_alive() if camera.messaging_thread else False,
+        "vision_engine": type(camera.vision).__name__ if camera.vision is not None else None,
+        "segments": camera.segment_recorder.stats if camera.segment_recorder else None
+    })
+    status["queue_lengths"]["message_queue"] = camera.message_queue.qsize()
+    return status
+
 @app.route("/api/status", methods=["GET"])
 def system_status():
-    status = {
+    load_cameras()
+
+    #The top level is the default camera, like it was before there could be more than one
+    per_camera = {camera.id: camera_status(camera) for camera in cameras}
+    default = cameras.get()
+    status = dict(per_camera[default.id]) if default else {}
+    status.update({
         "filming_event": filming_event.is_set(),
-        "recording_event": recording_event.is_set(),
-        "capture_thread_alive": capture_thread.is_alive() if capture_thread else False,
-        "pass_thread_alive": pass_thread.is_alive() if pass_thread else False,
-        "messaging_thread_alive": messaging_thread.is_alive() if messaging_thread else False,
-        "queue_lengths": {
-            "frame_queue": frame_queue.qsize(),
-            "recording_queue": recording_queue.qsize(),
-            "message_queue": message_queue.qsize()
-        },
-        "tracked_objects": len(tracked_objects),
-        "frame_count": frame_count
-    }
+        "budget": {"threads": cameras.thread_budget, "processes": cameras.process_budget},
+        "postprocess": post_processor.stats,
+        "cameras": per_camera
+    })
 
     return jsonify(status), 200
+
+def elapsed(since, until):
+    return round(until - since, 3) if since and until else None
+
+@app.route("/api/ready", methods=["GET"])
+def readiness():
+    #Answers straight away however far along start up is. We're ready once the database works and, if
+    #filming is on, every camera has sent us a frame. Until then it's a 503, so it can be used as a health check
+    try:
+        sqlite_conn, sqlite_cursor = dbutils.load_database()
+        sqlite_cursor.execute("SELECT 1")
+        database = True
+    except Exception as e:
+        print(f"[ready] Database isn't ready: {e}", flush=True)
+        database = False
+
+    #Don't load the cameras from here, start up does that in the background
+    camera_states = {}
+    for camera in (cameras if cameras.loaded else []):
+        camera_state = camera.vision.startup_stats() if camera.vision is not None else {"camera_state": "stopped", "first_frame_at": None}
+        camera_state["ready"] = camera_state["camera_state"] == "streaming" and camera_state["first_frame_at"] is not None
+        camera_states[camera.id] = camera_state
+
+    cameras_ready = cameras.loaded and (not filming_event.is_set() or all(c["ready"] for c in camera_states.values()))
+    ready = database and cameras_ready
+
+    #We're ready as of the latest thing we were waiting on, which might be before anyone asked
+    if ready and startup["ready_at"] is None:
+        first_frames = [c["first_frame_at"] for c in camera_states.values() if c["first_frame_at"]]
+        startup["ready_at"] = max([startup["http_at"] or time.time()] + first_frames)
+
+    return jsonify({
+        "ready": ready,
+        "subsystems": {
+            "http": True,
+            "database": database,
+            "cameras": cameras_ready,
+            "bot": bot_thread is not None and bot_thread.is_alive()
+        },
+        "cameras": camera_states,
+        "time_to_http": elapsed(started_at, startup["http_at"]),
+        "time_to_ready": elapsed(started_at, startup["ready_at"])
+    }), 200 if ready else 503
             
 @app.route('/')
 @app.route('/<path:path>')
@@ -265,8 +395,106 @@ def serve_frontend(path="index.html"):
     return send_from_directory(app.static_folder, path)
             
 @app.route("/api/live")
-def video_feed():
-    return Response(generate_stream(), mimetype='multipart/x-mixed-replace; boundary=frame')
+@app.route("/api/live/<camera_id>")
+def video_feed(camera_id=None):
+    camera = find_camera(camera_id)
+    if camera is None:
+        return jsonify({"error": "No such camera"}), 404
+
+    return Response(generate_stream(camera), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route("/api/cameras", methods=["GET", "POST"])
+def cameras_config():
+    load_cameras()
+
+    if request.method == "GET":
+        return jsonify([camera.to_dict() for camera in cameras]), 200
+
+    data = request.json
+    if not isinstance(data, dict) or not data.get("name") or data.get("source") in (None, ""):
+        return jsonify({"error": "Please send a name and a source for the camera"}), 400
+
+    sqlite_conn, sqlite_cursor = dbutils.load_database()
+    try:
+        camera_id = dbutils.add_camera(sqlite_conn, sqlite_cursor, data["name"], data["source"], data.get("record_source"))
+    except sqlite3.IntegrityError:
+        return jsonify({"error": "There is already a camera with that name"}), 400
+
+    camera = cameras.add(camera_id, data["name"], str(data["source"]), str(data["record_source"]) if data.get("record_source") else None)
+    if filming_event.is_set():
+        try:
+            start_camera(camera)
+        except FrameBusFull as e:
+            #There's no room for it, so it's as if it was never added
+            cameras.remove(camera.id)
+            dbutils.delete_camera(sqlite_conn, sqlite_cursor, camera.id)
+            return jsonify({"error": f"There isn't enough memory for another camera: {e}"}), 507
+
+    return jsonify({"status": "Camera added successfully", "camera": camera.to_dict()}), 201
+
+@app.route("/api/cameras/<camera_id>", methods=["GET", "PUT", "DELETE"])
+def camera_config(camera_id):
+    camera = find_camera(camera_id)
+    if camera is None:
+        return jsonify({"error": "No such camera"}), 404
+
+    if request.method == "GET":
+        return jsonify(camera.to_dict()), 200
+
+    sqlite_conn, sqlite_cursor = dbutils.load_database()
+
+    if request.method == "DELETE":
+        if len(cameras) == 1:
+            return jsonify({"error": "Can't remove the only camera"}), 400
+
+        cameras.remove(camera.id)
+        stop_camera(camera)
+        if camera.vision is not None:
+            camera.vision.close()
+        dbutils.delete_camera(sqlite_conn, sqlite_cursor, camera.id)
+        return jsonify({"status": "Camera removed successfully"}), 201
+
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({"error": "Please send a name, a source and/or a record_source for the camera"}), 400
+
+    name = data.get("name") or camera.name
+    source = str(data["source"]) if data.get("source") not in (None, "") else camera.source
+    #Send an empty record_source to go back to recording what we detect on
+    if "record_source" in data:
+        record_source = str(data["record_source"]) if data["record_source"] else None
+    else:
+        record_source = camera.record_source
+    try:
+        dbutils.update_camera(sqlite_conn, sqlite_cursor, camera.id, name, source, record_source)
+    except sqlite3.IntegrityError:
+        return jsonify({"error": "There is already a camera with that name"}), 400
+
+    camera.name = name
+    if source != camera.source or record_source != camera.record_source:
+        #A new source needs a new engine, the old background model is for a different scene anyway
+        was_running = camera.running
+        stop_camera(camera)
+        if camera.vision is not None:
+            camera.vision.close()
+        camera.vision = None
+        camera.source = source
+        camera.record_source = record_source
+        if was_running:
+            try:
+                start_camera(camera)
+            except FrameBusFull as e:
+                return jsonify({"error": f"The camera was updated, but there isn't enough memory to start it: {e}"}), 507
+
+    return jsonify({"status": "Camera updated successfully", "camera": camera.to_dict()}), 201
+
+@app.route("/api/cameras/<camera_id>/status", methods=["GET"])
+def camera_status_route(camera_id):
+    camera = find_camera(camera_id)
+    if camera is None:
+        return jsonify({"error": "No such camera"}), 404
+
+    return jsonify(camera_status(camera)), 200
 
 @app.route("/api/alerts", methods=["GET"])
 def get_alerts():
@@ -277,8 +505,11 @@ def get_alerts():
     if not page_no:
         page_no = 1
 
+    #Pass camera to only get the alerts from one camera
+    camera_id = request.args.get("camera")
+
     sqlite_conn, sqlite_cursor = dbutils.load_database()
-    alerts = dbutils.get_alerts_data(sqlite_conn, sqlite_cursor, 5, page_no)
+    alerts = dbutils.get_alerts_data(sqlite_conn, sqlite_cursor, 5, int(page_no), int(camera_id) if camera_id else None)
     return jsonify(alerts), 200
 
 @app.route("/api/alerts/<alert_id>", methods=["GET", "DELETE"])
@@ -297,6 +528,9 @@ def get_alert_detail(alert_id):
    
 @app.route("/api/setup/link_bot", methods=["POST",])
 def link_bot():
+    if bot_thread is None:
+        return jsonify({"error": "The bot hasn't started yet, try again in a moment"}), 503
+
     data = request.json
     sqlite_conn, sqlite_cursor = dbutils.load_database()
     dbutils.update_setting_value(sqlite_conn, sqlite_cursor, "BOT_CHAT_ID", data["chat_id"])
@@ -326,27 +560,55 @@ def get_setup_status():
         return Response("INCOMPLETE", status=200, mimetype="text/plain")
 
 
+def send_recording(folder, filename, finished=True, ranges=True, **kwargs):
+    #send_from_directory answers range requests with a 206 (so the browser can seek), and gives out an ETag for
+    #If-None-Match and If-Range. That's only right for a file that won't change under the browser. A finished one
+    #never does, so it can be cached too. One that's still being recorded only grows, so its ranges stay good but
+    #there's nothing to check them against, and a partial clip gets cut all over again, so it's sent whole
+    response = send_from_directory(folder, filename, conditional=ranges, etag=finished,
+                                   max_age=recording_cache_seconds if finished else None, **kwargs)
+    if finished:
+        response.cache_control.immutable = True
+    else:
+        response.headers.pop("Last-Modified", None)
+    return response
+
 @app.route("/api/thumbnails/<filename>")
 def get_image(filename):
-    return send_from_directory("/app/thumbnails", filename)
+    return send_recording("/app/thumbnails", filename)
 
 @app.route("/api/recordings/<filename>")
 def get_video(filename):
     as_attachment = request.args.get("download")
 
+    #An alert from continuous recording gets its clip cut from the segments the first time it's asked for
+    clip = re.fullmatch(r"clip_(\d+)\.mp4", filename)
+    if clip:
+        sqlite_conn, sqlite_cursor = dbutils.load_database()
+        path = cut_clip(sqlite_conn, sqlite_cursor, int(clip.group(1)))
+        if path is None:
+            return jsonify({"error": "The footage for this alert has already been recycled, or couldn't be cut"}), 404
+        filename = os.path.basename(path)
+
     #The as_attachment variable allows you to change the Content-Disposition
     #to determine if it displays in the browser or downloads
 
-    return send_from_directory("/app/recordings", filename, mimetype="video/mp4", as_attachment = True if as_attachment == "yes" else False)
+    #A clip of an alert that's still going gets cut again every few seconds, and a recording that's still being written keeps growing
+    partial = filename.endswith("_partial.mp4")
+    finished = filename not in unfinished_recordings and not partial
+    return send_recording("/app/recordings", filename, finished, ranges=not partial, mimetype="video/mp4", as_attachment = True if as_attachment == "yes" else False)
 
 
 @app.route("/api/record", methods=["POST", "GET"])
 def recording_state():
-    global record_count
+    #Send a camera field (or ?camera= when using get) to pick the camera, otherwise it's the default one
+    camera = find_camera(request.args.get("camera") if request.method == "GET" else (request.json or {}).get("camera"))
+    if camera is None:
+        return jsonify({"error": "No such camera"}), 404
 
     #We can use get to check if we are recording or not
     if request.method == "GET":
-        return jsonify({"recording" : "on" if recording_event.isSet() else "off"}), 200
+        return jsonify({"recording" : "on" if camera.recording_event.is_set() else "off"}), 200
     elif request.method != "POST":
         #Give an error if the method is not get or post
         return "", 405
@@ -357,17 +619,19 @@ def recording_state():
         return jsonify({"error": "Please include a new_state field with a value of \"on\" or \"off\""}), 400
     
     if data["new_state"].lower() == "on":
-        if not recording_event.is_set():
-            record_count = 0
-            recording_thread = threading.Thread(target=record_frames, args=["User generated recording",], daemon=False)
+        if not camera.running:
+            return jsonify({"error": "The camera isn't running"}), 400
+        if not camera.recording_event.is_set():
+            camera.record_count = 0
+            recording_thread = threading.Thread(target=mark_alert if continuous_recording else record_frames, args=[camera, "User generated recording", None, postprocess.USER, False], daemon=False)
+            camera.recording_event.set()
             recording_thread.start()
-            recording_event.set()
             return jsonify({"status" : "Recording started successfully"}), 201
         else:
             return jsonify({"status" : "The program is already recording"}), 400
             
     elif data["new_state"].lower() == "off":
-        recording_event.clear()
+        camera.recording_event.clear()
         return jsonify({"status" : "Recording stopped successfully"}), 201
     else:
         return jsonify({"error": "Please include a new_state field with a value of \"on\" or \"off\""}), 400
@@ -405,98 +669,172 @@ def recording_enabled():
     
 @app.route("/api/processor", methods=["POST", "GET"])
 def image_processor():
-    global processing_method
+    global processing_method, detector_params
 
     if request.method == "GET":
-        return jsonify({"method" : processing_method}), 200
+        return jsonify({"method" : processing_method, "params": detector_params}), 200
     elif request.method != "POST":
         return "", 405
     
     data = request.json
     if "method" not in data:
         return jsonify({"error": "Please send a method field with a value of 0 or 1"}), 400
-    else:
-        processing_method = int(data["method"])
-        #Restart the capture and processing
-        stop_capture_and_processing()
-        start_capture_and_processing()
-        return jsonify({"status" : "Frame processor changed successfully"}), 201
+
+    try:
+        method = whole_number("method", data["method"])
+        params = validate_detector_params(method, data.get("params"))
+        warmup_frames = whole_number("warmup_frames", data.get("warmup_frames", 0))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    processing_method, detector_params = method, params
+
+    #The running cameras swap the new detector in between frames instead of restarting capture. Sending
+    #warmup_frames lets it learn the background alongside the old one for that many frames before it takes over
+    load_cameras()
+    for camera in cameras:
+        if camera.vision is not None:
+            camera.vision.swap_detector(method, params, warmup_frames)
+
+    return jsonify({"status" : "Frame processor changed successfully"}), 201
     
-def start_capture_and_processing():
-    global capture_thread, pass_thread, messaging_thread, filming_event
+@app.route("/api/zones", methods=["POST", "GET"])
+def zones_config():
+    #Every camera has its own zones, pass ?camera= to pick one, otherwise it's the default camera
+    camera = find_camera(request.args.get("camera"))
+    if camera is None:
+        return jsonify({"error": "No such camera"}), 404
 
-    print("Capture and processing function started", flush=True)
+    sqlite_conn, sqlite_cursor = dbutils.load_database()
 
-    if filming_event.is_set():
-        print("Film already running.")
-        return
+    if request.method == "GET":
+        return jsonify(dbutils.get_detection_zones(sqlite_conn, sqlite_cursor, camera.id)), 200
+    elif request.method != "POST":
+        return "", 405
 
-    filming_event.set()
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({"error": "Please send an object with include and exclude lists of polygons"}), 400
+
+    try:
+        zones = DetectionZones.from_dict(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    capture_thread = threading.Thread(target=capture_and_process_frames, daemon=True)
-    pass_thread = threading.Thread(target=pass_frame, daemon=True)
-    messaging_thread = threading.Thread(target=handle_messages, daemon=True)
+    dbutils.update_detection_zones(sqlite_conn, sqlite_cursor, zones.to_dict(), camera.id)
 
-    capture_thread.start()
-    pass_thread.start()
-    messaging_thread.start()
+    if camera.vision is not None:
+        camera.vision.set_detection_zones(zones)
+    return jsonify({"status": "Detection zones updated successfully"}), 201
 
-def stop_capture_and_processing():
-    global capture_thread, pass_thread, messaging_thread, filming_event, recording_event, frame_queue, recording_queue, message_queue
+@app.route("/api/vision/restart", methods=["POST",])
+def restart_vision():
+    #Restarts just one camera's capture and detection, without touching the web server, the bot or the other cameras
+    camera = find_camera((request.get_json(silent=True) or {}).get("camera"))
+    if camera is None:
+        return jsonify({"error": "No such camera"}), 404
+    if not camera.running:
+        return jsonify({"error": "Capture isn't running"}), 400
 
-    print("Capture and processing function stopped", flush=True)
-    
-    recording_event.clear()
-    filming_event.clear()
+    camera.vision.stop()
+    camera.vision.start()
+    return jsonify({"status": "Vision engine restarted successfully"}), 201
+
+def start_camera(camera):
+    if camera.vision is None:
+        cameras.create_engine(camera, lambda msg, timestamp: add_to_mq(camera, msg, timestamp), processing_method)
+
+    camera.vision.processing_method = processing_method
+    camera.vision.detector_params = detector_params
+    camera.vision.start()
+
+    if continuous_recording:
+        if camera.segment_recorder is None:
+            camera.segment_recorder = SegmentRecorder(camera, post_processor)
+        camera.segment_recorder.start()
+
+    camera.messaging_thread = threading.Thread(target=handle_messages, args=[camera], daemon=True)
+    camera.messaging_thread.start()
+
+def stop_camera(camera):
+    camera.recording_event.clear()
 
     #Join the threads to really make sure they're done
     #This fixed a bug I found where the camera refused to restart
     #and it was also partially caused by the race condition of using filming_event as a bool instead
     #of a thread.event
-    if capture_thread is not None:
-        capture_thread.join(timeout=2)
-    if pass_thread is not None:
-        pass_thread.join(timeout=2)
+    messaging_thread, camera.messaging_thread = camera.messaging_thread, None
+
+    #Finish off the segment being recorded before the frames stop coming
+    if camera.segment_recorder is not None:
+        camera.segment_recorder.stop()
+    if camera.vision is not None:
+        camera.vision.stop()
     if messaging_thread is not None:
         messaging_thread.join(timeout=2)
 
-    capture_thread = None
-    pass_thread = None
-    messaging_thread = None
-
     #We empty the queues here to prevent erroneous data from sticking around if we restart    
     while True:
         try:
-            frame_queue.get_nowait()
+            camera.message_queue.get_nowait()
         except queue.Empty:
             break
 
-    while True:
-        try:
-            recording_queue.get_nowait()
-        except queue.Empty:
-            break
+def start_capture_and_processing():
+    global filming_event
 
-    while True:
+    print("Capture and processing function started", flush=True)
+
+    if filming_event.is_set():
+        print("Film already running.")
+        return
+
+    load_cameras()
+    filming_event.set()
+
+    for camera in cameras:
         try:
-            message_queue.get_nowait()
-        except queue.Empty:
-            break
+            start_camera(camera)
+        except FrameBusFull as e:
+            #The rest of the cameras still get started
+            print(f"[main] Not starting {camera.name}: {e}", flush=True)
+
+def stop_capture_and_processing():
+    global filming_event
+
+    print("Capture and processing function stopped", flush=True)
+    
+    filming_event.clear()
+
+    for camera in cameras:
+        stop_camera(camera)
     
 
+def start_background():
+    #Everything that can take a while happens here, so the server can answer straight away. The cameras
+    #open on their own capture threads and keep retrying until they're there
+    global bot_thread
+
+    try:
+        start_capture_and_processing()
+    except Exception as e:
+        print(f"[main] Error starting capture: {e}", flush=True)
+
+    #The bot pulls in requests and qrcode, which nothing else needs
+    from bot import TelegramBotThread
+    bot_thread = TelegramBotThread()
+    bot_thread.start()
+
 if __name__ == "__main__":
 
-    recording_event.clear()
     filming_event.clear()
 
-    start_capture_and_processing()
+    threading.Thread(target=start_background, daemon=True).start()
 
-    bot_thread = TelegramBotThread()
-    bot_thread.start() 
-    
+    startup["http_at"] = time.time()
+    print(f"[main] Starting the server {startup['http_at'] - started_at:.2f}s after launch", flush=True)
     app.run('0.0.0.0', port=5000)
     print("[main] Flask server started", flush=True)
 
-    recording_event.clear()
     filming_event.clear()
 
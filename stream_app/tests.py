@@ -1,6 +1,30 @@
 import unittest
 import utils
+import pipeline
+import shared_frames
+import capture
+import cameras
+import vision
+import vision_process
+import recorder
+import postprocess
+import segments
+import shutil
+import dbutils
+import tempfile
+import os
+import threading
+import time
 import cv2 as cv
+import numpy as np
+import itertools
+from collections import deque
+
+#stream.py needs Python 3.12 and DOCKER_HOST_IP, the tests of the server are skipped without them
+try:
+    import stream
+except Exception:
+    stream = None
 
 
 class TestStream(unittest.TestCase):
@@ -30,4 +54,1053 @@ class TestStream(unittest.TestCase):
         self.cam.release()
         return super().tearDown()
 
-    
\ No newline at end of file
+
+class TestRunningMedian(unittest.TestCase):
+
+    def test_MatchesNumpyMedian(self):
+
+        #The running median should give exactly what np.median gave us before, through the warm up
+        #and after the buffer starts wrapping. Small values make sure we get plenty of ties
+
+        rng = np.random.default_rng(0)
+        for bufsize in (1, 4, 5):
+            running = utils.RunningMedian(bufsize)
+            history = deque(maxlen=bufsize)
+            for _ in range(3 * bufsize):
+                frame = rng.integers(0, 8, (6, 5, 3), dtype=np.uint8)
+                running.push(frame)
+                history.append(frame)
+                expected = np.median(np.stack(history, axis=0), axis=0).astype(np.uint8)
+                self.assertTrue(np.array_equal(running.median(), expected))
+
+
+
+class TestResolutionScaling(unittest.TestCase):
+
+    def test_ThresholdsScaleWithResolution(self):
+
+        #At the reference resolution nothing should change, and at a quarter of the pixels areas
+        #shrink by 4 and distances by 2
+
+        self.assertEqual(utils.scale_area(3500, (800, 600)), 3500)
+        self.assertAlmostEqual(utils.scale_area(3500, (400, 300)), 875)
+        self.assertAlmostEqual(utils.scale_distance(200, (400, 300)), 100)
+
+    def test_ContourMapsBackToDisplay(self):
+        contour = np.array([[[10, 20]], [[40, 20]], [[40, 60]]], dtype=np.int32)
+        scaled = utils.scale_contour(contour, (320, 240), (800, 600))
+        self.assertEqual(cv.boundingRect(scaled), (25, 50, 76, 101))
+
+
+class TestMotionGate(unittest.TestCase):
+
+    def test_SkipsStaticScenes(self):
+
+        #The first frame always goes through, identical frames get skipped, and a moving
+        #block gets through again unless we're forced
+
+        gate = utils.MotionGate(upkeep_interval=2)
+        frame = np.full((240, 320, 3), 50, dtype=np.uint8)
+
+        self.assertTrue(gate.should_process(frame))
+        self.assertFalse(gate.should_process(frame))
+        self.assertFalse(gate.should_process(frame))
+        self.assertTrue(gate.upkeep_due())
+        self.assertTrue(gate.should_process(frame, force=True))
+
+        moved = frame.copy()
+        cv.rectangle(moved, (100, 100), (160, 200), (255, 255, 255), -1)
+        self.assertTrue(gate.should_process(moved))
+        self.assertEqual(gate.stats["skipped"], 2)
+
+
+class TestDetectionZones(unittest.TestCase):
+
+    def test_CropAndMask(self):
+
+        #The crop should be the bounding box of the include zone, and the excluded square inside
+        #it should be masked out
+
+        zones = utils.DetectionZones(
+            include=[[[0.25, 0.25], [0.75, 0.25], [0.75, 0.75], [0.25, 0.75]]],
+            exclude=[[[0.5, 0.5], [0.75, 0.5], [0.75, 0.75], [0.5, 0.75]]])
+        (x, y, w, h), mask = zones.crop((200, 100))
+
+        self.assertEqual((x, y, w, h), (50, 25, 101, 51))
+        self.assertEqual(mask.shape, (51, 101))
+        self.assertEqual(mask[5, 5], 255)
+        self.assertEqual(mask[40, 80], 0)
+        self.assertIs(zones.crop((200, 100))[1], mask)
+
+    def test_RejectsBadPolygons(self):
+        with self.assertRaises(ValueError):
+            utils.DetectionZones(include=[[[0.1, 0.1], [0.2, 0.2]]])
+        with self.assertRaises(ValueError):
+            utils.DetectionZones(exclude=[[[0.1, 0.1], [0.2, 0.2], [1.5, 0.2]]])
+
+        #These come straight from the JSON POST /api/zones gets, which turns the ValueError into a 400
+        for point in (["0.1", 0.2], [None, 0.2], [True, 0.2], [0.1, False]):
+            with self.assertRaises(ValueError):
+                utils.DetectionZones.from_dict({"include": [[[0.1, 0.1], [0.2, 0.2], point]], "exclude": []})
+
+
+class TestBlobExtractors(unittest.TestCase):
+
+    def test_ExtractorsAgree(self):
+
+        #Both extractors should find the same blobs in the same places, with the tiny and the huge
+        #ones filtered out
+
+        mask = np.zeros((120, 160), dtype=np.uint8)
+        cv.rectangle(mask, (10, 10), (39, 49), 255, -1)
+        cv.rectangle(mask, (100, 60), (139, 99), 255, -1)
+        cv.rectangle(mask, (70, 5), (72, 7), 255, -1)
+
+        args = (20, 5000, (160, 120), (160, 120))
+        contours = utils.ContourBlobExtractor(*args).extract(mask, 0)
+        components = utils.ComponentBlobExtractor(*args).extract(mask, 0)
+
+        self.assertEqual(len(contours), 2)
+        self.assertEqual(sorted(c.bounding_box for c in contours), sorted(c.bounding_box for c in components))
+        for c in components:
+            self.assertEqual(cv.boundingRect(c.contour), c.bounding_box)
+
+        #Mapped up to double the size, the boxes should double too
+        scaled = utils.ComponentBlobExtractor(20, 5000, (160, 120), (320, 240)).extract(mask, 0)
+        self.assertEqual(sorted(c.bounding_box for c in scaled), [(20, 20, 60, 80), (200, 120, 80, 80)])
+
+
+class TestTiledObjectDetector(unittest.TestCase):
+
+    def test_MatchesSingleDetector(self):
+
+        #Splitting the frame into strips shouldn't change the mask at all, for either detector
+
+        rng = np.random.default_rng(1)
+        frames = [rng.integers(0, 256, (90, 64, 3), dtype=np.uint8) for _ in range(12)]
+
+        for make_detector in (utils.MovingMedianObjectDetector, utils.OpenCVMOG2ObjectDetector):
+            single = make_detector()
+            tiled = utils.TiledObjectDetector(make_detector, strips=4)
+            for frame in frames:
+                self.assertTrue(np.array_equal(single.iterate(frame), tiled.iterate(frame)))
+            tiled.close()
+
+
+class TestDetectorState(unittest.TestCase):
+
+    def test_MedianStateRestoresExactly(self):
+
+        #A detector restored from a saved state should carry on exactly like the one it was saved from
+
+        rng = np.random.default_rng(2)
+        frames = [rng.integers(0, 256, (30, 40, 3), dtype=np.uint8) for _ in range(15)]
+
+        for make_detector in (utils.MovingMedianObjectDetector, lambda: utils.TiledObjectDetector(utils.MovingMedianObjectDetector, strips=2)):
+            original = make_detector()
+            for frame in frames[:12]:
+                original.iterate(frame)
+
+            restored = make_detector()
+            restored.set_state(original.get_state())
+            for frame in frames[12:]:
+                self.assertTrue(np.array_equal(original.iterate(frame), restored.iterate(frame)))
+
+    def test_StatesKeptPerCamera(self):
+
+        #Each camera gets back its own background, and saving one camera's doesn't lose another's
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "detector_state.pkl")
+            utils.save_detector_states(path, 1, {0: "front"})
+            utils.save_detector_states(path, 2, {0: "back", 1: "back mog"})
+            utils.save_detector_states(path, 1, {0: "front again"})
+
+            self.assertEqual(utils.load_detector_states(path, 1), {0: "front again"})
+            self.assertEqual(utils.load_detector_states(path, 2), {0: "back", 1: "back mog"})
+            self.assertEqual(utils.load_detector_states(path, 3), {})
+
+
+class TestDetectionGovernor(unittest.TestCase):
+
+    def test_CadenceFollowsCost(self):
+
+        #At 10 fps we have 100ms a frame. With 40ms of other work, a 150ms detection has to be
+        #spread over 3 frames, and a cheap one can run on every frame
+
+        governor = utils.DetectionGovernor(target_fps=10, smoothing=1.0)
+        governor.record(0.15, 0.04)
+        self.assertEqual(governor.cadence, 3)
+        self.assertEqual([governor.should_detect() for _ in range(6)], [False, False, True, False, False, True])
+
+        governor.record(0.01, 0.04)
+        self.assertEqual(governor.cadence, 1)
+
+    def test_Extrapolation(self):
+        tracked = utils.TrackedObject((100, 100, 20, 20), None, 0)
+        tracked.update((110, 96, 20, 20), 2)
+        tracked.extrapolate(4)
+        self.assertEqual(tracked.velocity, (5.0, -2.0))
+        self.assertEqual(tracked.bounding_box, (120, 92, 20, 20))
+
+    def test_IdlePolicy(self):
+        #Nothing for idle_after seconds means we only take a frame every 1/idle_fps, and activity ends that at once
+        policy = utils.IdlePolicy(idle_after=10, idle_fps=2)
+        self.assertFalse(policy.update())
+        self.assertEqual(policy.wait_time(), 0.0)
+
+        #Only update moves it along, looking at it (or its stats) doesn't
+        policy.last_activity -= 11
+        policy.frame_taken()
+        self.assertFalse(policy.idle)
+        self.assertFalse(policy.stats["idle"])
+        self.assertEqual(policy.stats["idle_periods"], 0)
+        self.assertTrue(policy.update())
+        self.assertTrue(policy.update())
+        self.assertGreater(policy.wait_time(), 0.4)
+
+        policy.activity()
+        self.assertFalse(policy.idle)
+        self.assertEqual(policy.wait_time(), 0.0)
+        self.assertEqual(policy.stats["idle_periods"], 1)
+
+        self.assertFalse(utils.IdlePolicy(idle_after=0).update())
+
+
+class TestObjectTracker(unittest.TestCase):
+
+    def test_AssignmentIsOptimal(self):
+
+        #Check the assignment against trying every possible pairing, including non-square problems
+
+        rng = np.random.default_rng(3)
+        for shape in ((4, 4), (3, 5), (5, 2), (1, 3)):
+            cost = rng.random(shape)
+            rows, cols = utils.solve_assignment(cost)
+            best = min(
+                sum(cost[r, c] for r, c in (zip(range(shape[0]), p) if shape[0] <= shape[1] else zip(p, range(shape[1]))))
+                for p in itertools.permutations(range(max(shape)), min(shape)))
+            self.assertEqual(len(rows), min(shape))
+            self.assertAlmostEqual(cost[rows, cols].sum(), best)
+
+    def test_GlobalMatching(self):
+
+        #Greedy matching would give the first object the detection at 100 and leave the second one
+        #with nothing nearby, the tracker should keep both objects on their own detections
+
+        tracker = utils.ObjectTracker(distance_threshold=60)
+        tracker.match([utils.TrackedObject((60, 0, 0, 0), None, 0), utils.TrackedObject((130, 0, 0, 0), None, 0)], 0, print)
+        ids = [o.id for o in tracker.objects]
+
+        tracker.match([utils.TrackedObject((100, 0, 0, 0), None, 1), utils.TrackedObject((20, 0, 0, 0), None, 1)], 1, print)
+        self.assertEqual(len(tracker), 2)
+        self.assertEqual({o.id: o.bounding_box[0] for o in tracker.objects}, {ids[0]: 20, ids[1]: 100})
+
+    def test_NotifiesAndForgets(self):
+        messages = []
+        tracker = utils.ObjectTracker(max_disappearance=4, notify_time=2)
+        tracker.match([utils.TrackedObject((0, 0, 10, 10), None, 0, area=100)], 0, messages.append)
+        for frame in range(1, 6):
+            tracker.match([], frame, messages.append)
+
+        self.assertEqual(messages, ["Small object detected on left side."])
+        self.assertEqual(len(tracker), 0)
+
+
+class TestStageQueue(unittest.TestCase):
+
+    def test_DropPolicies(self):
+
+        #A drop_oldest queue keeps the newest items and counts what it threw away, a block queue
+        #gives up on a put once the pipeline stops running
+
+        running = threading.Event()
+        dropping = pipeline.StageQueue("test", maxsize=2, policy=pipeline.DROP_OLDEST)
+        for i in range(5):
+            dropping.put(i, running)
+        self.assertEqual([dropping.get(), dropping.get()], [3, 4])
+        self.assertEqual(dropping.stats["dropped"], 3)
+
+        blocking = pipeline.StageQueue("test", maxsize=1, policy=pipeline.BLOCK)
+        self.assertTrue(blocking.put(1, running))
+        self.assertFalse(blocking.put(2, running))
+
+        with self.assertRaises(ValueError):
+            pipeline.StageQueue("test", policy="sometimes")
+
+
+class TestSharedSlotRing(unittest.TestCase):
+
+    def test_WriteAndOverwrite(self):
+
+        #Readers get back exactly what was written, and a sequence number whose slot has since
+        #been reused reads as gone instead of giving back the newer frame
+
+        ring = shared_frames.SharedSlotRing.create(2, 16)
+        try:
+            reader = shared_frames.SharedSlotRing.attach(ring.name, 2, 16)
+            first = ring.write(b"hello", timestamp=1.5)
+            self.assertEqual(reader.read(first), (b"hello", 1.5))
+
+            ring.write(b"there")
+            third = ring.write(np.arange(4, dtype=np.uint8))
+            self.assertEqual(reader.latest_seq(), third)
+            self.assertEqual(reader.read(first), (None, None))
+            self.assertEqual(reader.read(third)[0], bytes([0, 1, 2, 3]))
+            self.assertIsNone(ring.write(bytes(17)))
+
+            #A write whose source changed while it was being copied leaves nothing behind to read
+            self.assertIsNone(ring.write(b"torn", check=lambda: False))
+            self.assertEqual(reader.latest_seq(), third)
+            self.assertEqual(reader.read(third + 1), (None, None))
+            reader.close()
+        finally:
+            ring.close()
+
+
+class TestCameras(unittest.TestCase):
+
+    def test_RegistryBudget(self):
+
+        #The detector threads are shared out between the cameras, and only as many cameras
+        #as the process budget allows get their own process
+
+        registry = cameras.CameraRegistry((800, 600), (800, 600), thread_budget=4, process_budget=1)
+        registry.load([{"id": 2, "name": "Back", "source": "1"}, {"id": 1, "name": "Front", "source": "DEFAULT"}])
+
+        self.assertEqual([camera.id for camera in registry], [1, 2])
+        self.assertEqual(registry.get().name, "Front")
+        self.assertEqual(registry.plan(registry.get(1))[0], True)
+        self.assertEqual(registry.plan(registry.get(2))[0], False)
+        self.assertEqual(cameras.parse_camera_source("DEFAULT"), 0)
+        self.assertEqual(cameras.parse_camera_source("1"), 1)
+        self.assertEqual(cameras.parse_camera_source("rtsp://cam/stream"), "rtsp://cam/stream")
+
+    def test_EngineThatDoesntFit(self):
+
+        #A camera the frame bus has no room for gives back what it got before it ran out, so the
+        #next one isn't turned away because of it
+
+        bus = pipeline.frame_bus()
+        registry = cameras.CameraRegistry((320, 240), (320, 240), process_budget=0)
+        registry.load([{"id": 999, "name": "Spare", "source": "DEFAULT"}])
+        camera = registry.get(999)
+
+        #Leave room for one display frame, so the display queue gets something and the detect queue doesn't
+        before = bus.stats["reserved_bytes"]
+        bus.reserve("test filler", bus.budget - before - 320 * 240 * 3)
+        try:
+            with self.assertRaises(pipeline.FrameBusFull):
+                registry.create_engine(camera, lambda msg, timestamp: None)
+            self.assertIsNone(camera.vision)
+            self.assertFalse([name for name in bus.stats["consumers"] if name.startswith(pipeline.bus_prefix(999))])
+        finally:
+            bus.release("test filler")
+        self.assertEqual(bus.stats["reserved_bytes"], before)
+
+    def test_AlertsTaggedWithCamera(self):
+        with tempfile.TemporaryDirectory() as folder:
+            conn, cursor = dbutils.load_database(os.path.join(folder, "test.db"))
+            front = dbutils.add_camera(conn, cursor, "Front", 0)
+            back = dbutils.add_camera(conn, cursor, "Back", "rtsp://cam/stream")
+
+            dbutils.create_recording(conn, cursor, "Front door", front)
+            _, alert_id = dbutils.create_recording(conn, cursor, "Back door", back)
+
+            self.assertEqual([a["description"] for a in dbutils.get_alerts_data(conn, cursor, 5, 1, back)], ["Back door"])
+            self.assertEqual(len(dbutils.get_alerts_data(conn, cursor, 5, 1)), 2)
+            self.assertEqual(dbutils.get_alert_details(conn, cursor, alert_id)["camera_id"], back)
+            conn.close()
+
+
+class TestSegments(unittest.TestCase):
+
+    def test_AlertsPointIntoSegments(self):
+        with tempfile.TemporaryDirectory() as folder:
+            conn, cursor = dbutils.load_database(os.path.join(folder, "test.db"))
+            first = dbutils.add_segment(conn, cursor, 1, "segments/1/a.mp4", 100.0)
+            dbutils.finish_segment(conn, cursor, first, 160.0, 1000)
+            second = dbutils.add_segment(conn, cursor, 1, "segments/1/b.mp4", 160.0)
+
+            #The segment still being written has no end yet, and a time before any footage gets the first segment
+            self.assertEqual(dbutils.find_segment(conn, cursor, 1, 150.0), (first, 100.0))
+            self.assertEqual(dbutils.find_segment(conn, cursor, 1, 500.0), (second, 160.0))
+            self.assertEqual(dbutils.find_segment(conn, cursor, 1, 50.0), (first, 100.0))
+            self.assertIsNone(dbutils.find_segment(conn, cursor, 2, 150.0))
+
+            alert_id = dbutils.create_segment_alert(conn, cursor, "Front door", 1, first, 45.0)
+            details = dbutils.get_alert_details(conn, cursor, alert_id)
+            self.assertTrue(details["video"].startswith("clip_"))
+            dbutils.finish_segment_alert(conn, cursor, alert_id, 30.0)
+
+            recording_id = int(details["video"][len("clip_"):-len(".mp4")])
+            self.assertEqual(dbutils.get_alert_clip(conn, cursor, recording_id), {"camera_id": 1, "start_time": 145.0, "clip_seconds": 30.0})
+            self.assertEqual([row[0] for row in dbutils.get_segments(conn, cursor, 1, 145.0, 175.0)], ["segments/1/a.mp4", "segments/1/b.mp4"])
+
+            #Only finished segments get recycled, oldest first, and the alert's footage and clips go with them
+            self.assertEqual(dbutils.expire_segments(conn, cursor, max_bytes=500),
+                             (["segments/1/a.mp4"], [dbutils.clip_path(recording_id), dbutils.partial_clip_path(recording_id)]))
+            self.assertIsNone(dbutils.get_alert_clip(conn, cursor, recording_id))
+            self.assertEqual(dbutils.expire_segments(conn, cursor, max_bytes=500), ([], []))
+            conn.close()
+
+    @unittest.skipUnless(shutil.which("ffmpeg"), "needs ffmpeg")
+    def test_CutClip(self):
+        with tempfile.TemporaryDirectory() as folder:
+            conn, cursor = dbutils.load_database(os.path.join(folder, "test.db"))
+            os.makedirs(os.path.join(folder, "segments"))
+            writer = recorder.FFmpegRecordingWriter(os.path.join(folder, "segments", "a.mp4"), (64, 48), fps=10)
+            for i in range(40):
+                writer.write(np.full((48, 64, 3), i * 4, np.uint8), 1000.0 + i / 10)
+            self.assertTrue(writer.release())
+
+            segment_id = dbutils.add_segment(conn, cursor, 1, "segments/a.mp4", 1000.0)
+            alert_id = dbutils.create_segment_alert(conn, cursor, "Front door", 1, segment_id, 1.0)
+            recording_id = int(dbutils.get_alert_details(conn, cursor, alert_id)["video"][len("clip_"):-len(".mp4")])
+
+            #Everyone asking for a clip that's still going at once gets the same cut, and nothing is left lying around
+            paths = []
+            def cut():
+                thread_conn, thread_cursor = dbutils.load_database(os.path.join(folder, "test.db"))
+                paths.append(segments.cut_clip(thread_conn, thread_cursor, recording_id, folder, partial_seconds=60))
+                thread_conn.close()
+            threads = [threading.Thread(target=cut) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            partial = os.path.join(folder, dbutils.partial_clip_path(recording_id))
+            self.assertEqual(paths, [partial] * 4)
+            cut_at = os.path.getmtime(partial)
+            self.assertEqual(segments.cut_clip(conn, cursor, recording_id, folder, partial_seconds=60), partial)
+            self.assertEqual(os.path.getmtime(partial), cut_at)
+            self.assertEqual(sorted(os.listdir(folder)), sorted([os.path.basename(partial), "segments", "test.db"]))
+
+            #Once the alert is over its whole clip is cut, and that one is kept
+            dbutils.finish_segment(conn, cursor, segment_id, 1004.0, 1000)
+            dbutils.finish_segment_alert(conn, cursor, alert_id, 2.0)
+            #(finish_segment_alert only tidies up the real recordings folder)
+            os.remove(partial)
+            clip = segments.cut_clip(conn, cursor, recording_id, folder)
+            self.assertEqual(clip, os.path.join(folder, dbutils.clip_path(recording_id)))
+            video = cv.VideoCapture(clip)
+            count = 0
+            while video.read()[0]:
+                count += 1
+            video.release()
+            self.assertGreaterEqual(count, 20)
+
+            #The clip that's been cut is what gets sent until its footage is recycled, and then it goes with it
+            self.assertEqual(segments.cut_clip(conn, cursor, recording_id, folder), clip)
+            expired, clips = dbutils.expire_segments(conn, cursor, max_bytes=1)
+            for path in expired + clips:
+                if os.path.exists(os.path.join(folder, path)):
+                    os.remove(os.path.join(folder, path))
+            self.assertIsNone(segments.cut_clip(conn, cursor, recording_id, folder))
+            self.assertEqual(sorted(os.listdir(folder)), ["segments", "test.db"])
+            conn.close()
+
+
+class TestFrameRing(unittest.TestCase):
+
+    def test_PreRollAndOverwrite(self):
+
+        #Frames come back by sequence number from the timestamp asked for, and
+        #a frame that has been overwritten reads as None instead of the newer one
+
+        ring = pipeline.FrameRing(4, (2, 2, 3))
+        for i in range(6):
+            ring.write(np.full((2, 2, 3), i, np.uint8), 10.0 + i)
+
+        out = np.empty(ring.shape, np.uint8)
+        self.assertEqual(ring.oldest(), 3)
+        self.assertEqual(ring.find(13.5), 5)
+        self.assertEqual(ring.read(5, out), 14.0)
+        self.assertEqual(out[0, 0, 0], 4)
+        self.assertIsNone(ring.read(2, out))
+        self.assertEqual(ring.find(100.0), 7)
+        self.assertFalse(ring.wait(7, timeout=0.01))
+
+        #A torn frame is thrown away, and the slot it was copied into reads as gone rather than a mix of frames
+        self.assertIsNone(ring.write(np.full((2, 2, 3), 9, np.uint8), 20.0, check=lambda: False))
+        self.assertEqual(ring.latest, 6)
+        self.assertIsNone(ring.read(3, out))
+        self.assertEqual(ring.write(np.full((2, 2, 3), 9, np.uint8), 20.0, check=lambda: True), 7)
+
+    def test_FrameRate(self):
+        #The rate comes from the capture times of the last second of frames
+        ring = pipeline.FrameRing(50, (2, 2, 3))
+        self.assertIsNone(ring.frame_rate())
+        for i in range(40):
+            ring.write(np.zeros((2, 2, 3), np.uint8), 100.0 + i * 0.1)
+        self.assertAlmostEqual(ring.frame_rate(), 10.0)
+
+
+class TestFrameBus(unittest.TestCase):
+
+    def test_ByteBudget(self):
+
+        #A queue on the bus is full once its bytes are used up, however few items are
+        #in it, and the bus adds up the bytes across all of its consumers
+
+        running = threading.Event()
+        frame = np.zeros((10, 10, 3), np.uint8)
+        bus = pipeline.FrameBus(5 * frame.nbytes)
+        display = bus.queue("camera 1/display", frame.nbytes, maxsize=2, policy=pipeline.DROP_OLDEST)
+
+        for i in range(5):
+            display.put((i, frame.copy()), running)
+        self.assertEqual(display.qsize(), 2)
+        self.assertEqual(display.stats["dropped"], 3)
+        self.assertEqual(display.get()[0], 3)
+        self.assertEqual(bus.stats["bytes"], frame.nbytes)
+        self.assertEqual(bus.stats["peak_bytes"], 2 * frame.nbytes)
+
+        #Frames that could never fit are turned away, and a ring gets cut down to what's left of the budget
+        self.assertFalse(display.put(np.zeros((20, 20, 3), np.uint8), running))
+        self.assertEqual(bus.ring("camera 1/recording", 10, frame.shape).slots, 3)
+        self.assertEqual(bus.stats["reserved_bytes"], bus.budget)
+
+    def test_SharedBetweenCameras(self):
+        #Every camera's reservations come out of the same budget, one that wouldn't even get two frames is turned
+        #away instead of going over, and a camera's share comes back once it's closed
+        frame = np.zeros((10, 10, 3), np.uint8)
+        bus = pipeline.FrameBus(6 * frame.nbytes)
+        bus.ring("camera 1/recording", 4, frame.shape)
+        bus.reserve("camera 1/raw shared memory", frame.nbytes)
+
+        with self.assertRaises(ValueError):
+            bus.ring("camera 2/recording", 4, frame.shape)
+        self.assertEqual(bus.stats["reserved_bytes"], 5 * frame.nbytes)
+
+        bus.release("camera 1/")
+        self.assertEqual(bus.ring("camera 2/recording", 4, frame.shape).slots, 4)
+        self.assertEqual(list(bus.stats["consumers"]), ["camera 2/recording"])
+
+    def test_PreRoll(self):
+        #The shipped defaults keep all of the pre-roll, even recording a 720p main stream in a vision process
+        engine = vision_process.VisionProcess(0, (800, 600), (800, 600), lambda msg, timestamp: None, camera_id="defaults",
+                                              record_source="rtsp://camera/main", record_size=utils.get_record_resolution())
+        try:
+            self.assertEqual(engine.pre_roll, 3.0)
+            self.assertEqual(engine.recording_ring.slots, vision.recording_slots(3.0))
+        finally:
+            engine.close()
+
+        #One that doesn't fit is cut down to what the buffer holds, after the second for catching up
+        self.assertEqual(vision.fitted_pre_roll(pipeline.FrameRing(60, (2, 2, 3)), 3.0), 1.0)
+        self.assertEqual(vision.fitted_pre_roll(pipeline.FrameRing(120, (2, 2, 3)), 3.0), 3.0)
+
+
+class TestDetectorParams(unittest.TestCase):
+
+    def test_Validation(self):
+        self.assertEqual(utils.validate_detector_params(0, {"bufsize": 5.0}), {"bufsize": 5})
+        self.assertEqual(utils.validate_detector_params(1, {"detect_shadows": False, "var_threshold": 25}), {"detect_shadows": False, "var_threshold": 25.0})
+
+        #True isn't 1, 7.9 isn't 7 and "5" isn't a number at all
+        for method, params in [(0, {"history": 10}), (0, {"bufsize": 0}), (1, {"detect_shadows": "no"}), (2, {}),
+                               (0, {"bufsize": True}), (0, {"bufsize": 7.9}), (0, {"bufsize": "5"}), (1, {"history": 10.5}),
+                               (1, {"var_threshold": False}), (1, {"var_threshold": "16"}), (1, {"var_threshold": float("nan")})]:
+            with self.assertRaises(ValueError):
+                utils.validate_detector_params(method, params)
+
+        detector = utils.create_object_detector(0, threads=1, params={"bufsize": 3, "shadow_threshold": 10})
+        self.assertEqual(detector.background_buffer.bufsize, 3)
+        self.assertEqual(detector.shadow_threshold, 10)
+
+
+class TestCameraOpen(unittest.TestCase):
+
+    def test_RetryUntilStopped(self):
+        #A camera that isn't there gets retried with a growing delay, and stopping doesn't wait out the delay
+        engine = vision.VisionPipeline("/tmp/no_such_camera.avi", (32, 24), (32, 24), lambda msg, timestamp: None, pre_roll=0)
+        engine.retry_min, engine.retry_max = 0.05, 0.2
+        engine.running.set()
+        capture = threading.Thread(target=engine.capture_frames)
+        capture.start()
+
+        threading.Event().wait(0.6)
+        self.assertEqual(engine.camera_state, "opening")
+        self.assertGreaterEqual(engine.open_attempts, 3)
+        self.assertIsNone(engine.first_frame_at)
+
+        engine.running.clear()
+        capture.join(timeout=1)
+        self.assertFalse(capture.is_alive())
+        engine.close()
+
+
+class LiveBackend(capture.CaptureBackend):
+    #A capture backend with a new frame every 1/fps seconds, that counts how many it had to convert. With fps=0
+    #it never has a frame at all, and waits for one until it's released like a stalled network stream
+    def __init__(self, size, fps=200, can_grab=True):
+        super().__init__("live", size)
+        self.can_grab = can_grab
+        self.interval = 1.0 / fps if fps else None
+        self.opened = True
+        self.released = threading.Event()
+        self.grabs = 0
+        self.retrieves = 0
+
+    def isOpened(self):
+        return self.opened
+
+    def grab(self):
+        if self.interval is None:
+            self.released.wait(5)
+            return False
+        threading.Event().wait(self.interval)
+        self.grabs += 1
+        return True
+
+    def retrieve(self):
+        self.retrieves += 1
+        self.buffer[:] = self.grabs % 256
+        return True, self.buffer
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def release(self):
+        self.opened = False
+        self.released.set()
+
+
+class TestCapture(unittest.TestCase):
+
+    def read_slowly(self, backend, reads=5):
+        grabber = capture.LatestFrameGrabber(backend)
+        for _ in range(reads):
+            threading.Event().wait(0.05)
+            success, frame = grabber.read()
+            self.assertTrue(success)
+            self.assertEqual(frame.shape, (24, 32, 3))
+        grabber.release()
+        return grabber
+
+    def test_GrabberOnlyConvertsWhatItDelivers(self):
+        #Reading slower than the camera sends, we get the newest frames and skip the rest without converting them
+        backend = LiveBackend((32, 24))
+        grabber = self.read_slowly(backend)
+        self.assertEqual(grabber.delivered, 5)
+        self.assertGreater(grabber.dropped, 20)
+        self.assertEqual(grabber.grabbed, backend.grabs)
+        self.assertLessEqual(backend.retrieves, grabber.delivered + 1)
+        self.assertEqual(grabber.grabbed, grabber.delivered + grabber.dropped + int(grabber.fresh))
+
+        #A backend that can't skip frames has every one of them read in full, and the counts add up the same way
+        backend = LiveBackend((32, 24), can_grab=False)
+        grabber = self.read_slowly(backend)
+        self.assertEqual(grabber.delivered, 5)
+        self.assertEqual(backend.retrieves, backend.grabs)
+        self.assertEqual(grabber.grabbed, grabber.delivered + grabber.dropped + int(grabber.fresh))
+
+    @unittest.skipUnless(shutil.which("ffmpeg"), "needs ffmpeg")
+    def test_FFmpegPipe(self):
+        #ffmpeg hands us every frame already scaled and in BGR, all in the one buffer, and then says when it's done
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "in.mp4")
+            writer = recorder.FFmpegRecordingWriter(path, (64, 48), fps=10)
+            for i in range(20):
+                writer.write(np.full((48, 64, 3), 40 + i * 8, np.uint8))
+            self.assertTrue(writer.release())
+
+            backend = capture.FFmpegPipeCapture(path, (32, 24))
+            self.assertTrue(backend.isOpened())
+            levels = []
+            while True:
+                success, frame = backend.read()
+                if not success:
+                    break
+                self.assertIs(frame, backend.buffer)
+                self.assertEqual(frame.shape, (24, 32, 3))
+                levels.append(int(frame.mean()))
+            backend.release()
+            self.assertFalse(backend.isOpened())
+
+            self.assertEqual(len(levels), 20)
+            for i, level in enumerate(levels):
+                self.assertAlmostEqual(level, 40 + i * 8, delta=6)
+
+        #A source that isn't there just never has a frame
+        backend = capture.FFmpegPipeCapture(os.path.join(folder, "missing.mp4"), (32, 24))
+        self.assertEqual(backend.read(), (False, None))
+        backend.release()
+
+    def test_ReleaseWhileWaiting(self):
+        #Somebody waiting on a camera with nothing to give is let go as soon as it's released
+        grabber = capture.LatestFrameGrabber(LiveBackend((32, 24), fps=0), timeout=10)
+        results = []
+        reader = threading.Thread(target=lambda: results.append((grabber.read(), time.time())))
+        reader.start()
+        threading.Event().wait(0.2)
+
+        released_at = time.time()
+        grabber.release()
+        reader.join(timeout=5)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(results[0][0], (False, None))
+        self.assertLess(results[0][1] - released_at, 1.0)
+        self.assertFalse(grabber.isOpened())
+
+
+class TestVisionProcess(unittest.TestCase):
+
+    def test_DetectorStatesOutliveTheWorker(self):
+        #The background a worker learned comes back when it stops, and the next worker starts from it
+        detector = utils.create_object_detector(0, threads=1)
+        for i in range(3):
+            detector.iterate(np.full((24, 32, 3), i * 40, np.uint8))
+        state = detector.get_state()
+
+        engine = vision_process.VisionProcess("/tmp/no_such_camera.avi", (32, 24), (32, 24), lambda msg, timestamp: None,
+                                              camera_id="states", detector_threads=1, pre_roll=0)
+        try:
+            engine.detector_states = {0: state}
+            for _ in range(2):
+                sent = engine.detector_states
+                engine.start()
+                threading.Event().wait(0.5)
+                engine.stop()
+                self.assertIsNot(engine.detector_states, sent)
+                self.assertTrue(np.array_equal(engine.detector_states[0]["frames"], state["frames"]))
+        finally:
+            engine.close()
+
+
+class SteadyCamera:
+    #Stands in for a camera that has a new frame every 1/fps seconds. With moving=True, a block comes into view
+    #after the first 20 frames, crosses most of the way over it and is gone again 60 frames later
+    def __init__(self, size, fps=100, moving=False):
+        self.size = size
+        self.frame = np.zeros((size[1], size[0], 3), np.uint8)
+        self.interval = 1.0 / fps
+        self.moving = moving
+        self.reads = 0
+
+    def isOpened(self):
+        return True
+
+    def read(self):
+        threading.Event().wait(self.interval)
+        self.reads += 1
+        if self.moving:
+            self.frame[:] = 60
+            if 20 < self.reads <= 80:
+                x = (self.reads - 20) * (self.size[0] - 40) // 60
+                self.frame[self.size[1] // 2 - 20:self.size[1] // 2 + 20, x:x + 40] = 255
+        return True, self.frame
+
+    def release(self):
+        pass
+
+
+class TestIdleCapture(unittest.TestCase):
+
+    def run_idle(self, record_while_idle):
+        #Runs the capture stage on an idle scene for a bit, and returns how many frames the camera gave, how
+        #many went into the recording buffer, and how many went on to detection
+        engine = vision.VisionPipeline("steady", (32, 24), (32, 24), lambda msg, timestamp: None, pre_roll=2)
+        engine.idle_policy = utils.IdlePolicy(idle_after=0.05, idle_fps=2)
+        engine.record_while_idle = record_while_idle
+        camera = SteadyCamera((32, 24))
+        engine.open_camera = lambda source, size: camera
+        engine.started_at = time.time()
+        engine.running.set()
+
+        def drain():
+            while engine.running.is_set():
+                try:
+                    engine.detect_queue.get()
+                except Exception:
+                    pass
+
+        threads = [threading.Thread(target=engine.capture_frames), threading.Thread(target=drain)]
+        for thread in threads:
+            thread.start()
+        threading.Event().wait(1.0)
+        engine.running.clear()
+        for thread in threads:
+            thread.join(timeout=1)
+        engine.close()
+        return camera.reads, engine.recording_ring.latest, engine.detect_queue.stats["put"]
+
+    def test_ViewersAndIdle(self):
+        #With nobody watching and nothing moving the pipeline goes idle and stops drawing frames, and a viewer
+        #turning up puts it straight back to full speed
+        engine = vision.VisionPipeline("steady", (32, 24), (32, 24), lambda msg, timestamp: None, pre_roll=1)
+        engine.idle_policy = utils.IdlePolicy(idle_after=0.3, idle_fps=2)
+        engine.record_while_idle = False
+        camera = SteadyCamera((32, 24))
+        engine.open_camera = lambda source, size: camera
+        engine.start()
+        try:
+            threading.Event().wait(0.8)
+            self.assertTrue(engine.idle_policy.idle)
+            self.assertEqual(engine.idle_policy.idle_periods, 1)
+            self.assertGreater(engine.unwatched_frames, 0)
+            self.assertEqual(engine.captured_seq, 0)
+
+            reads = camera.reads
+            threading.Event().wait(0.5)
+            self.assertLessEqual(camera.reads - reads, 3)
+
+            engine.add_viewer()
+            engine.add_viewer()
+            self.assertEqual(engine.viewers, 2)
+            seq, jpeg = engine.wait_for_jpeg(0, timeout=2)
+            self.assertIsNotNone(jpeg)
+            self.assertFalse(engine.idle_policy.idle)
+            reads = camera.reads
+            threading.Event().wait(0.5)
+            self.assertGreater(camera.reads - reads, 20)
+
+            #The count never goes below nobody
+            for _ in range(3):
+                engine.remove_viewer()
+            self.assertEqual(engine.viewers, 0)
+
+            #Left alone again, it goes back to idle
+            threading.Event().wait(0.8)
+            self.assertTrue(engine.idle_policy.idle)
+            self.assertEqual(engine.idle_policy.idle_periods, 2)
+        finally:
+            engine.close()
+
+        #The last viewer leaving forgets the frame they were shown, so the next one doesn't start with it
+        engine.add_viewer()
+        engine.captured_frame = camera.frame
+        engine.remove_viewer()
+        self.assertIsNone(engine.captured_frame)
+
+    def test_ContinuousRecordingKeepsEveryFrame(self):
+        #Idle on its own slows the whole capture stage down
+        reads, recorded, detected = self.run_idle(False)
+        self.assertLess(reads, 20)
+        self.assertEqual(recorded, detected)
+
+        #With continuous recording the recording buffer still gets every frame, and only detection is thinned out
+        reads, recorded, detected = self.run_idle(True)
+        self.assertGreater(recorded, 40)
+        self.assertEqual(recorded, reads)
+        self.assertLess(detected, 20)
+
+
+class TestPipelineStages(unittest.TestCase):
+
+    def test_EndToEnd(self):
+        #Frames go from the camera through detection and annotation to the live view, the recording buffer gets
+        #a copy of each, and something moving across the scene gets tracked and raises an alert
+        messages = []
+        engine = vision.VisionPipeline("moving", (320, 240), (320, 240), lambda msg, timestamp: messages.append((msg, timestamp)), pre_roll=1)
+        camera = SteadyCamera((320, 240), fps=50, moving=True)
+        engine.open_camera = lambda source, size: camera
+        engine.add_viewer()
+        started_at = time.time()
+        engine.start()
+        try:
+            seq, jpeg = engine.wait_for_jpeg(0, timeout=2)
+            self.assertIsNotNone(jpeg)
+            self.assertEqual(cv.imdecode(np.frombuffer(jpeg, np.uint8), cv.IMREAD_COLOR).shape, (240, 320, 3))
+            self.assertEqual(engine.wait_for_jpeg(seq, timeout=2)[0], seq + 1)
+
+            deadline = time.time() + 5
+            while not messages and time.time() < deadline:
+                threading.Event().wait(0.1)
+            self.assertTrue(messages)
+            self.assertGreaterEqual(messages[0][1], started_at)
+            self.assertIsNotNone(engine.last_motion_at)
+
+            for stage in ("capture", "detect", "annotate", "pass"):
+                self.assertTrue(engine.is_alive(stage))
+            self.assertGreater(engine.recording_ring.latest, 0)
+            self.assertGreater(engine.detect_queue.stats["put"], 0)
+            self.assertGreater(engine.annotate_queue.stats["put"], 0)
+        finally:
+            engine.stop()
+            engine.close()
+
+        #Stopping finishes every stage off and leaves nothing behind in the queues
+        self.assertEqual(engine.threads, {})
+        self.assertEqual(engine.detect_queue.qsize() + engine.annotate_queue.qsize() + engine.frame_queue.qsize(), 0)
+        self.assertIn(0, engine.detector_states)
+
+
+@unittest.skipUnless(stream is not None, "needs stream.py to import")
+class TestServer(unittest.TestCase):
+
+    @unittest.skipUnless(os.path.isdir("/app/db"), "needs the database folder")
+    def test_ReadyOnceCamerasStream(self):
+        #The API answers straight away, and says it isn't ready (503) until the camera has sent its first frame
+        registry = cameras.CameraRegistry((32, 24), (32, 24), process_budget=0)
+        original = stream.cameras, dict(stream.startup), stream.filming_event.is_set()
+        stream.cameras = registry
+        stream.startup.update(http_at=time.time(), ready_at=None)
+        stream.filming_event.set()
+        client = stream.app.test_client()
+        engine = None
+        try:
+            self.assertEqual(client.get("/api/ready").status_code, 503)
+
+            registry.load([{"id": 1, "name": "Test", "source": "steady"}])
+            camera = registry.get(1)
+            engine = camera.vision = vision.VisionPipeline("steady", (32, 24), (32, 24), lambda msg, timestamp: None, camera_id=1, pre_roll=1)
+            engine.open_camera = lambda source, size: threading.Event().wait(0.5) or SteadyCamera(size)
+            engine.start()
+
+            response = client.get("/api/ready")
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.get_json()["cameras"]["1"]["camera_state"], "opening")
+            self.assertFalse(response.get_json()["subsystems"]["cameras"])
+            self.assertIsNone(response.get_json()["time_to_ready"])
+
+            deadline = time.time() + 3
+            while response.status_code != 200 and time.time() < deadline:
+                threading.Event().wait(0.05)
+                response = client.get("/api/ready")
+            self.assertEqual(response.status_code, 200)
+            status = response.get_json()
+            self.assertTrue(status["ready"])
+            self.assertEqual(status["cameras"]["1"]["camera_state"], "streaming")
+            self.assertGreaterEqual(status["cameras"]["1"]["time_to_first_frame"], 0.5)
+            self.assertIsNotNone(status["time_to_ready"])
+        finally:
+            if engine is not None:
+                engine.close()
+            stream.cameras, startup, filming = original
+            stream.startup.update(startup)
+            if not filming:
+                stream.filming_event.clear()
+
+    def test_RecordingHeaders(self):
+        #A finished recording can be cached for good, seeked with ranges and checked with its ETag. One still being
+        #written can be seeked but not cached or checked, and a partial clip is always sent whole
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, "rec.mp4"), "wb") as f:
+                f.write(bytes(range(256)) * 4)
+
+            def send(headers=None, **kwargs):
+                with stream.app.test_request_context(headers=headers or {}):
+                    response = stream.send_recording(folder, "rec.mp4", mimetype="video/mp4", **kwargs)
+                    response.direct_passthrough = False
+                    data = response.get_data()
+                    response.close()
+                    return response, data
+
+            response, data = send()
+            self.assertEqual((response.status_code, len(data)), (200, 1024))
+            self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+            self.assertTrue(response.cache_control.immutable)
+            self.assertEqual(response.cache_control.max_age, stream.recording_cache_seconds)
+            etag = response.headers["ETag"]
+
+            response, data = send({"Range": "bytes=100-199"})
+            self.assertEqual((response.status_code, data), (206, bytes(range(100, 200))))
+            self.assertEqual(response.headers["Content-Range"], "bytes 100-199/1024")
+            self.assertEqual(send({"If-None-Match": etag})[0].status_code, 304)
+            self.assertEqual(send({"Range": "bytes=0-9", "If-Range": etag})[0].status_code, 206)
+            self.assertEqual(send({"Range": "bytes=0-9", "If-Range": '"something-else"'})[0].status_code, 200)
+
+            response, data = send({"Range": "bytes=0-9"}, finished=False)
+            self.assertEqual((response.status_code, len(data)), (206, 10))
+            self.assertNotIn("ETag", response.headers)
+            self.assertNotIn("Last-Modified", response.headers)
+            self.assertFalse(response.cache_control.immutable)
+            self.assertIsNone(response.cache_control.max_age)
+            self.assertEqual(send({"Range": "bytes=0-9", "If-Range": etag}, finished=False)[0].status_code, 200)
+
+            response, data = send({"Range": "bytes=0-9"}, finished=False, ranges=False)
+            self.assertEqual((response.status_code, len(data)), (200, 1024))
+            self.assertNotIn("Accept-Ranges", response.headers)
+
+
+class TestRecorder(unittest.TestCase):
+
+    @unittest.skipUnless(shutil.which("ffmpeg"), "needs ffmpeg")
+    def test_PlayableWhileRecording(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "rec.mp4")
+            writer = recorder.FFmpegRecordingWriter(path, (64, 48), fps=10)
+            frames = [np.full((48, 64, 3), i * 8, np.uint8) for i in range(30)]
+            for frame in frames:
+                self.assertTrue(writer.write(frame))
+
+            #The wrong size is turned away instead of scrambling the stream
+            self.assertFalse(writer.write(np.zeros((10, 10, 3), np.uint8)))
+
+            #Fragments are on disk before the recording is finished
+            threading.Event().wait(1.0)
+            self.assertGreater(os.path.getsize(path), 0)
+
+            self.assertTrue(writer.release())
+            video = cv.VideoCapture(path)
+            count = 0
+            while video.read()[0]:
+                count += 1
+            video.release()
+            self.assertEqual(count, 30)
+
+    @unittest.skipUnless(shutil.which("ffmpeg"), "needs ffmpeg")
+    def test_FollowsCaptureTimes(self):
+        #Frames with capture times are repeated or left out to put them where they belong in a constant fps video
+        with tempfile.TemporaryDirectory() as folder:
+            writer = recorder.FFmpegRecordingWriter(os.path.join(folder, "rec.mp4"), (64, 48), fps=10)
+            frame = np.zeros((48, 64, 3), np.uint8)
+            for timestamp in [50.0, 50.1, 50.5, 50.52, 50.6]:
+                writer.write(frame, timestamp)
+            self.assertTrue(writer.release())
+            self.assertEqual(writer.frames, 7)
+            self.assertEqual(writer.repeated, 3)
+            self.assertEqual(writer.skipped, 1)
+
+    @unittest.skipUnless(shutil.which("ffmpeg"), "needs ffmpeg")
+    def test_Faststart(self):
+        #Once it's finished, the recording's index comes before its frames and it isn't in fragments anymore
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "rec.mp4")
+            writer = recorder.FFmpegRecordingWriter(path, (64, 48), fps=10)
+            for i in range(20):
+                writer.write(np.full((48, 64, 3), i * 8, np.uint8))
+            self.assertTrue(writer.release())
+            self.assertIn(b"moof", open(path, "rb").read())
+
+            self.assertTrue(recorder.faststart(path))
+            data = open(path, "rb").read()
+            self.assertNotIn(b"moof", data)
+            self.assertLess(data.index(b"moov"), data.index(b"mdat"))
+            self.assertEqual(os.listdir(folder), ["rec.mp4"])
+
+            video = cv.VideoCapture(path)
+            count = 0
+            while video.read()[0]:
+                count += 1
+            video.release()
+            self.assertEqual(count, 20)
+
+
+class TestPostProcessor(unittest.TestCase):
+
+    def test_PriorityAndOverflow(self):
+        processor = postprocess.PostProcessor(workers=1, max_jobs=2)
+        gate = threading.Event()
+        order = []
+
+        #Hold the only worker up while the queue fills, user recordings should jump ahead of alerts
+        processor.submit(postprocess.ALERT, "hold", gate.wait)
+        threading.Event().wait(0.1)
+        processor.submit(postprocess.ALERT, "alert", order.append, "alert")
+        processor.submit(postprocess.USER, "user", order.append, "user")
+
+        #With the queue full, the job is done there and then instead of being dropped
+        processor.submit(postprocess.ALERT, "overflow", order.append, "overflow")
+        self.assertEqual(order, ["overflow"])
+
+        gate.set()
+        self.assertTrue(processor.wait(timeout=2))
+        self.assertEqual(order, ["overflow", "user", "alert"])
+        self.assertEqual(processor.stats["ran_inline"], 1)
+        self.assertEqual(processor.stats["done"], 4)
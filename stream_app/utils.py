@@ -1,10 +1,14 @@
 import cv2 as cv
 import numpy as np
-import queue
-from collections import deque
-from functools import reduce
+from functools import partial
 from decouple import config
 import socket
+import time
+import pickle
+import os
+import fcntl
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 def get_camera_feed_source():
     #This allows me to read it from my environment variable in my dockerfile
@@ -15,6 +19,49 @@ def get_camera_feed_source():
     else:
         return source
 
+#The detection thresholds below were all tuned on frames resized to 800x600, so we keep them
+#expressed at that size and scale them to whatever resolution we are actually running at
+REFERENCE_RESOLUTION = (800, 600)
+
+def parse_resolution(value):
+    #Resolutions are written as WIDTHxHEIGHT, e.g. 800x600
+    width, height = str(value).lower().split("x")
+    return (int(width), int(height))
+
+def get_display_resolution():
+    #This is the size we stream, draw on and record at
+    return parse_resolution(config("DISPLAY_RESOLUTION", default="800x600"))
+
+def get_detection_resolution():
+    #This is the size the object detectors work on. It defaults to the display size, but setting it lower
+    #(e.g. 320x240) saves a lot of CPU on small boards
+    value = config("DETECTION_RESOLUTION", default=None)
+
+    if value == None or value == "DEFAULT":
+        return get_display_resolution()
+    else:
+        return parse_resolution(value)
+
+def get_record_resolution():
+    #This is the size we record at for cameras with a separate record stream, so the recordings can be a
+    #lot sharper than what we detect on. Cameras without one record at the display size
+    return parse_resolution(config("RECORD_RESOLUTION", default="1280x720"))
+
+def scale_area(area, frame_size):
+    #Areas scale with the number of pixels
+    return area * (frame_size[0] * frame_size[1]) / (REFERENCE_RESOLUTION[0] * REFERENCE_RESOLUTION[1])
+
+def scale_distance(distance, frame_size):
+    #Distances scale with the square root of the number of pixels, so this stays sensible if the aspect ratio changes
+    return distance * np.sqrt((frame_size[0] * frame_size[1]) / (REFERENCE_RESOLUTION[0] * REFERENCE_RESOLUTION[1]))
+
+def scale_contour(contour, from_size, to_size):
+    #Maps a contour found on the detection frame back onto the display frame
+    if from_size == to_size:
+        return contour
+    factors = np.array([to_size[0] / from_size[0], to_size[1] / from_size[1]], dtype=np.float32)
+    return np.round(contour * factors).astype(np.int32)
+
 #created this object class to make it easy to track objects
 class TrackedObject:
     _id_counter = 0
@@ -25,13 +72,18 @@ class TrackedObject:
         TrackedObject._id_counter += 1
         return TrackedObject._id_counter
         
-    def __init__(self, b, c, l):
+    def __init__(self, b, c, l, area=None):
         self.id = str(TrackedObject.generate_id())
         self.bounding_box = b
         self.lastSeenFrame = l
-        self.velocity = 0.0
+        #Pixels per frame in x and y, worked out from the last two times we saw the object
+        self.velocity = (0.0, 0.0)
+        #Where the object actually was the last time it was detected, bounding_box may be a prediction
+        self.detected_box = b
         self.enabled = True
-        self.contour = c
+        #The contour can be a function that makes it, since we often never need it
+        self._contour = c
+        self._area = area
         self.notified = False
 
     @property
@@ -39,9 +91,34 @@ class TrackedObject:
         x, y, w, h = self.bounding_box
         return (x + w // 2, y + h // 2)
 
+    def update(self, b, frame_count):
+        #Called when a new detection gets matched to us
+        frames = frame_count - self.lastSeenFrame
+        if frames > 0:
+            self.velocity = ((b[0] - self.detected_box[0]) / frames, (b[1] - self.detected_box[1]) / frames)
+        self.bounding_box = b
+        self.detected_box = b
+        self.lastSeenFrame = frame_count
+
+    def extrapolate(self, frame_count, max_frames=5):
+        #Moves the bounding box to where we think the object is on a frame we didn't run detection on.
+        #We only guess a few frames ahead, after that it has probably stopped or gone
+        frames = min(frame_count - self.lastSeenFrame, max_frames)
+        x, y, w, h = self.detected_box
+        self.bounding_box = (int(round(x + self.velocity[0] * frames)), int(round(y + self.velocity[1] * frames)), w, h)
+
+    @property
+    def contour(self):
+        if callable(self._contour):
+            self._contour = self._contour()
+        return self._contour
+
     @property
     def area(self):
-        return cv.contourArea(self.contour)
+        #The contour never changes once we've been created, so there's no need to keep working this out
+        if self._area is None:
+            self._area = cv.contourArea(self.contour)
+        return self._area
 
     """
     @property
@@ -66,18 +143,128 @@ class ObjectDetector:
         #This function is called on every iteration of the loop
         #It should return the current foreground mask
         raise NotImplementedError(message="Please implement the iterate function")
+
+    def update_background(self, current_frame):
+        #This is called instead of iterate on frames where we know nothing is moving, so the
+        #background model keeps up without us paying for the mask. By default we just iterate
+        self.iterate(current_frame)
+
+    def close(self):
+        #Called when the capture thread is done with the detector
+        pass
+
+    def get_state(self):
+        #Whatever the detector needs to pick up where it left off after a restart, or None
+        return None
+
+    def set_state(self, state):
+        pass
     
+class RunningMedian:
+    #Keeps the per-pixel median of the last bufsize frames without restacking them every frame. Alongside the
+    #ring of raw frames we keep the same values sorted per pixel. When a frame is pushed out we find the rank of
+    #the outgoing value, overwrite it with the incoming one, and do one compare-exchange pass up and one down to
+    #put it back in order. That's still about 3 x bufsize passes over the frame per push, so it gets slower in
+    #step with bufsize, just a lot less steeply than np.median, which had to stack, partition and average in
+    #float64 every time. Each pass is a saturating uint8 min/max into buffers we already have.
+    #The result is bit for bit what np.median(stack, axis=0).astype(np.uint8) gives, even sizes included
+
+    def __init__(self, bufsize):
+        self.bufsize = bufsize
+        self.count = 0
+        self.head = 0
+        self.shape = None
+
+    def _allocate(self, shape):
+        #Everything is flattened to 2D so that OpenCV treats it as a single channel image
+        self.shape = shape
+        rows, cols = shape[0], int(np.prod(shape[1:]))
+        self.ring = np.zeros((self.bufsize, rows, cols), np.uint8)
+        self.sorted = np.zeros((self.bufsize, rows, cols), np.uint8)
+        self.rank = np.zeros((rows, cols), np.uint8)
+        #Where each pixel's outgoing value sits in the flattened sorted buffer, worked out in place every push
+        self.offsets = np.arange(rows * cols, dtype=np.intp)
+        self.index = np.zeros(rows * cols, np.intp)
+        self.less = np.zeros((rows, cols), np.uint8)
+        self.scratch = np.zeros((rows, cols), np.uint8)
+        self.count = 0
+        self.head = 0
+
+    def reset(self):
+        self.shape = None
+        self.count = 0
+        self.head = 0
+
+    def __len__(self):
+        return self.count
+
+    def _exchange(self, k):
+        #Put slots k and k+1 in order
+        a, b = self.sorted[k], self.sorted[k + 1]
+        cv.min(a, b, dst=self.scratch)
+        cv.max(a, b, dst=b)
+        np.copyto(a, self.scratch)
+
+    def push(self, frame):
+        if frame.shape != self.shape:
+            self._allocate(frame.shape)
+
+        frame = frame.reshape(self.ring.shape[1:])
+
+        if self.count < self.bufsize:
+            #Still filling up, so the new value goes on the end and sinks down to where it belongs
+            np.copyto(self.ring[self.count], frame)
+            np.copyto(self.sorted[self.count], frame)
+            self.count += 1
+            for k in range(self.count - 2, -1, -1):
+                self._exchange(k)
+            return
+
+        outgoing = self.ring[self.head]
+
+        #The rank of the outgoing value is the number of sorted values strictly below it.
+        #The comparison gives 255 for true, and uint8 wraparound makes subtracting it the same as adding 1
+        self.rank.fill(0)
+        for k in range(self.bufsize):
+            cv.compare(self.sorted[k], outgoing, cv.CMP_LT, dst=self.less)
+            np.subtract(self.rank, self.less, out=self.rank)
+
+        np.copyto(self.index, self.rank.reshape(-1))
+        np.multiply(self.index, self.offsets.size, out=self.index)
+        np.add(self.index, self.offsets, out=self.index)
+        self.sorted.put(self.index, frame)
+        np.copyto(outgoing, frame)
+        self.head = (self.head + 1) % self.bufsize
+
+        #Only one value is out of place, so a pass in each direction is enough to restore the order
+        for k in range(self.bufsize - 1):
+            self._exchange(k)
+        for k in range(self.bufsize - 2, -1, -1):
+            self._exchange(k)
+
+    def frames(self):
+        #The frames currently in the buffer, oldest first
+        start = self.head if self.count == self.bufsize else 0
+        return [self.ring[(start + i) % self.bufsize].reshape(self.shape) for i in range(self.count)]
+
+    def median(self):
+        mid = self.count // 2
+        if self.count % 2 == 1:
+            result = self.sorted[mid].copy()
+        else:
+            result = ((self.sorted[mid - 1].astype(np.uint16) + self.sorted[mid]) // 2).astype(np.uint8)
+        return result.reshape(self.shape)
+
 class MovingMedianObjectDetector(ObjectDetector):
     #This implements a moving median object detector
     def __init__(self, bufsize=10, shadow_threshold=30):
         super().__init__()
-        self.background_buffer = deque(maxlen=bufsize)
+        self.background_buffer = RunningMedian(bufsize)
         self.shadow_threshold = shadow_threshold
 
     def generate_median_background(self):
-        #This is some numpy wizardry to get the median value of every corresponding pixel each of the stored frames in the array buffer
-        stack = np.stack(self.background_buffer, axis=0)
-        return np.median(stack, axis=0).astype(np.uint8)
+        #The running median keeps every pixel's history sorted, so this is just a lookup of the middle slot
+        return self.background_buffer.median()
     
     def generate_fgmask(self, current_frame, median_background):
 
@@ -104,9 +291,23 @@ class MovingMedianObjectDetector(ObjectDetector):
         mask = cv.medianBlur(mask, 3)
         return mask 
 
+    def update_background(self, current_frame):
+        self.background_buffer.push(current_frame)
+
+    def get_state(self):
+        if len(self.background_buffer) == 0:
+            return None
+        return {"frames": np.stack(self.background_buffer.frames(), axis=0)}
+
+    def set_state(self, state):
+        #Pushing the saved frames back in order gives us exactly the same buffer we had before
+        self.background_buffer.reset()
+        for frame in state["frames"]:
+            self.background_buffer.push(frame)
+
     def iterate(self, current_frame):
 
-        self.background_buffer.append(current_frame)        
+        self.background_buffer.push(current_frame)
         median_background = self.generate_median_background()
         fg_mask = self.generate_fgmask(current_frame, median_background)
         fg_mask = self.morphology_patch(fg_mask)
@@ -114,15 +315,31 @@ class MovingMedianObjectDetector(ObjectDetector):
         return fg_mask
     
 class OpenCVMOG2ObjectDetector(ObjectDetector):
-    #This uses openCV's built in MOG2 detector
-    def __init__(self):
+    #This uses openCV's built in MOG2 detector, the defaults are openCV's own
+    def __init__(self, history=500, var_threshold=16, detect_shadows=True):
         super().__init__()
-        self.mogger = cv.createBackgroundSubtractorMOG2()
+        self.mogger = cv.createBackgroundSubtractorMOG2(history=history, varThreshold=var_threshold, detectShadows=detect_shadows)
 
     def cleanup_mask(self, frame_to_clean):
         kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE, (3, 3))
         return cv.morphologyEx(frame_to_clean, cv.MORPH_OPEN, kernel)
 
+    def update_background(self, current_frame):
+        #MOG2 always gives us a mask, but we can at least skip cleaning it up
+        self.mogger.apply(current_frame)
+
+    def get_state(self):
+        #OpenCV doesn't let us get at the whole mixture model, but the background image it has learned is a
+        #good summary of it. The variances start over from their defaults when we load it back in
+        background = self.mogger.getBackgroundImage()
+        if background is None:
+            return None
+        return {"background": background}
+
+    def set_state(self, state):
+        #A learning rate of 1 makes the model start over from just this image
+        self.mogger.apply(state["background"], learningRate=1)
+
     def iterate(self, current_frame):
         #This is so simple, two lines of code, using openCV's built in Mixture of Gaussians detector
         fg_mask = self.mogger.apply(current_frame)
@@ -131,7 +348,487 @@ class OpenCVMOG2ObjectDetector(ObjectDetector):
 
 
 
-def match_objects(detections, frame_count, old_to, message_queue_add_func, distance_threshold = 200, max_disappearance = 40, notify_time = 30):
+class TiledObjectDetector(ObjectDetector):
+    #OpenCV lets go of the GIL, so we can use more than one core by cutting the frame into horizontal
+    #strips and running a separate detector on each one in a thread pool. The strips overlap so that
+    #the morphology near the cut sees the same neighbours it would in the full frame, and then we only
+    #keep the middle of each strip. Everything else the detectors do is per pixel, so the stitched
+    #mask is identical to running one detector over the whole frame
+    def __init__(self, make_detector, strips=4, overlap=8):
+        super().__init__()
+        self.make_detector = make_detector
+        self.strips = strips
+        #The median detector's open, close, dilate and median blur reach 6 rows out, MOG2's open reaches 2
+        self.overlap = overlap
+        self.height = None
+        self.detectors = []
+        self.bounds = []
+        self.pool = ThreadPoolExecutor(max_workers=strips, thread_name_prefix="tiled-detector")
+
+    def split(self, height):
+        #Works out (start, end) of every strip including the overlap, and (core_start, core_end) of the part we keep
+        self.height = height
+        self.bounds = []
+        step = int(np.ceil(height / self.strips))
+        for core_start in range(0, height, step):
+            core_end = min(core_start + step, height)
+            start = max(core_start - self.overlap, 0)
+            end = min(core_end + self.overlap, height)
+            self.bounds.append((start, end, core_start, core_end))
+
+        #Each strip gets its own background model
+        for detector in self.detectors:
+            detector.close()
+        self.detectors = [self.make_detector() for _ in self.bounds]
+
+    def run(self, method, current_frame):
+        if current_frame.shape[0] != self.height:
+            self.split(current_frame.shape[0])
+
+        return [self.pool.submit(getattr(detector, method), current_frame[start:end])
+                for detector, (start, end, _, _) in zip(self.detectors, self.bounds)]
+
+    def update_background(self, current_frame):
+        for future in self.run("update_background", current_frame):
+            future.result()
+
+    def iterate(self, current_frame):
+        futures = self.run("iterate", current_frame)
+
+        fg_mask = np.empty(current_frame.shape[:2], np.uint8)
+        for future, (start, _, core_start, core_end) in zip(futures, self.bounds):
+            fg_mask[core_start:core_end] = future.result()[core_start - start:core_end - start]
+        return fg_mask
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+        for detector in self.detectors:
+            detector.close()
+
+    def get_state(self):
+        if self.height is None:
+            return None
+        return {"height": self.height, "strips": [detector.get_state() for detector in self.detectors]}
+
+    def set_state(self, state):
+        self.split(state["height"])
+
+        #If the number of strips has changed since this was saved, we just have to learn from scratch
+        if len(state["strips"]) != len(self.detectors):
+            return
+
+        for detector, strip_state in zip(self.detectors, state["strips"]):
+            if strip_state is not None:
+                detector.set_state(strip_state)
+
+#Every camera keeps its detector states in the one file, as {camera id: {processing method: state}}. Saving
+#merges a camera's states into whatever the others have saved, under a lock file, since the cameras running in
+#vision processes save from processes of their own
+detector_state_lock = threading.Lock()
+
+def read_detector_state_file(path):
+    try:
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Error loading detector state, starting from scratch: {e}", flush=True)
+        return {}
+
+    #Files from before there was more than one camera only had one camera's states in them, and we can't tell which
+    if not isinstance(saved, dict) or saved.get("version") != 2:
+        print("The saved detector state is from an older version, starting from scratch", flush=True)
+        return {}
+    return saved["cameras"]
+
+def save_detector_states(path, camera_id, states):
+    #Write to a temporary file first so a crash halfway through can't leave us with a broken one
+    try:
+        with detector_state_lock, open(path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            saved = read_detector_state_file(path)
+            saved[camera_id] = states
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump({"version": 2, "cameras": saved}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Error saving detector state: {e}", flush=True)
+
+def load_detector_states(path, camera_id):
+    #Just this camera's states, keyed by processing method
+    return read_detector_state_file(path).get(camera_id, {})
+
+#The parameters each processing method takes, and the type and range of each one
+DETECTOR_PARAMETERS = {
+    0: {"bufsize": (int, 1, 255), "shadow_threshold": (int, 0, 255)},
+    1: {"history": (int, 1, 100000), "var_threshold": (float, 0.1, 1000.0), "detect_shadows": (bool, None, None)}
+}
+
+def whole_number(name, value):
+    #A number straight out of the JSON that has to be whole. Python treats true as 1 and int() cuts 7.9 down to 7,
+    #so neither is let through, and neither is a number sent as a string
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{name} should be a number")
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError(f"{name} should be a whole number")
+    return int(value)
+
+def validate_detector_params(processing_method, params):
+    #Checks the parameters sent to the API and hands them back with the right types, raises a ValueError if they're no good
+    if processing_method not in DETECTOR_PARAMETERS:
+        raise ValueError(f"Unknown processing method {processing_method}, please use one of {list(DETECTOR_PARAMETERS)}")
+    if params is None:
+        return {}
+    if not isinstance(params, dict):
+        raise ValueError("The detector parameters should be an object")
+
+    allowed = DETECTOR_PARAMETERS[processing_method]
+    validated = {}
+    for name, value in params.items():
+        if name not in allowed:
+            raise ValueError(f"Processing method {processing_method} doesn't take a {name} parameter, it takes {list(allowed)}")
+
+        cast, low, high = allowed[name]
+        if cast is bool:
+            if not isinstance(value, bool):
+                raise ValueError(f"{name} should be true or false")
+            validated[name] = value
+            continue
+
+        if cast is int:
+            value = whole_number(name, value)
+        elif isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{name} should be a number")
+        else:
+            value = float(value)
+        if not low <= value <= high:
+            raise ValueError(f"{name} should be between {low} and {high}")
+        validated[name] = value
+
+    return validated
+
+def create_object_detector(processing_method, threads=None, params=None):
+    #0 for the moving median background subtractor, 1 for openCV's builtin MOG2, with the parameters from
+    #validate_detector_params. More than 1 thread splits the work across that many threads, by default
+    #DETECTOR_THREADS of them
+    detector_class = MovingMedianObjectDetector if processing_method == 0 else OpenCVMOG2ObjectDetector
+    make_detector = partial(detector_class, **(params or {}))
+    if threads is None:
+        threads = config("DETECTOR_THREADS", default=1, cast=int)
+
+    if threads > 1:
+        return TiledObjectDetector(make_detector, strips=threads)
+    else:
+        return make_detector()
+
+class ContourBlobExtractor:
+    #This turns a foreground mask into TrackedObjects in display coordinates. This is the way we've always
+    #done it, find the outer contours, then measure and filter them one by one
+    def __init__(self, min_area, max_area, detection_size, display_size):
+        self.min_area = min_area
+        self.max_area = max_area
+        self.detection_size = detection_size
+        self.display_size = display_size
+
+    def extract(self, fgmask, frame_count, offset=(0, 0)):
+        #The offset is where the mask sits in the detection frame, if it was cropped
+        contours, hierarchy = cv.findContours(image=fgmask, mode=cv.RETR_EXTERNAL, method=cv.CHAIN_APPROX_SIMPLE, offset=offset)
+        new_detections = []
+        for contour in contours:
+            area = cv.contourArea(contour)
+            if area > self.min_area and area < self.max_area:
+                #Everything downstream (tracking, drawing, alerts) works in display coordinates
+                contour = scale_contour(contour, self.detection_size, self.display_size)
+                new_detections.append(TrackedObject(cv.boundingRect(contour), contour, frame_count))
+        return new_detections
+
+class ComponentBlobExtractor(ContourBlobExtractor):
+    #This gets the area and bounding box of every blob in one pass with connectedComponentsWithStats,
+    #and does the filtering on the whole array at once. Contours are only traced if someone asks for one.
+    #The area here is the number of pixels in the blob, which is a touch bigger than the contour area
+    #since contourArea runs through the middle of the edge pixels
+    def extract(self, fgmask, frame_count, offset=(0, 0)):
+        _, labels, stats, _ = cv.connectedComponentsWithStats(fgmask, connectivity=8)
+
+        #Label 0 is the background
+        areas = stats[1:, cv.CC_STAT_AREA]
+        keep = np.nonzero((areas > self.min_area) & (areas < self.max_area))[0] + 1
+        if len(keep) == 0:
+            return []
+
+        scale_x = self.display_size[0] / self.detection_size[0]
+        scale_y = self.display_size[1] / self.detection_size[1]
+
+        boxes = stats[keep, :4].astype(np.float64)
+        boxes[:, 0] += offset[0]
+        boxes[:, 1] += offset[1]
+        boxes *= [scale_x, scale_y, scale_x, scale_y]
+        boxes = np.round(boxes).astype(int)
+        scaled_areas = stats[keep, cv.CC_STAT_AREA] * (scale_x * scale_y)
+
+        new_detections = []
+        for label, box, area in zip(keep, boxes, scaled_areas):
+            x, y, w, h = stats[label, :4]
+            #We hang on to just this blob's patch of the mask so we can trace its contour later if we need to
+            patch = (labels[y:y + h, x:x + w] == label).astype(np.uint8)
+            new_detections.append(TrackedObject(tuple(int(v) for v in box), self.make_contour_function(patch, (x + offset[0], y + offset[1])), frame_count, area=float(area)))
+        return new_detections
+
+    def make_contour_function(self, patch, origin):
+        def make_contour():
+            contours, _ = cv.findContours(patch, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE, offset=origin)
+            return scale_contour(max(contours, key=len), self.detection_size, self.display_size)
+        return make_contour
+
+def create_blob_extractor(min_area, max_area, detection_size, display_size):
+    #BLOB_EXTRACTOR picks how we go from the mask to detections, either contours (the default) or components
+    if config("BLOB_EXTRACTOR", default="contours").lower() == "components":
+        return ComponentBlobExtractor(min_area, max_area, detection_size, display_size)
+    else:
+        return ContourBlobExtractor(min_area, max_area, detection_size, display_size)
+
+class MotionGate:
+    #Most of the time nothing is happening in front of the camera, so before we run the full detector we
+    #compare a tiny grayscale thumbnail against the one from the last frame we fully processed. If hardly
+    #anything has changed, the detector would find nothing new, so we can skip it
+    def __init__(self, thumbnail_size=(80, 60), pixel_threshold=12, changed_fraction=0.002, upkeep_interval=10):
+        self.thumbnail_size = thumbnail_size
+        self.pixel_threshold = pixel_threshold
+        self.changed_pixels = max(1, int(changed_fraction * thumbnail_size[0] * thumbnail_size[1]))
+        self.upkeep_interval = upkeep_interval
+        self.reference = None
+        self.skipped_since_upkeep = 0
+        self.frames = 0
+        self.skipped = 0
+
+    def make_thumbnail(self, frame):
+        #Shrinking first means the colour conversion only touches a few thousand pixels
+        thumbnail = cv.resize(frame, self.thumbnail_size, interpolation=cv.INTER_AREA)
+        return cv.cvtColor(thumbnail, cv.COLOR_BGR2GRAY)
+
+    def should_process(self, frame, force=False):
+        #Returns True if this frame needs to go through the detector. Use force when something is
+        #already being tracked, since a still object is not the same as an empty scene
+        self.frames += 1
+        thumbnail = self.make_thumbnail(frame)
+
+        if not force and self.reference is not None:
+            diff = cv.absdiff(thumbnail, self.reference)
+            _, diff = cv.threshold(diff, self.pixel_threshold, 255, cv.THRESH_BINARY)
+            if cv.countNonZero(diff) < self.changed_pixels:
+                self.skipped += 1
+                self.skipped_since_upkeep += 1
+                return False
+
+        self.reference = thumbnail
+        self.skipped_since_upkeep = 0
+        return True
+
+    def upkeep_due(self):
+        #We still want the background model to follow slow changes like the light through the day,
+        #so every so often a skipped frame gets handed to it
+        if self.skipped_since_upkeep >= self.upkeep_interval:
+            self.skipped_since_upkeep = 0
+            return True
+        return False
+
+    @property
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "skipped": self.skipped,
+            "skip_ratio": self.skipped / self.frames if self.frames > 0 else 0.0
+        }
+
+class DetectionZones:
+    #Trees, roads and TVs give us plenty of contours we don't care about. These are polygons to
+    #watch (include) and to ignore (exclude), with every point given as fractions of the frame width
+    #and height so the same zones work at any resolution. With no include zones we watch everything
+    def __init__(self, include=None, exclude=None):
+        self.include = DetectionZones.validate(include or [])
+        self.exclude = DetectionZones.validate(exclude or [])
+        #The rasterised masks, keyed by frame size, so we only draw them once per set of zones
+        self.cache = {}
+
+    @staticmethod
+    def validate(polygons):
+        #Raises a ValueError describing the problem if the polygons aren't usable
+        if not isinstance(polygons, list):
+            raise ValueError("Zones must be a list of polygons")
+
+        for polygon in polygons:
+            if not isinstance(polygon, list) or len(polygon) < 3:
+                raise ValueError("Every zone must be a list of at least 3 points")
+            for point in polygon:
+                if not isinstance(point, (list, tuple)) or len(point) != 2:
+                    raise ValueError("Every point must be an [x, y] pair")
+                #bool is an int as far as isinstance goes, but true isn't a coordinate
+                if not all(isinstance(v, (int, float)) and not isinstance(v, bool) and 0 <= v <= 1 for v in point):
+                    raise ValueError("Point coordinates must be fractions of the frame between 0 and 1")
+
+        return polygons
+
+    @staticmethod
+    def from_dict(data):
+        return DetectionZones(data.get("include"), data.get("exclude"))
+
+    def to_dict(self):
+        return {"include": self.include, "exclude": self.exclude}
+
+    @property
+    def active(self):
+        return len(self.include) > 0 or len(self.exclude) > 0
+
+    def scale_polygons(self, polygons, frame_size):
+        return [np.round(np.array(p, dtype=np.float32) * frame_size).astype(np.int32) for p in polygons]
+
+    def build(self, frame_size):
+        width, height = frame_size
+        include = self.scale_polygons(self.include, frame_size)
+        exclude = self.scale_polygons(self.exclude, frame_size)
+
+        #We only need to look at the part of the frame the include zones cover
+        if include:
+            x, y, w, h = cv.boundingRect(np.concatenate(include))
+            x, y = max(x, 0), max(y, 0)
+            w, h = min(w, width - x), min(h, height - y)
+        else:
+            x, y, w, h = 0, 0, width, height
+
+        if not self.active:
+            return (x, y, w, h), None
+
+        mask = np.zeros((height, width), np.uint8)
+        if include:
+            cv.fillPoly(mask, include, 255)
+        else:
+            mask[:] = 255
+        if exclude:
+            cv.fillPoly(mask, exclude, 0)
+
+        return (x, y, w, h), mask[y:y + h, x:x + w].copy()
+
+    def crop(self, frame_size):
+        #Returns the (x, y, w, h) region to run detection on, and the mask to apply inside that
+        #region (None if there is nothing to mask out)
+        if frame_size not in self.cache:
+            self.cache[frame_size] = self.build(frame_size)
+        return self.cache[frame_size]
+
+class DetectionGovernor:
+    #If detection takes longer than we have per frame, everything falls behind. This keeps an eye on how
+    #long detection and everything else take, and picks how often to run detection (every frame, every
+    #2nd, every 3rd...) so that we can keep up with the target fps. In between, trackers are extrapolated
+    def __init__(self, target_fps=15, max_cadence=4, smoothing=0.1):
+        self.target_fps = target_fps
+        self.max_cadence = max_cadence
+        self.smoothing = smoothing
+        self.cadence = 1
+        self.frame_number = 0
+        #Smoothed seconds per frame of detection, of everything else, and between frames
+        self.detect_time = None
+        self.other_time = None
+        self.frame_interval = None
+        self.last_tick = None
+
+    def smooth(self, average, value):
+        return value if average is None else average + self.smoothing * (value - average)
+
+    def should_detect(self):
+        #Called once per frame, returns True if this frame gets the full detection
+        self.frame_number += 1
+        return self.frame_number % self.cadence == 0
+
+    def record(self, detect_time, other_time):
+        #detect_time is None on frames we didn't run detection on
+        now = time.perf_counter()
+        if self.last_tick is not None:
+            self.frame_interval = self.smooth(self.frame_interval, now - self.last_tick)
+        self.last_tick = now
+
+        if detect_time is not None:
+            self.detect_time = self.smooth(self.detect_time, detect_time)
+        self.other_time = self.smooth(self.other_time, other_time)
+
+        if self.target_fps <= 0 or self.detect_time is None:
+            return
+
+        #Spread the detection cost over enough frames that what's left fits in the frame budget
+        spare = 1.0 / self.target_fps - self.other_time
+        if spare <= 0:
+            cadence = self.max_cadence
+        else:
+            cadence = int(np.ceil(self.detect_time / spare))
+        self.cadence = max(1, min(cadence, self.max_cadence))
+
+    @property
+    def stats(self):
+        return {
+            "cadence": self.cadence,
+            "target_fps": self.target_fps,
+            "achieved_fps": 1.0 / self.frame_interval if self.frame_interval else 0.0,
+            "detect_ms": self.detect_time * 1000 if self.detect_time is not None else None,
+            "other_ms": self.other_time * 1000 if self.other_time is not None else None
+        }
+
+class IdlePolicy:
+    #On a battery or solar site there's no point going flat out at an empty scene. After idle_after seconds
+    #with nothing detected (and nobody watching) the capture stage only takes idle_fps frames a second, and
+    #the first sign of activity puts it straight back to full speed. idle_after=0 turns this off
+    def __init__(self, idle_after=30, idle_fps=2):
+        self.idle_after = idle_after
+        self.idle_fps = idle_fps
+        self.last_activity = time.time()
+        self.last_frame = 0
+        self.idle_since = None
+        self.idle_periods = 0
+
+    def activity(self):
+        self.last_activity = time.time()
+        self.idle_since = None
+
+    def update(self, now=None):
+        #Called once every time round the capture loop, to notice when it's been quiet for long enough to go idle.
+        #Returns whether we're idle now
+        now = time.time() if now is None else now
+        if self.idle_after <= 0 or self.idle_fps <= 0 or now - self.last_activity < self.idle_after:
+            self.idle_since = None
+        elif self.idle_since is None:
+            self.idle_since = now
+            self.idle_periods += 1
+        return self.idle
+
+    @property
+    def idle(self):
+        #As of the last update, so looking doesn't change anything
+        return self.idle_since is not None
+
+    def wait_time(self):
+        #How long the capture stage should hold off before its next frame, 0 to go ahead now
+        if not self.idle:
+            return 0.0
+        return max(0.0, self.last_frame + 1.0 / self.idle_fps - time.time())
+
+    def frame_taken(self):
+        self.last_frame = time.time()
+
+    @property
+    def stats(self):
+        idle_since = self.idle_since
+        return {
+            "idle": idle_since is not None,
+            "idle_for": time.time() - idle_since if idle_since is not None else 0.0,
+            "idle_after": self.idle_after,
+            "idle_fps": self.idle_fps,
+            "idle_periods": self.idle_periods,
+            "since_activity": time.time() - self.last_activity
+        }
+
+def match_objects(detections, frame_count, old_to, message_queue_add_func, distance_threshold = 200, max_disappearance = 40, notify_time = 30, frame_size = REFERENCE_RESOLUTION):
+
+    #The distance threshold is given at the reference resolution, and the detections are in frame_size coordinates
+    distance_threshold = scale_distance(distance_threshold, frame_size)
 
     #Iterate through each object being tracked
     #Calculate the distance between the tracked object and all of the newly detected objects
@@ -156,10 +853,9 @@ def match_objects(detections, frame_count, old_to, message_queue_add_func, dista
 
 
             if min_distance < distance_threshold:
-                best_match_bbox = detections[best_match_index].bounding_box
+                best_match_bbox = unmatched_detections[best_match_index].bounding_box
     
-                tracked.bounding_box = best_match_bbox
-                tracked.lastSeenFrame = frame_count
+                tracked.update(best_match_bbox, frame_count)
     
                 del unmatched_detections[best_match_index]
 
@@ -177,6 +873,15 @@ def match_objects(detections, frame_count, old_to, message_queue_add_func, dista
             #    to="+18762834804"
             #)
 
+    notify_objects(to_notify, message_queue_add_func, frame_size)
+            
+    for new_det in unmatched_detections:
+        old_to.append(new_det)
+
+def notify_objects(to_notify, message_queue_add_func, frame_size = REFERENCE_RESOLUTION):
+    big_area = scale_area(10000, frame_size)
+    mid_x, mid_y = frame_size[0] / 2, frame_size[1] / 2
+
     if len(to_notify) == 0:
         #If we haven't picked up anything, don't say anything
         pass
@@ -184,8 +889,8 @@ def match_objects(detections, frame_count, old_to, message_queue_add_func, dista
         #If we've picked up 3 or less objects, we can dump details in the text message
         complete_msg = ""
         for t in to_notify:
-            body_size = "Small" if t.area < 10000 else "Big"
-            complete_msg = complete_msg + f'{body_size} object detected on {"right" if tracked.centroid[0] > 400 else "left"} side.'
+            body_size = "Small" if t.area < big_area else "Big"
+            complete_msg = complete_msg + f'{body_size} object detected on {"right" if t.centroid[0] > mid_x else "left"} side.'
             message_queue_add_func(complete_msg)
     else:
         #If we've picked up more than 3 objects, we summarize everything
@@ -193,12 +898,205 @@ def match_objects(detections, frame_count, old_to, message_queue_add_func, dista
                     sum(t.centroid[0] for t in to_notify) / len(to_notify),
                     sum(t.centroid[1] for t in to_notify) / len(to_notify)
                     )
-        msg = f'{len(to_notify)} objects detected, with average position at {"bottom" if avg_pos[1] >= 300 else "top"} - {"right" if avg_pos[0] > 400 else "left"}'
+        msg = f'{len(to_notify)} objects detected, with average position at {"bottom" if avg_pos[1] >= mid_y else "top"} - {"right" if avg_pos[0] > mid_x else "left"}'
         message_queue_add_func(msg)
 
-            
-    for new_det in unmatched_detections:
-        old_to.append(new_det)
+def solve_assignment(cost):
+    #Finds the pairing of rows to columns with the smallest total cost (the Hungarian algorithm, in
+    #the shortest augmenting path form). The inner loop over columns is done with numpy, so this is
+    #O(n^2 m) but with only O(n^2) python steps. Returns (rows, cols) like scipy's linear_sum_assignment
+    cost = np.asarray(cost, dtype=np.float64)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+
+    n, m = cost.shape
+    if n == 0:
+        return np.zeros(0, int), np.zeros(0, int)
+
+    #Everything is 1-indexed, with column 0 standing in for "not assigned yet"
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    owner = np.zeros(m + 1, int)
+    way = np.zeros(m + 1, int)
+
+    for row in range(1, n + 1):
+        owner[0] = row
+        col = 0
+        min_cost = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, bool)
+
+        while True:
+            used[col] = True
+            current_row = owner[col]
+            free = ~used
+            free[0] = False
+
+            reduced = cost[current_row - 1] - u[current_row] - v[1:]
+            better = free[1:] & (reduced < min_cost[1:])
+            min_cost[1:][better] = reduced[better]
+            way[1:][better] = col
+
+            candidates = np.where(free, min_cost, np.inf)
+            next_col = int(np.argmin(candidates))
+            delta = candidates[next_col]
+
+            u[owner[used]] += delta
+            v[used] -= delta
+            min_cost[free] -= delta
+
+            col = next_col
+            if owner[col] == 0:
+                break
+
+        #Walk back along the path, flipping the assignments
+        while col != 0:
+            previous = way[col]
+            owner[col] = owner[previous]
+            col = previous
+
+    cols = np.nonzero(owner[1:])[0]
+    rows = owner[cols + 1] - 1
+
+    if transposed:
+        rows, cols = cols, rows
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+class TrackedObjectView:
+    #The tracker keeps everything in arrays, this gives the old TrackedObject interface onto one row of
+    #them. Views are only good until the tracker next changes, since rows move around
+    __slots__ = ("tracker", "index")
+
+    def __init__(self, tracker, index):
+        self.tracker = tracker
+        self.index = index
+
+    @property
+    def id(self):
+        return str(self.tracker.ids[self.index])
+
+    @property
+    def bounding_box(self):
+        return tuple(int(v) for v in self.tracker.boxes[self.index])
+
+    @property
+    def centroid(self):
+        x, y, w, h = self.bounding_box
+        return (x + w // 2, y + h // 2)
+
+    @property
+    def velocity(self):
+        return tuple(float(v) for v in self.tracker.velocities[self.index])
+
+    @property
+    def lastSeenFrame(self):
+        return int(self.tracker.last_seen[self.index])
+
+    @property
+    def notified(self):
+        return bool(self.tracker.notified[self.index])
+
+    @property
+    def enabled(self):
+        return True
+
+    @property
+    def area(self):
+        return self.tracker.sources[self.index].area
+
+    @property
+    def contour(self):
+        return self.tracker.sources[self.index].contour
+
+class ObjectTracker:
+    #This does the same job as match_objects, but keeps the state of every tracked object in numpy
+    #arrays. Every frame we work out the distance from every tracked object to every detection in one
+    #go, and pair them up so the total distance is as small as possible instead of first come first
+    #served. Objects that have been gone too long are dropped rather than kept around disabled
+    def __init__(self, distance_threshold = 200, max_disappearance = 40, notify_time = 30, frame_size = REFERENCE_RESOLUTION):
+        self.distance_threshold = scale_distance(distance_threshold, frame_size)
+        self.max_disappearance = max_disappearance
+        self.notify_time = notify_time
+        self.frame_size = frame_size
+
+        self.ids = np.zeros(0, np.int64)
+        #bounding_box may be a prediction, detected_boxes is where we last actually saw each object
+        self.boxes = np.zeros((0, 4), np.float64)
+        self.detected_boxes = np.zeros((0, 4), np.float64)
+        self.velocities = np.zeros((0, 2), np.float64)
+        self.last_seen = np.zeros(0, np.int64)
+        self.notified = np.zeros(0, bool)
+        #The detections each object came from, so the area and contour are only worked out if they're needed
+        self.sources = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def objects(self):
+        return [TrackedObjectView(self, i) for i in range(len(self))]
+
+    def centroids(self, boxes):
+        return boxes[:, :2] + boxes[:, 2:] // 2
+
+    def match(self, detections, frame_count, message_queue_add_func):
+        detected = np.array([d.bounding_box for d in detections], dtype=np.float64).reshape(-1, 4)
+        unmatched = np.ones(len(detections), bool)
+
+        if len(self) > 0 and len(detections) > 0:
+            distances = np.linalg.norm(self.centroids(self.boxes)[:, None, :] - self.centroids(detected)[None, :, :], axis=2)
+
+            #Pairs that are too far apart can't be matched, so make them cost more than any real answer could
+            too_far = distances >= self.distance_threshold
+            rows, cols = solve_assignment(np.where(too_far, distances.max() * (len(self) + len(detections)) + 1, distances))
+            keep = ~too_far[rows, cols]
+            rows, cols = rows[keep], cols[keep]
+
+            frames = np.maximum(frame_count - self.last_seen[rows], 1)
+            self.velocities[rows] = (detected[cols, :2] - self.detected_boxes[rows, :2]) / frames[:, None]
+            self.boxes[rows] = detected[cols]
+            self.detected_boxes[rows] = detected[cols]
+            self.last_seen[rows] = frame_count
+            unmatched[cols] = False
+
+        #Objects we haven't seen for a while get reported, and after a while longer we forget them
+        missing = frame_count - self.last_seen
+        to_notify = np.nonzero((missing > self.notify_time) & ~self.notified)[0]
+        self.notified[to_notify] = True
+        notify_objects([TrackedObjectView(self, i) for i in to_notify], message_queue_add_func, self.frame_size)
+
+        alive = missing <= self.max_disappearance
+        if not alive.all():
+            self.keep(alive)
+
+        new = np.nonzero(unmatched)[0]
+        if len(new) > 0:
+            self.add([detections[i] for i in new], detected[new], frame_count)
+
+    def keep(self, mask):
+        self.ids = self.ids[mask]
+        self.boxes = self.boxes[mask]
+        self.detected_boxes = self.detected_boxes[mask]
+        self.velocities = self.velocities[mask]
+        self.last_seen = self.last_seen[mask]
+        self.notified = self.notified[mask]
+        self.sources = [s for s, k in zip(self.sources, mask) if k]
+
+    def add(self, detections, boxes, frame_count):
+        count = len(detections)
+        self.ids = np.concatenate([self.ids, [int(d.id) for d in detections]])
+        self.boxes = np.concatenate([self.boxes, boxes])
+        self.detected_boxes = np.concatenate([self.detected_boxes, boxes])
+        self.velocities = np.concatenate([self.velocities, np.zeros((count, 2))])
+        self.last_seen = np.concatenate([self.last_seen, np.full(count, frame_count, np.int64)])
+        self.notified = np.concatenate([self.notified, np.zeros(count, bool)])
+        self.sources.extend(detections)
+
+    def extrapolate(self, frame_count, max_frames=5):
+        #Same as TrackedObject.extrapolate, for everything at once
+        frames = np.minimum(frame_count - self.last_seen, max_frames)
+        self.boxes[:, :2] = np.round(self.detected_boxes[:, :2] + self.velocities * frames[:, None])
 
 def get_host_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
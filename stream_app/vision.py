@@ -0,0 +1,566 @@
+import cv2 as cv
+import numpy as np
+import queue
+import threading
+import time
+import dbutils
+from concurrent.futures import ThreadPoolExecutor
+from utils import *
+from capture import open_capture
+from pipeline import bus_prefix, frame_bus, BLOCK, DROP_OLDEST
+
+#How many processed frames can wait for the live view before the oldest get thrown away
+DISPLAY_QUEUE_FRAMES = 35
+
+def recording_slots(pre_roll):
+    #The recording buffer holds PRE_ROLL_SECONDS of frames at CAMERA_FPS, plus a second for record_frames to catch up
+    return int(np.ceil((pre_roll + 1) * config("CAMERA_FPS", default=30, cast=float)))
+
+def fitted_pre_roll(ring, pre_roll):
+    #How much pre-roll the recording buffer really holds. If the frame bus couldn't fit all of it, the second for
+    #catching up goes first and then the pre-roll itself, and we say so rather than quietly recording less
+    if ring.slots >= recording_slots(pre_roll):
+        return pre_roll
+
+    kept = max(0.0, min(pre_roll, ring.slots / config("CAMERA_FPS", default=30, cast=float) - 1))
+    if pre_roll > 0:
+        print(f"[vision] There's only room for {kept:.1f}s of the {pre_roll:g}s PRE_ROLL_SECONDS at {ring.shape[1]}x{ring.shape[0]}, "
+              "raise FRAME_BUS_MB or lower RECORD_RESOLUTION to keep it all", flush=True)
+    return kept
+
+def pipeline_bytes(display_size, record_size, pre_roll):
+    #How much of the frame bus a VisionPipeline reserves. Every queue between the stages carries display size frames
+    display = display_size[0] * display_size[1] * 3
+    queue_size = config("PIPELINE_QUEUE_SIZE", default=2, cast=int)
+    return (DISPLAY_QUEUE_FRAMES + 2 * queue_size) * display + recording_slots(pre_roll) * record_size[0] * record_size[1] * 3
+
+class VisionPipeline:
+    #This is everything between the camera and the rest of the program: the capture, detect and annotate
+    #stages, the tracker and the detector's background model. It used to be module level globals in
+    #stream.py, keeping it all in one object means it can be run in its own process too
+    def __init__(self, source, display_size, detection_size, on_message, processing_method=0, publish_display=True, camera_id=None, detector_threads=None,
+                 record_source=None, record_size=None, pre_roll=None, detector_params=None, bus=None):
+        self.source = source
+        #IP cameras often have a cheap substream and a high resolution main stream. If there's a record_source,
+        #we detect on source and record from record_source at record_size, otherwise we record what we detect on
+        self.record_source = record_source
+        self.record_size = record_size if record_source is not None and record_size else display_size
+        #Which camera in the database this is, for loading its detection zones
+        self.camera_id = camera_id
+        self.display_size = display_size
+        self.detection_size = detection_size
+        #Called with the alert text and the time the frame it was spotted in was captured, when the tracker has something to report
+        self.on_message = on_message
+        #0 for my moving median background subtractor, 1 to use openCV's builtin MOG2, and its parameters (see validate_detector_params)
+        self.processing_method = processing_method
+        self.detector_params = detector_params or {}
+        #A detector change from the API waiting for the detect stage to pick it up between frames, and the
+        #new detector while it warms up
+        self.detector_request = None
+        self.detector_warmup = None
+        self.detector_swaps = 0
+        #If this is False, nobody runs pass_frame and the owner reads frame_queue itself
+        self.publish_display = publish_display
+        #How many threads the detector can split its work across, None leaves it up to DETECTOR_THREADS
+        self.detector_threads = detector_threads
+
+        #This is a threading.Event and not a boolean to prevent race conditions
+        self.running = threading.Event()
+
+        #All of the frames this camera has in flight come out of the one frame bus every camera in this process shares
+        #(or the one a vision process was given), under names starting with bus_prefix
+        self.bus = bus if bus is not None else frame_bus()
+        self.bus_prefix = bus_prefix(camera_id if camera_id is not None else id(self))
+        display_bytes = display_size[0] * display_size[1] * 3
+
+        # Create a thread-safe queue for the processed frames on their way to the live view
+        self.frame_queue = self.bus.queue(self.bus_prefix + "display", display_bytes, maxsize=DISPLAY_QUEUE_FRAMES, policy=DROP_OLDEST)
+
+        # The latest processed frame, and a counter that goes up every time it changes
+        self.captured_frame = None
+        self.captured_seq = 0
+        self.captured_condition = threading.Condition()
+
+        self.frame_count = 0
+
+        #The capture time of the last frame anything was being tracked in, recordings keep going until a while after it
+        self.last_motion_at = None
+
+        #Everything we are currently tracking, in display coordinates
+        self.tracker = ObjectTracker(frame_size=display_size)
+
+        #The camera currently being read (and the one being recorded from, if that's different), and the motion
+        #gate and governor in front of the detector
+        self.camera = None
+        self.record_camera = None
+        self.motion_gate = None
+        self.governor = None
+
+        #The frame rate the detection governor tries to keep up, 0 runs detection on every frame no matter what
+        self.target_fps = config("TARGET_FPS", default=15, cast=float)
+
+        #The areas of the frame we watch and ignore, these get loaded from the database when capture starts
+        self.detection_zones = DetectionZones()
+
+        #This camera's background models, keyed by processing method, so that restarting capture doesn't mean
+        #learning the background all over again. Set DETECTOR_STATE_PATH to also keep them across restarts of the
+        #whole program, in a file the cameras share
+        self.detector_state_path = config("DETECTOR_STATE_PATH", default=None)
+        self.detector_states = load_detector_states(self.detector_state_path, camera_id) if self.detector_state_path else {}
+
+        #Set MOTION_GATE=False to run the detector on every frame, even when nothing is moving
+        self.use_motion_gate = config("MOTION_GATE", default=True, cast=bool)
+
+        #The queues between the capture, detect and annotate stages. By default detection sees every frame the
+        #capture stage gets, set the policies to drop_oldest to always skip ahead to the newest frame instead
+        queue_size = config("PIPELINE_QUEUE_SIZE", default=2, cast=int)
+        self.detect_queue = self.bus.queue(self.bus_prefix + "detect", display_bytes, maxsize=queue_size, policy=config("PIPELINE_DETECT_POLICY", default=BLOCK))
+        self.annotate_queue = self.bus.queue(self.bus_prefix + "annotate", display_bytes, maxsize=queue_size, policy=config("PIPELINE_ANNOTATE_POLICY", default=BLOCK))
+
+        #The last few seconds of frames for recordings, with their capture times so the recording can line itself up
+        #with the alert. It's the last thing onto the frame bus, so if anything has to make do with less it's this
+        self.pre_roll = config("PRE_ROLL_SECONDS", default=3.0, cast=float) if pre_roll is None else pre_roll
+        self.recording_ring = self.bus.ring(self.bus_prefix + "recording", recording_slots(self.pre_roll), (self.record_size[1], self.record_size[0], 3))
+        self.pre_roll = fitted_pre_roll(self.recording_ring, self.pre_roll)
+
+        #A camera that isn't there yet (still booting, off the network) gets tried again after CAMERA_RETRY_MIN
+        #seconds, doubling every time up to CAMERA_RETRY_MAX, for as long as we're running
+        self.retry_min = config("CAMERA_RETRY_MIN", default=0.5, cast=float)
+        self.retry_max = config("CAMERA_RETRY_MAX", default=30.0, cast=float)
+
+        #How the camera is getting on (stopped, opening, streaming or reconnecting) and how many times we've tried
+        #to open it. And when we started and got the first frame, so we know how long a cold start takes
+        self.camera_state = "stopped"
+        self.open_attempts = 0
+        self.started_at = None
+        self.first_frame_at = None
+
+        #How many people are watching the live view. With nobody watching there's no point drawing the overlay or
+        #publishing frames for it
+        self.viewers = 0
+        self.viewer_lock = threading.Lock()
+        self.unwatched_frames = 0
+
+        #Slows the capture stage right down when nothing has happened for a while, see IdlePolicy. Set IDLE_AFTER=0
+        #to always run at full speed
+        self.idle_policy = IdlePolicy(config("IDLE_AFTER", default=30, cast=float), config("IDLE_FPS", default=2, cast=float))
+        #With CONTINUOUS_RECORDING on, the footage from quiet periods is still being kept, so when the recording
+        #buffer is fed from this camera it goes on getting every frame and idling only thins out detection
+        self.record_while_idle = config("CONTINUOUS_RECORDING", default=False, cast=bool)
+
+        self.threads = {}
+
+    def open_camera(self, source, size):
+        #Keeps trying until the camera opens or we're stopped, in which case it returns None. This runs on the
+        #capture thread, so nothing else has to wait for a slow or missing camera
+        print("The video source is " + str(source))
+        delay = self.retry_min
+        while self.running.is_set():
+            self.open_attempts += 1
+            camera = open_capture(source, size)
+            if camera.isOpened():
+                return camera
+            camera.release()
+
+            print(f"[camera] Couldn't open {source}, retrying in {delay:.1f}s", flush=True)
+            self.wait_while_running(delay)
+            delay = min(delay * 2, self.retry_max)
+
+        return None
+
+    def wait_while_running(self, delay):
+        #Like time.sleep, but gives up as soon as we're stopped
+        deadline = time.time() + delay
+        while self.running.is_set() and time.time() < deadline:
+            time.sleep(min(0.1, deadline - time.time()))
+
+    def capture_frames(self):
+        #Stage 1: read frames off of the camera, keep a copy for recording and pass them on for detection
+        self.camera_state = "opening"
+        camera = self.open_camera(self.source, self.display_size)
+        if camera is None:
+            return
+
+        self.camera = camera
+        self.camera_state = "streaming"
+
+        while self.running.is_set():
+            #Somebody watching counts as activity, they want to see the scene at full speed
+            if self.viewers > 0:
+                self.idle_policy.activity()
+
+            #When it's quiet we only take a frame every so often. The short sleeps mean we pick up again as
+            #soon as there's activity
+            self.idle_policy.update()
+            wait = self.idle_policy.wait_time()
+            recording_only = wait > 0 and self.record_while_idle and self.record_source is None
+            if wait > 0 and not recording_only:
+                time.sleep(min(wait, 0.05))
+                continue
+
+            success, frame = camera.read()
+            if not success or frame is None:
+                print(f"read() success={success}, frame is None={frame is None}", flush=True)
+
+                if not camera.isOpened():
+                    print("[camera] Device unexpectedly closed, attempting to reopen...", flush=True)
+                    self.camera_state = "reconnecting"
+                    camera.release()
+                    camera = self.open_camera(self.source, self.display_size)
+                    if camera is None:
+                        return
+                    self.camera = camera
+                    self.camera_state = "streaming"
+                continue
+
+            timestamp = time.time()
+            if self.first_frame_at is None:
+                self.first_frame_at = timestamp
+                print(f"[camera] First frame after {timestamp - self.started_at:.2f}s", flush=True)
+
+            #The recording buffer gets its own copy straight out of the backend's buffer
+            if self.record_source is None:
+                self.recording_ring.write(frame, timestamp)
+            if recording_only:
+                continue
+            self.idle_policy.frame_taken()
+
+            #The capture backend has already resized the frame to cut down on what it takes to process it,
+            #but it reuses that buffer on the next read, so we take our own copy to draw on and queue
+            frame = frame.copy()
+
+            #Every frame carries its number and capture time with it, since the stages run at their own pace
+            self.detect_queue.put((self.frame_count, timestamp, frame), self.running)
+            self.frame_count += 1
+
+        camera.release()
+
+    def record_capture_frames(self):
+        #Only runs when there's a separate record_source, and just keeps the recording buffer full of its frames
+        camera = self.open_camera(self.record_source, self.record_size)
+        if camera is None:
+            return
+
+        self.record_camera = camera
+
+        while self.running.is_set():
+            success, frame = camera.read()
+            if not success or frame is None:
+                if not camera.isOpened():
+                    print("[camera] Record stream unexpectedly closed, attempting to reopen...", flush=True)
+                    camera.release()
+                    camera = self.open_camera(self.record_source, self.record_size)
+                    if camera is None:
+                        return
+                    self.record_camera = camera
+                continue
+
+            self.recording_ring.write(frame, time.time())
+
+        camera.release()
+
+    def detect_objects(self):
+        #Stage 2: run the detector and the tracker, and pass each frame on with where the tracked objects are
+        try:
+            sqlite_conn, sqlite_cursor = dbutils.load_database()
+            self.detection_zones = DetectionZones.from_dict(dbutils.get_detection_zones(sqlite_conn, sqlite_cursor, self.camera_id))
+        except Exception as e:
+            print(f"Error loading detection zones, watching the whole frame: {e}", flush=True)
+            self.detection_zones = DetectionZones()
+
+        #The API can change processing_method before it stops us, so remember which one we're actually running
+        method = self.processing_method
+        object_detector = create_object_detector(method, self.detector_threads, self.detector_params)
+        if self.detector_states.get(method) is not None:
+            object_detector.set_state(self.detector_states[method])
+
+        #A detector that's been asked for but isn't ready to take over yet, which learns the background on a
+        #thread of its own alongside the current one
+        candidate = None
+        warmup_pool = None
+        motion_gate = MotionGate() if self.use_motion_gate else None
+        self.motion_gate = motion_gate
+        governor = DetectionGovernor(target_fps=self.target_fps)
+        self.governor = governor
+
+        #The contour area limits were tuned at 800x600, so scale them to the detection resolution
+        min_area = scale_area(3500, self.detection_size)
+        max_area = scale_area(30000, self.detection_size)
+        blob_extractor = create_blob_extractor(min_area, max_area, self.detection_size, self.display_size)
+
+        while self.running.is_set():
+            try:
+                frame_number, frame_time, frame = self.detect_queue.get()
+            except queue.Empty:
+                continue
+
+            frame_start = time.perf_counter()
+
+            #Swapping detectors happens here between frames, so the camera and the stream never notice
+            request, self.detector_request = self.detector_request, None
+            if request is not None:
+                if candidate is not None:
+                    candidate[0].close()
+                candidate = self.prepare_detector(request, method, object_detector)
+
+            if candidate is not None and candidate[3] <= 0:
+                new_detector, new_method, new_params, _ = candidate
+                self.detector_states[method] = object_detector.get_state()
+                object_detector.close()
+                object_detector, method, candidate = new_detector, new_method, None
+                self.processing_method, self.detector_params = new_method, new_params
+                self.detector_swaps += 1
+                print(f"[detector] Switched to processing method {method} with {new_params}", flush=True)
+            self.detector_warmup = candidate[3] if candidate is not None else None
+
+            #The governor decides whether we can afford to run detection on this frame
+            detect_time = None
+            if governor.should_detect():
+                detect_start = time.perf_counter()
+
+                #The detector can run on an even smaller copy of the frame
+                if self.detection_size == self.display_size:
+                    detection_frame = frame
+                else:
+                    detection_frame = cv.resize(frame, self.detection_size, interpolation=cv.INTER_AREA)
+
+                #Only look at the part of the frame the detection zones cover. Grabbing the zones once per
+                #frame means an update from the API takes effect cleanly on the next one
+                zones = self.detection_zones
+                (crop_x, crop_y, crop_w, crop_h), zone_mask = zones.crop(self.detection_size)
+                detection_frame = detection_frame[crop_y:crop_y + crop_h, crop_x:crop_x + crop_w]
+
+                #The new detector learns from the same frame while the current one works on it
+                warmup = None
+                if candidate is not None:
+                    if warmup_pool is None:
+                        warmup_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="detector-warmup")
+                    warmup = warmup_pool.submit(candidate[0].update_background, detection_frame)
+
+                #Skip all of the detection work if the scene is empty and nothing has changed
+                if motion_gate is None or motion_gate.should_process(detection_frame, force=len(self.tracker) > 0):
+                    fgmask = object_detector.iterate(detection_frame)
+
+                    #Blank out anything in the excluded areas before we go looking for contours
+                    if zone_mask is not None:
+                        fgmask = cv.bitwise_and(fgmask, zone_mask)
+
+                    #The offset puts the blobs back into full detection frame coordinates
+                    new_detections = blob_extractor.extract(fgmask, frame_number, offset=(crop_x, crop_y))
+
+                    #Check the contours detected and compare them to the old ones to look for motion
+
+                    self.tracker.match(new_detections, frame_number, lambda msg: self.on_message(msg, frame_time))
+                elif motion_gate.upkeep_due():
+                    object_detector.update_background(detection_frame)
+
+                if warmup is not None:
+                    warmup.result()
+                    candidate[3] -= 1
+
+                detect_time = time.perf_counter() - detect_start
+            else:
+                #No detection this frame, so move everything we're tracking to where we expect it to be
+                self.tracker.extrapolate(frame_number)
+
+            #Anything being tracked keeps us out of idle, or wakes us up from it
+            if len(self.tracker) > 0:
+                self.idle_policy.activity()
+                self.last_motion_at = frame_time
+
+            #The tracker will have moved on by the time the frame gets drawn on, so send a snapshot along with it
+            overlays = [(t_obj.id, t_obj.centroid) for t_obj in self.tracker.objects]
+            self.annotate_queue.put((frame, overlays), self.running)
+
+            governor.record(detect_time, time.perf_counter() - frame_start - (detect_time or 0))
+
+            #Just for testing
+            #self.annotate_queue.put((cv.cvtColor(fgmask, cv.COLOR_GRAY2BGR), []), self.running)
+
+        #Hang on to the background model for the next time we start up
+        self.detector_states[method] = object_detector.get_state()
+        if self.detector_state_path:
+            save_detector_states(self.detector_state_path, self.camera_id, self.detector_states)
+
+        object_detector.close()
+        if candidate is not None:
+            candidate[0].close()
+        if warmup_pool is not None:
+            warmup_pool.shutdown(wait=False)
+        self.detector_warmup = None
+
+    def prepare_detector(self, request, method, object_detector):
+        #Builds the detector the API asked for and returns [detector, method, params, warm up frames left]
+        new_method, new_params, warmup_frames = request
+        new_detector = create_object_detector(new_method, self.detector_threads, new_params)
+
+        #The same kind of detector can start from what the current one has learned, so it's ready straight away.
+        #Otherwise it picks up where it left off last time it ran, if it has
+        if new_method == method:
+            state, warmup_frames = object_detector.get_state(), 0
+        else:
+            state = self.detector_states.get(new_method)
+        if state is not None:
+            new_detector.set_state(state)
+
+        return [new_detector, new_method, new_params, warmup_frames]
+
+    def swap_detector(self, method, params=None, warmup_frames=0):
+        #Changes the detector without stopping capture. With warmup_frames, the new detector learns the background
+        #alongside the current one for that many frames before it takes over, so there's no gap in detection
+        if not self.running.is_set():
+            self.processing_method, self.detector_params = method, params or {}
+            return
+        self.detector_request = (method, params or {}, warmup_frames)
+
+    def annotate_frames(self):
+        #Stage 3: draw the tracking overlay on and publish the frame for the live view
+        while self.running.is_set():
+            try:
+                frame, overlays = self.annotate_queue.get()
+            except queue.Empty:
+                continue
+
+            #Nobody to show it to, so don't bother drawing on it or passing it on
+            if self.viewers == 0:
+                self.unwatched_frames += 1
+                continue
+
+            #Just uncomment this if I want to see how tracking is working
+            for object_id, centroid in overlays:
+                cv.circle(frame, centroid, 10, (255, 0, 0), -1)
+                cv.putText(frame, " " + object_id, centroid, cv.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 0))
+
+            #put it in the queue, if the queue is full it drops the oldest frame
+            self.frame_queue.put(frame, self.running)
+
+    def pass_frame(self):
+        #This thread pulls the frame from the queue and sets it up for
+        #display via the MJPEG stream created by the generate_stream function
+        while self.running.is_set():
+            try:
+                frame = self.frame_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            with self.captured_condition:
+                self.captured_frame = frame
+                self.captured_seq += 1
+                self.captured_condition.notify_all()
+
+    def wait_for_jpeg(self, last_seq, timeout=1.0):
+        #Waits for a frame newer than last_seq and returns (seq, jpeg bytes), or (last_seq, None) if none turned up
+        with self.captured_condition:
+            if not self.captured_condition.wait_for(lambda: self.captured_seq != last_seq and self.captured_frame is not None, timeout=timeout):
+                return last_seq, None
+            frame, seq = self.captured_frame, self.captured_seq
+
+        _, buffer = cv.imencode('.jpg', frame)
+        return seq, buffer.tobytes()
+
+    def add_viewer(self):
+        with self.viewer_lock:
+            self.viewers += 1
+
+    def remove_viewer(self):
+        with self.viewer_lock:
+            self.viewers = max(0, self.viewers - 1)
+            if self.viewers == 0:
+                #Otherwise the next viewer would get whatever we were showing when the last one left
+                with self.captured_condition:
+                    self.captured_frame = None
+
+    def set_detection_zones(self, zones):
+        #The detect stage picks this up on its next frame, and rasterises the new masks once
+        self.detection_zones = zones
+
+    def start(self):
+        if self.running.is_set():
+            return
+
+        self.running.set()
+        self.started_at = time.time()
+        self.first_frame_at = None
+        self.open_attempts = 0
+        #Start out at full speed, the detector has a background to learn
+        self.idle_policy.activity()
+
+        stages = {"capture": self.capture_frames, "detect": self.detect_objects, "annotate": self.annotate_frames}
+        if self.record_source is not None:
+            stages["record"] = self.record_capture_frames
+        if self.publish_display:
+            stages["pass"] = self.pass_frame
+
+        self.threads = {name: threading.Thread(target=target, daemon=True) for name, target in stages.items()}
+        for thread in self.threads.values():
+            thread.start()
+
+    def stop(self):
+        self.running.clear()
+
+        #Join the threads to really make sure they're done
+        #This fixed a bug I found where the camera refused to restart
+        for thread in self.threads.values():
+            thread.join(timeout=2)
+        self.threads = {}
+        self.camera_state = "stopped"
+
+        #We empty the queues here to prevent erroneous data from sticking around if we restart
+        self.detect_queue.clear()
+        self.annotate_queue.clear()
+        self.frame_queue.clear()
+        self.recording_ring.clear()
+
+    def close(self):
+        self.stop()
+        #Our share of the frame bus goes back for whichever engine comes next
+        self.bus.release(self.bus_prefix)
+
+    def is_alive(self, stage):
+        thread = self.threads.get(stage)
+        return thread.is_alive() if thread else False
+
+    def startup_stats(self):
+        first_frame = self.first_frame_at - self.started_at if self.first_frame_at and self.started_at else None
+        return {
+            "camera_state": self.camera_state,
+            "open_attempts": self.open_attempts,
+            "started_at": self.started_at,
+            "first_frame_at": self.first_frame_at,
+            "time_to_first_frame": first_frame
+        }
+
+    def stats(self):
+        return {
+            "startup": self.startup_stats(),
+            "capture_thread_alive": self.is_alive("capture"),
+            "detect_thread_alive": self.is_alive("detect"),
+            "annotate_thread_alive": self.is_alive("annotate"),
+            "pass_thread_alive": self.is_alive("pass"),
+            "record_capture_thread_alive": self.is_alive("record"),
+            "capture": getattr(self.camera, "stats", None),
+            "record_capture": getattr(self.record_camera, "stats", None),
+            "motion_gate": self.motion_gate.stats if self.motion_gate else None,
+            "governor": self.governor.stats if self.governor else None,
+            "idle": self.idle_policy.stats,
+            "viewers": self.viewers,
+            "unwatched_frames": self.unwatched_frames,
+            "queue_lengths": {
+                "frame_queue": self.frame_queue.qsize()
+            },
+            "recording_buffer": self.recording_ring.stats,
+            "frame_bus": self.bus.stats,
+            "pipeline": {
+                "detect": self.detect_queue.stats,
+                "annotate": self.annotate_queue.stats
+            },
+            "detector": {
+                "method": self.processing_method,
+                "params": self.detector_params,
+                "warmup_frames_left": self.detector_warmup,
+                "swaps": self.detector_swaps
+            },
+            "tracked_objects": len(self.tracker),
+            "last_motion_at": self.last_motion_at,
+            "frame_count": self.frame_count
+        }
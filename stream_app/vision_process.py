@@ -0,0 +1,342 @@
+import cv2 as cv
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from decouple import config
+from pipeline import FrameBus, bus_prefix, frame_bus
+from shared_frames import SharedSlotRing
+from utils import DetectionZones
+from vision import VisionPipeline, fitted_pre_roll, pipeline_bytes, recording_slots
+
+#Flask, the MJPEG generators, the bot and the vision threads all fight over one GIL if they share a
+#process. Setting VISION_PROCESS=True runs the VisionPipeline in its own process instead. It publishes
+#the annotated frames as JPEGs, the raw frames for recording and its status through rings of shared
+#memory slots (see shared_frames.py), and alerts come back through a multiprocessing queue, as do the
+#detectors' background models when the worker stops, so the next one can pick up where it left off
+
+def publish_frames(pipeline, jpeg_ring, raw_ring, state_ring, state_interval=0.5):
+    #Runs in the worker process in place of pass_frame
+    last_state = 0
+    recording_ring = pipeline.recording_ring
+    next_seq = recording_ring.latest + 1
+    while pipeline.running.is_set():
+        try:
+            frame = pipeline.frame_queue.get(timeout=0.1)
+            #Encoding once here means every viewer gets the same JPEG without encoding it themselves
+            _, buffer = cv.imencode('.jpg', frame)
+            jpeg_ring.write(buffer)
+        except queue.Empty:
+            pass
+
+        #Pass on every recording frame we haven't yet, straight from the slot it was captured into. Capture can
+        #come round and reuse the slot while we're copying it, so it has to still be the same frame afterwards
+        next_seq = max(next_seq, recording_ring.oldest())
+        while next_seq <= recording_ring.latest:
+            slot = next_seq % recording_ring.slots
+            if recording_ring.seqs[slot] == next_seq:
+                timestamp = float(recording_ring.timestamps[slot])
+                if raw_ring.write(recording_ring.frames[slot], timestamp, check=lambda: recording_ring.seqs[slot] == next_seq) is None:
+                    recording_ring.missed += 1
+            next_seq += 1
+
+        if time.time() - last_state > state_interval:
+            last_state = time.time()
+            state_ring.write(json.dumps(pipeline.stats(), default=str).encode("utf-8"))
+
+def run_worker(settings, ring_names, control, messages):
+    #This is the entry point of the vision process
+    jpeg_ring = SharedSlotRing.attach(ring_names["jpeg"], settings["jpeg_slots"], settings["frame_bytes"])
+    raw_ring = SharedSlotRing.attach(ring_names["raw"], settings["raw_slots"], settings["record_bytes"])
+    state_ring = SharedSlotRing.attach(ring_names["state"], 2, settings["state_bytes"])
+
+    pipeline = VisionPipeline(settings["source"], settings["display_size"], settings["detection_size"],
+                              lambda msg, timestamp: messages.put(("alert", (msg, timestamp))),
+                              processing_method=settings["processing_method"], publish_display=False,
+                              camera_id=settings["camera_id"], detector_threads=settings["detector_threads"],
+                              record_source=settings["record_source"], record_size=settings["record_size"],
+                              pre_roll=0, detector_params=settings["detector_params"],
+                              bus=FrameBus(settings["bus_bytes"]))
+    pipeline.detector_states.update(settings["detector_states"])
+    pipeline.start()
+
+    publisher = threading.Thread(target=publish_frames, args=(pipeline, jpeg_ring, raw_ring, state_ring), daemon=True)
+    publisher.start()
+
+    parent = os.getppid()
+    while True:
+        try:
+            command, value = control.get(timeout=0.5)
+        except queue.Empty:
+            #If the web server went away without telling us, there's no one left to work for
+            if os.getppid() != parent:
+                break
+            continue
+
+        if command == "stop":
+            break
+        elif command == "zones":
+            pipeline.set_detection_zones(DetectionZones.from_dict(value))
+        elif command == "detector":
+            pipeline.swap_detector(*value)
+        elif command == "viewers":
+            pipeline.viewers = value
+
+    pipeline.stop()
+    publisher.join(timeout=2)
+    messages.put(("detector_states", pipeline.detector_states))
+
+    for ring in (jpeg_ring, raw_ring, state_ring):
+        ring.close()
+
+class VisionProcess:
+    #This stands in for a VisionPipeline in the web server process, and looks the same from the outside
+    def __init__(self, source, display_size, detection_size, on_message, processing_method=0, camera_id=None, detector_threads=None,
+                 record_source=None, record_size=None, pre_roll=None, detector_params=None, jpeg_slots=4, raw_slots=16, state_bytes=1 << 16):
+        self.source = source
+        self.record_source = record_source
+        self.record_size = record_size if record_source is not None and record_size else display_size
+        self.camera_id = camera_id
+        self.detector_threads = detector_threads
+        self.display_size = display_size
+        self.detection_size = detection_size
+        self.on_message = on_message
+        self.processing_method = processing_method
+        self.detector_params = detector_params or {}
+
+        #Everything this camera holds in either process comes out of the web server's frame bus: the shared memory,
+        #the pre-roll buffer on this side, and a slice for the worker to make its own bus out of, just big enough
+        #for its VisionPipeline
+        self.bus = frame_bus()
+        self.bus_prefix = bus_prefix(camera_id if camera_id is not None else id(self))
+        self.frame_bytes = display_size[0] * display_size[1] * 3
+        self.record_bytes = self.record_size[0] * self.record_size[1] * 3
+        worker_bytes = self.bus.reserve(self.bus_prefix + "worker", pipeline_bytes(display_size, self.record_size, 0))
+        for name, slots, size in (("jpeg", jpeg_slots, self.frame_bytes), ("raw", raw_slots, self.record_bytes), ("state", 2, state_bytes)):
+            self.bus.reserve(self.bus_prefix + name + " shared memory", SharedSlotRing.size_for(slots, size))
+
+        #The pre-roll buffer lives on this side, fed from the raw frames the worker publishes. The worker only keeps
+        #enough to get them to us (see VisionPipeline for how it's sized). It's reserved with everything else before
+        #any shared memory is made, so there's nothing to clean up if the frame bus turns out to be full
+        self.pre_roll = config("PRE_ROLL_SECONDS", default=3.0, cast=float) if pre_roll is None else pre_roll
+        self.recording_ring = self.bus.ring(self.bus_prefix + "recording", recording_slots(self.pre_roll), (self.record_size[1], self.record_size[0], 3))
+        self.pre_roll = fitted_pre_roll(self.recording_ring, self.pre_roll)
+
+        #The shared memory belongs to the web server, so a worker can be restarted without anyone else noticing
+        self.jpeg_ring = SharedSlotRing.create(jpeg_slots, self.frame_bytes)
+        self.raw_ring = SharedSlotRing.create(raw_slots, self.record_bytes)
+        self.state_ring = SharedSlotRing.create(2, state_bytes)
+        self.settings = {"jpeg_slots": jpeg_slots, "raw_slots": raw_slots, "state_bytes": state_bytes,
+                         "frame_bytes": self.frame_bytes, "record_bytes": self.record_bytes, "bus_bytes": worker_bytes}
+
+        #Spawn rather than fork, since forking a process full of threads is asking for trouble
+        self.context = multiprocessing.get_context("spawn")
+        self.process = None
+        self.control = None
+        self.messages = None
+
+        self.lost_recording_frames = 0
+
+        #The background models the last worker learned, keyed by processing method, which the next one starts from
+        self.detector_states = {}
+
+        self.running = threading.Event()
+        self.threads = {}
+        self.started_at = None
+
+        #The worker only draws and encodes frames for the live view while someone is watching, so it gets told
+        #how many viewers there are. viewers_since keeps a new viewer from being sent a frame from before
+        self.viewers = 0
+        self.viewers_since = 0
+        self.viewer_lock = threading.Lock()
+
+    def start(self):
+        if self.running.is_set():
+            return
+
+        self.running.set()
+        self.started_at = time.time()
+        self.control = self.context.Queue()
+        self.messages = self.context.Queue()
+
+        settings = dict(self.settings, source=self.source, display_size=self.display_size,
+                        detection_size=self.detection_size, processing_method=self.processing_method,
+                        detector_params=self.detector_params, detector_states=self.detector_states,
+                        camera_id=self.camera_id, detector_threads=self.detector_threads,
+                        record_source=self.record_source, record_size=self.record_size)
+        names = {"jpeg": self.jpeg_ring.name, "raw": self.raw_ring.name, "state": self.state_ring.name}
+        self.process = self.context.Process(target=run_worker, args=(settings, names, self.control, self.messages), daemon=True)
+        self.process.start()
+        self.control.put(("viewers", self.viewers))
+
+        self.threads = {
+            "recording": threading.Thread(target=self.receive_recording_frames, daemon=True),
+            "messages": threading.Thread(target=self.receive_messages, daemon=True)
+        }
+        for thread in self.threads.values():
+            thread.start()
+
+    def stop(self):
+        self.running.clear()
+
+        #The messages thread has to be out of the way before the worker sends back its detector states
+        for thread in self.threads.values():
+            thread.join(timeout=2)
+        self.threads = {}
+
+        if self.process is not None:
+            self.control.put(("stop", None))
+            self.collect_detector_states(timeout=5)
+            self.process.join(timeout=1)
+            if self.process.is_alive():
+                print("[vision] Worker didn't stop in time, terminating it", flush=True)
+                self.process.terminate()
+                self.process.join()
+            self.process = None
+
+        self.recording_ring.clear()
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def close(self):
+        self.stop()
+        for ring in (self.jpeg_ring, self.raw_ring, self.state_ring):
+            ring.close()
+        self.bus.release(self.bus_prefix)
+
+    def receive_recording_frames(self):
+        #Copies the raw frames out of shared memory into the recording buffer as they turn up
+        last_seq = self.raw_ring.latest_seq()
+        shape = (self.record_size[1], self.record_size[0], 3)
+
+        while self.running.is_set():
+            latest = self.raw_ring.latest_seq()
+            if latest == last_seq:
+                time.sleep(0.01)
+                continue
+
+            #If we fell more than a whole ring behind, the oldest ones are already gone
+            first = max(last_seq + 1, latest - self.raw_ring.slots + 1)
+            self.lost_recording_frames += first - (last_seq + 1)
+
+            for seq in range(first, latest + 1):
+                view, timestamp = self.raw_ring.view(seq)
+                #Straight from shared memory into the ring slot, without a copy in between. If the worker wrote over
+                #it while we were copying, the torn frame never makes it into the ring
+                if view is None or self.recording_ring.write(view.reshape(shape), timestamp, check=lambda: self.raw_ring.still_valid(seq)) is None:
+                    self.lost_recording_frames += 1
+
+            last_seq = latest
+
+    def receive_messages(self):
+        while self.running.is_set():
+            try:
+                kind, value = self.messages.get(timeout=0.1)
+                if kind == "alert":
+                    self.on_message(*value)
+            except queue.Empty:
+                continue
+            except Exception as e:
+                print(f"Error passing on message from the vision worker: {e}", flush=True)
+
+    def collect_detector_states(self, timeout):
+        #Waits for the stopping worker's detector states. It can't exit until somebody has read them off of the queue,
+        #and if it died instead we keep the ones we had. Any alerts still on their way are too late to matter
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                kind, value = self.messages.get(timeout=0.1)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    return
+                continue
+            if kind == "detector_states":
+                self.detector_states = value
+                return
+
+    def wait_for_jpeg(self, last_seq, timeout=1.0):
+        #Same as VisionPipeline.wait_for_jpeg, except the worker has already done the encoding, so all we
+        #do is copy the JPEG out of shared memory
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            seq = self.jpeg_ring.latest_seq()
+            if seq != last_seq and seq != 0:
+                data, timestamp = self.jpeg_ring.read(seq)
+                if data is not None and timestamp >= self.viewers_since:
+                    return seq, data
+            time.sleep(0.005)
+        return last_seq, None
+
+    def add_viewer(self):
+        with self.viewer_lock:
+            self.viewers += 1
+            if self.viewers == 1:
+                self.viewers_since = time.time()
+            self.send_viewers()
+
+    def remove_viewer(self):
+        with self.viewer_lock:
+            self.viewers = max(0, self.viewers - 1)
+            self.send_viewers()
+
+    def send_viewers(self):
+        if self.running.is_set():
+            self.control.put(("viewers", self.viewers))
+
+    def set_detection_zones(self, zones):
+        if self.running.is_set():
+            self.control.put(("zones", zones.to_dict()))
+
+    def swap_detector(self, method, params=None, warmup_frames=0):
+        #We remember it here too, so the worker starts with it the next time round
+        self.processing_method, self.detector_params = method, params or {}
+        if self.running.is_set():
+            self.control.put(("detector", (method, params or {}, warmup_frames)))
+
+    def read_state(self):
+        data, _ = self.state_ring.read(self.state_ring.latest_seq())
+        return json.loads(data) if data else {}
+
+    def startup_stats(self, status=None):
+        #The worker knows how its camera is getting on, but a cold start is timed from when we spawned it,
+        #since starting the process is part of it too. Anything left over from before a restart doesn't count
+        startup = (status if status is not None else self.read_state()).get("startup") or {}
+        first_frame_at = startup.get("first_frame_at")
+        if not self.running.is_set() or not self.started_at or (first_frame_at or 0) < self.started_at:
+            first_frame_at = None
+        if not self.running.is_set():
+            camera_state = "stopped"
+        elif first_frame_at is None and startup.get("camera_state") in (None, "stopped", "streaming"):
+            camera_state = "opening"
+        else:
+            camera_state = startup["camera_state"]
+
+        return {
+            "camera_state": camera_state,
+            "open_attempts": startup.get("open_attempts", 0),
+            "started_at": self.started_at,
+            "first_frame_at": first_frame_at,
+            "time_to_first_frame": first_frame_at - self.started_at if first_frame_at else None
+        }
+
+    @property
+    def last_motion_at(self):
+        #The worker's status is only a fraction of a second old, which is plenty for telling when a recording can stop
+        return self.read_state().get("last_motion_at")
+
+    def stats(self):
+        status = self.read_state()
+        status["startup"] = self.startup_stats(status)
+        status["vision_process"] = {
+            "alive": self.process.is_alive() if self.process else False,
+            "pid": self.process.pid if self.process else None,
+            "lost_recording_frames": self.lost_recording_frames
+        }
+        status["recording_buffer"] = self.recording_ring.stats
+        #The worker's frame bus only has its side of things, the rest of this camera is on ours
+        status["web_frame_bus"] = self.bus.stats
+        return status